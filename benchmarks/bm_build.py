@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end build benchmark for synthetic projects.
+
+Generates Sphinx projects with a configurable number of documents and
+``program-output`` directives per document, and times a cold build, a warm
+build with nothing changed and an incremental build after touching a single
+document, for every combination of the given parameters.  Run with::
+
+    python benchmarks/bm_build.py --documents 10 50 --jobs 1 2 4 \\
+        --duration 0 0.05 -o build.json
+
+Every directive runs a distinct ``sleep DURATION; echo N`` through the
+shell, so a POSIX shell is required.  Each build is a separate
+``sphinx-build`` process, and values are the median of ``--repeat`` runs,
+in seconds.
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from sphinxcontrib.programoutput.tests import CONF_PY
+
+SCENARIOS = ('cold', 'warm', 'incremental')
+
+
+def make_project(srcdir, documents, commands, duration):
+    os.makedirs(srcdir)
+    with open(os.path.join(srcdir, 'conf.py'), 'w', encoding='utf-8') as f:
+        f.write(CONF_PY)
+    with open(os.path.join(srcdir, 'index.rst'), 'w', encoding='utf-8') as f:
+        f.write('=====\nIndex\n=====\n\n.. toctree::\n\n')
+        for i in range(documents):
+            f.write('   doc%d\n' % i)
+    for i in range(documents):
+        with open(os.path.join(srcdir, 'doc%d.rst' % i), 'w',
+                  encoding='utf-8') as f:
+            f.write('========\nDoc %d\n========\n\n' % i)
+            for j in range(commands):
+                f.write('.. program-output:: sleep %g; echo %d\n'
+                        '   :shell:\n\n' % (duration, i * commands + j))
+
+
+def build(tmpdir, jobs, confoverrides):
+    args = [sys.executable, '-m', 'sphinx', '-q', '-b', 'html',
+            '-j', str(jobs), '-d', os.path.join(tmpdir, 'doctrees')]
+    for name, value in confoverrides.items():
+        args.extend(['-D', '%s=%s' % (name, value)])
+    args.extend([os.path.join(tmpdir, 'src'), os.path.join(tmpdir, 'html')])
+    start = time.perf_counter()
+    subprocess.run(args, check=True)
+    return time.perf_counter() - start
+
+
+def run(documents, commands, duration, jobs, confoverrides):
+    """
+    Time one cold, warm and incremental build of a fresh project.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        make_project(os.path.join(tmpdir, 'src'), documents, commands, duration)
+        timings = {}
+        timings['cold'] = build(tmpdir, jobs, confoverrides)
+        timings['warm'] = build(tmpdir, jobs, confoverrides)
+        # Make sure the modification time actually changes.
+        time.sleep(0.01)
+        os.utime(os.path.join(tmpdir, 'src', 'doc0.rst'))
+        timings['incremental'] = build(tmpdir, jobs, confoverrides)
+        return timings
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--documents', type=int, nargs='+', default=[20],
+                        help='numbers of documents (default: %(default)s)')
+    parser.add_argument('--commands', type=int, nargs='+', default=[5],
+                        help='numbers of directives per document '
+                        '(default: %(default)s)')
+    parser.add_argument('--duration', type=float, nargs='+', default=[0.0],
+                        help='seconds each command sleeps '
+                        '(default: %(default)s)')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1],
+                        help='values for sphinx-build -j (default: %(default)s)')
+    parser.add_argument('--max-workers', type=int, default=1,
+                        help='value of programoutput_max_workers '
+                        '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per combination (default: %(default)s)')
+    parser.add_argument('-D', dest='define', action='append', default=[],
+                        metavar='name=value',
+                        help='override a configuration value, as with '
+                        'sphinx-build')
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    args = parser.parse_args(argv)
+
+    confoverrides = dict(d.split('=', 1) for d in args.define)
+    confoverrides['programoutput_max_workers'] = args.max_workers
+
+    results = []
+    header = '{:>9} {:>8} {:>8} {:>4} ' + ' {:>11}' * len(SCENARIOS)
+    print(header.format('documents', 'commands', 'duration', 'jobs',
+                        *SCENARIOS))
+    for documents, commands, duration, jobs in itertools.product(
+            args.documents, args.commands, args.duration, args.jobs):
+        runs = [run(documents, commands, duration, jobs, confoverrides)
+                for _ in range(args.repeat)]
+        timings = {scenario: statistics.median(r[scenario] for r in runs)
+                   for scenario in SCENARIOS}
+        print(header.format(documents, commands, '%g' % duration, jobs,
+                            *('%.3f' % timings[s] for s in SCENARIOS)))
+        results.append(dict(documents=documents, commands=commands,
+                            duration=duration, jobs=jobs, **timings))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(dict(confoverrides=confoverrides,
+                           repeat=args.repeat,
+                           results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
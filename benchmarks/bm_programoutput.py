@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the command, cache and rendering hot paths.
+
+Run with::
+
+    python benchmarks/bm_programoutput.py -o before.json
+    python benchmarks/bm_programoutput.py -o after.json
+    python -m pyperf compare_to before.json after.json
+
+This requires `pyperf <https://pypi.org/project/pyperf/>`_. No command is
+actually executed: the cache is filled with synthetic outputs, so only the
+overhead of this extension is measured.  The benchmarks are run once by
+``sphinxcontrib.programoutput.tests.test_benchmarks``, so that they keep up
+with the extension.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from docutils.frontend import get_default_settings
+from docutils.parsers.rst import Parser
+from docutils.utils import new_document
+from sphinx.application import Sphinx
+
+from sphinxcontrib.programoutput import Command
+from sphinxcontrib.programoutput import ProgramOutputCache
+from sphinxcontrib.programoutput import _strip_ansi_formatting
+from sphinxcontrib.programoutput import program_output
+from sphinxcontrib.programoutput import run_programs
+from sphinxcontrib.programoutput.tests import CONF_PY
+
+#: Number of ``program_output`` nodes in a synthetic doctree.
+NODES = 2000
+
+#: Number of distinct commands among these nodes.
+COMMANDS = 200
+
+#: Number of ``program_output`` nodes in a synthetic doctree with large
+#: outputs.
+LARGE_NODES = 20
+
+#: Lines of a large output, about 4 MB.
+LARGE_LINES = 50000
+
+LINE = 'The quick brown fox jumps over the lazy dog, {0:>8}.'
+ANSI_LINE = '\x1b[1m\x1b[31mThe quick brown\x1b[0m fox jumps over \x1b[4mthe lazy dog\x1b[0m, {0:>8}.'
+
+SMALL_OUTPUT = '\n'.join(LINE.format(i) for i in range(20))
+LARGE_OUTPUT = '\n'.join(LINE.format(i) for i in range(LARGE_LINES))
+ANSI_OUTPUT = '\n'.join(ANSI_LINE.format(i) for i in range(LARGE_LINES))
+
+
+class StaticCommand(Command):
+    """
+    A command which pretends to print ``SMALL_OUTPUT``.
+    """
+
+    def get_output(self, timeout=None, statistics=None, **kwargs): # pylint:disable=unused-argument
+        return 0, SMALL_OUTPUT
+
+
+def make_app(tmpdir, **confoverrides):
+    srcdir = os.path.join(tmpdir, 'src')
+    os.makedirs(srcdir, exist_ok=True)
+    with open(os.path.join(srcdir, 'conf.py'), 'w', encoding='utf-8') as f:
+        f.write(CONF_PY)
+    with open(os.path.join(srcdir, 'index.rst'), 'w', encoding='utf-8') as f:
+        f.write('index\n=====\n')
+    app = Sphinx(srcdir, srcdir, os.path.join(tmpdir, 'html'),
+                 os.path.join(tmpdir, 'doctrees'), 'html',
+                 status=None, warning=None, confoverrides=confoverrides)
+    app.env.prepare_settings('index')
+    return app
+
+
+def make_doctree(commands, count, **attributes):
+    settings = get_default_settings(Parser)
+    doctree = new_document('<benchmark>', settings)
+    for i in range(count):
+        node = program_output()
+        node['command'] = commands[i % len(commands)]
+        node['show_prompt'] = False
+        node['hide_standard_error'] = False
+        node['extraargs'] = ''
+        node['working_directory'] = '/'
+        node['use_shell'] = False
+        node['returncode'] = 0
+        node['language'] = 'text'
+        for key, value in attributes.items():
+            node[key] = value
+        doctree += node
+    return doctree
+
+
+def fill_cache(app, commands, output):
+    cache = app.env.programoutput_cache
+    cache.clear()
+    for command in commands:
+        cache[Command(command)] = (0, output)
+
+
+def bench_command_new(loops, command, shell):
+    start = time.perf_counter()
+    for _ in range(loops):
+        Command(command, shell, False, '.')
+    return time.perf_counter() - start
+
+
+def bench_cache_hit(loops):
+    cache = ProgramOutputCache()
+    command = Command('echo spam')
+    cache[command] = (0, 'spam')
+    start = time.perf_counter()
+    for _ in range(loops):
+        cache[command] # pylint:disable=pointless-statement
+    return time.perf_counter() - start
+
+
+def bench_cache_miss(loops):
+    commands = [StaticCommand('echo %d' % i) for i in range(loops)]
+    cache = ProgramOutputCache()
+    start = time.perf_counter()
+    for command in commands:
+        cache[command] # pylint:disable=pointless-statement
+    return time.perf_counter() - start
+
+
+def time_run_programs(loops, app, commands, count, attributes=None):
+    elapsed = 0
+    for _ in range(loops):
+        doctree = make_doctree(commands, count, **(attributes or {}))
+        app.env.programoutput_commands.clear()
+        start = time.perf_counter()
+        run_programs(app, doctree)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def bench_run_programs(loops, app, commands, count, attributes=None):
+    # Render the output of every node, rather than reusing rendered texts.
+    app.env.programoutput_cache.max_rendered_size = 0
+    return time_run_programs(loops, app, commands, count, attributes)
+
+
+def bench_run_rendered(loops, app, commands, count):
+    # Reuse the texts of all nodes, rendered ahead.
+    cache = app.env.programoutput_cache
+    cache.max_rendered_size = ProgramOutputCache.max_rendered_size
+    run_programs(app, make_doctree(commands, count))
+    return time_run_programs(loops, app, commands, count)
+
+
+def bench_strip_ansi(loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        _strip_ansi_formatting(ANSI_OUTPUT)
+    return time.perf_counter() - start
+
+
+def main():
+    import pyperf
+    runner = pyperf.Runner()
+    runner.metadata['description'] = __doc__.strip().splitlines()[0]
+
+    runner.bench_time_func('Command.__new__ (list)', bench_command_new,
+                           ['python', '-c', 'print("spam")'], False)
+    runner.bench_time_func('Command.__new__ (shlex)', bench_command_new,
+                           'python -c \'print("spam with eggs")\' --long-option',
+                           False)
+    runner.bench_time_func('Command.__new__ (shell)', bench_command_new,
+                           'echo "${HOME}" | tr a-z A-Z', True)
+    runner.bench_time_func('ProgramOutputCache hit', bench_cache_hit)
+    runner.bench_time_func('ProgramOutputCache miss', bench_cache_miss)
+    runner.bench_time_func('_strip_ansi_formatting (4 MB)', bench_strip_ansi)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        app = make_app(tmpdir)
+        commands = ['echo %d' % i for i in range(COMMANDS)]
+
+        fill_cache(app, commands, SMALL_OUTPUT)
+        runner.bench_time_func('run_programs (%d nodes)' % NODES,
+                               bench_run_programs, app, commands, NODES)
+        runner.bench_time_func('run_programs (%d nodes, prompt)' % NODES,
+                               bench_run_programs, app, commands, NODES,
+                               dict(show_prompt=True))
+        runner.bench_time_func('run_programs (%d nodes, rendered)' % NODES,
+                               bench_run_rendered, app, commands, NODES)
+
+        large_commands = commands[:10]
+        fill_cache(app, large_commands, LARGE_OUTPUT)
+        runner.bench_time_func('run_programs (4 MB outputs, ellipsis)',
+                               bench_run_programs, app, large_commands,
+                               LARGE_NODES, dict(strip_lines=(10, -10)))
+
+        ansi_app = make_app(os.path.join(tmpdir, 'ansi'),
+                            programoutput_use_ansi=True)
+        fill_cache(ansi_app, large_commands, ANSI_OUTPUT)
+        runner.bench_time_func('run_programs (4 MB outputs, strip ANSI)',
+                               bench_run_programs, ansi_app, large_commands,
+                               LARGE_NODES)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
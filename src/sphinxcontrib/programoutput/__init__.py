@@ -32,24 +32,52 @@
 
     .. moduleauthor::  Sebastian Wiesner  <lunaryorn@gmail.com>
 """
+import asyncio
+import functools
+import glob
+import hashlib
+import json
 import os
 import re
 import shlex
+import shutil
 import sys
-from collections import defaultdict
-from collections import namedtuple
-from subprocess import PIPE
-from subprocess import STDOUT
-from subprocess import Popen
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from docutils import nodes
 from docutils.parsers import rst
 from docutils.parsers.rst.directives import flag
 from docutils.parsers.rst.directives import nonnegative_int
 from docutils.parsers.rst.directives import unchanged
+from docutils.parsers.rst.directives import unchanged_required
 from docutils.statemachine import StringList
+from sphinx.config import ENUM
+from sphinx.util.console import bold
 from sphinx.util import logging as sphinx_logging
 
+from sphinxcontrib.programoutput._blobs import BlobFile
+from sphinxcontrib.programoutput._blobs import _digest_output
+from sphinxcontrib.programoutput._cache import Cassette
+from sphinxcontrib.programoutput._cache import CassetteMissError # pylint:disable=unused-import
+from sphinxcontrib.programoutput._cache import CommandStatistics
+from sphinxcontrib.programoutput._cache import ProgramOutputCache
+from sphinxcontrib.programoutput._cache import SingleFlight
+from sphinxcontrib.programoutput._cache import SQLiteResultStore
+from sphinxcontrib.programoutput._command import Command
+from sphinxcontrib.programoutput._command import CommandTimeoutError # pylint:disable=unused-import
+from sphinxcontrib.programoutput._command import ShellSessions
+from sphinxcontrib.programoutput._output import _output_pipeline
+from sphinxcontrib.programoutput._output import _strip_ansi_formatting
+from sphinxcontrib.programoutput._spawn import SpawnServer
+from sphinxcontrib.programoutput._zygote import PythonZygote
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    # Windows
+    fcntl = None
+
 __version__ = '0.21.dev0'
 
 logger = sphinx_logging.getLogger('contrib.programoutput')
@@ -86,11 +114,11 @@ def _slice(value):
     return tuple((parts + [None] * 2)[:2])
 
 
-_ANSI_FORMAT_SEQUENCE = re.compile(r'\x1b\[[^m]+m')
-
-
-def _strip_ansi_formatting(text):
-    return _ANSI_FORMAT_SEQUENCE.sub('', text)
+def _timeout(value):
+    timeout = float(value)
+    if timeout <= 0:
+        raise ValueError('timeout must be positive')
+    return timeout
 
 
 def _create_output_node(output, use_ansi, app=None):
@@ -119,6 +147,103 @@ def _create_output_node(output, use_ansi, app=None):
     return ANSILiteralBlock(output, output)
 
 
+def _digest_files(paths):
+    """
+    Return a hex digest over the names and contents of ``paths``, a sequence
+    of ``(name, filename)`` tuples.
+    """
+    digest = hashlib.sha256()
+    for name, filename in paths:
+        digest.update(name.encode('utf-8') + b'\0')
+        with open(filename, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, 65536), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _digest_executable(path, size, mtime): # pylint:disable=unused-argument
+    # The size and modification time only invalidate the cached digest.
+    return _digest_files([('', path)])
+
+
+_SHELL_CONTROL_OPERATORS = frozenset(
+    ['|', '||', '|&', '&', '&&', ';', ';;', '(', ')'])
+
+
+def _executable_names(command):
+    """
+    Return the names of the executables run by :class:`Command` ``command``.
+
+    For shell commands, these are the first words of the simple commands
+    in pipelines and lists, as far as they can be told without running the
+    shell.
+    """
+    if not command.shell:
+        return [command._arguments()[0]] # pylint:disable=protected-access
+    lexer = shlex.shlex(command.command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    names = []
+    expect_name = True
+    redirect = False
+    try:
+        for token in lexer:
+            if token and not token.strip(lexer.punctuation_chars):
+                # A control operator like |, && or ;, or a redirection,
+                # which is followed by its target
+                redirect = token not in _SHELL_CONTROL_OPERATORS
+                expect_name = expect_name or not redirect
+            elif redirect:
+                redirect = False
+            elif expect_name and not re.match(r'[A-Za-z_]\w*=', token):
+                names.append(token)
+                expect_name = False
+    except ValueError:
+        # Unbalanced quotes, which the shell will complain about.
+        pass
+    return names
+
+
+def _fingerprint(command, config):
+    """
+    Return a hex digest identifying the executables run by ``command`` and
+    the environment variables listed in
+    :confval:`programoutput_fingerprint_environment`.
+
+    Executables are found on the ``PATH``, or relative to the working
+    directory of ``command``, and identified by their resolved path and
+    their size and modification time, or their contents if
+    :confval:`programoutput_fingerprint` is ``'hash'``.
+    """
+    executables = []
+    for name in _executable_names(command):
+        if os.sep in name or (os.altsep and os.altsep in name):
+            path = os.path.join(command.working_directory, name)
+        else:
+            path = shutil.which(name)
+        try:
+            path = os.path.realpath(path)
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            executables.append([name, None])
+            continue
+        if config.programoutput_fingerprint == 'hash':
+            identity = _digest_executable(path, stat.st_size, stat.st_mtime_ns)
+        else:
+            identity = [stat.st_size, stat.st_mtime_ns]
+        executables.append([path, identity])
+    environment = {name: os.environ.get(name)
+                   for name in config.programoutput_fingerprint_environment}
+    serialized = json.dumps([executables, environment], sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+#: The names of Python interpreters, see :func:`_python_invocation`.
+_PYTHON_INTERPRETER = re.compile(r'(?:python|pypy)[\d.]*(?:\.exe)?',
+                                 re.IGNORECASE)
+
+
 class ProgramOutputDirective(rst.Directive):
     has_content = False
     final_argument_whitespace = True
@@ -128,7 +253,10 @@ class ProgramOutputDirective(rst.Directive):
                        ellipsis=_slice, extraargs=unchanged,
                        returncode=nonnegative_int, cwd=unchanged,
                        caption=unchanged, name=unchanged,
-                       language=unchanged, **{'class': unchanged})
+                       language=unchanged, depends=unchanged,
+                       timeout=_timeout, python=flag,
+                       session=unchanged_required,
+                       **{'class': unchanged})
 
     def run(self):
         env = self.state.document.settings.env
@@ -147,10 +275,10 @@ class ProgramOutputDirective(rst.Directive):
         _, cwd = env.relfn2path(self.options.get('cwd', '/'))
         node['working_directory'] = cwd
         node['use_shell'] = 'shell' in self.options
+        self._set_runner(env, node)
         node['returncode'] = self.options.get('returncode', 0)
         node['language'] = self.options.get('language', 'text')
-        if 'ellipsis' in self.options:
-            node['strip_lines'] = self.options['ellipsis']
+        self._set_execution(env, node)
 
         classes = self.options.get('class', '').split() if 'class' in self.options else []
         if classes:
@@ -165,125 +293,365 @@ class ProgramOutputDirective(rst.Directive):
         self.add_name(node)
         return [node]
 
+    def _set_runner(self, env, node):
+        # Apply the python and session options, which run the command in
+        # another interpreter or shell.
+        if 'python' in self.options:
+            if node['use_shell']:
+                raise self.error(
+                    'The python and shell options are mutually exclusive')
+            self._check_interpreter()
+            node['python'] = True
+        if 'session' in self.options:
+            if node.get('python'):
+                raise self.error(
+                    'The python and session options are mutually exclusive')
+            node['use_shell'] = True
+            node['session'] = self._session_history(env, node)
+
+    def _set_execution(self, env, node):
+        # Apply the options and configuration values which change how the
+        # command is executed and cached, and start executing it if
+        # speculating.
+        if 'ellipsis' in self.options:
+            node['strip_lines'] = self.options['ellipsis']
+            stream = env.config.programoutput_stream_ellipsis
+            if stream:
+                node['window'] = self.options['ellipsis'] + (stream == 'stop',)
+        if 'timeout' in self.options:
+            node['timeout'] = self.options['timeout']
+        if 'depends' in self.options:
+            node['depends'] = self._digest_dependencies(
+                env, self.options['depends'].split())
+        if env.config.programoutput_fingerprint:
+            node['fingerprint'] = _fingerprint(
+                Command.from_program_output_node(node), env.config)
+        if env.config.programoutput_speculate and 'session' not in node:
+            # The commands of a session must run in order, in its shell.
+            env.programoutput_cache.speculate(
+                Command.from_program_output_node(node),
+                node.get('timeout', env.config.programoutput_timeout),
+                env.config.programoutput_max_workers)
+
+    def _check_interpreter(self):
+        # The python option runs the command with sys.executable in place of
+        # its first word, so that must name a Python interpreter.
+        try:
+            words = shlex.split(self.arguments[0])
+        except ValueError:
+            # Reported when executing the command.
+            return
+        if words and not _PYTHON_INTERPRETER.fullmatch(
+                os.path.basename(words[0])):
+            raise self.error(
+                'The python option requires a Python interpreter, not '
+                '{0!r}'.format(words[0]))
+
+    def _session_history(self, env, node):
+        # Return the session of the node's command, a tuple of its name and
+        # the commands the session ran before in this document, and append
+        # the command to this history.
+        name = self.options['session']
+        histories = env.temp_data.setdefault('programoutput_sessions', {})
+        history = histories.setdefault((name, node['working_directory']), [])
+        session = (name, tuple(history))
+        history.append((node['command'] + ' ' + node['extraargs']).strip())
+        return session
+
+    def _digest_dependencies(self, env, patterns):
+        # Resolve the glob patterns like ``cwd``, relative to the current
+        # document, and register every matching file with Sphinx, so that the
+        # document is read again (and its command gets a new cache key) when
+        # one of them changes.
+        paths = set()
+        for pattern in patterns:
+            _, abspattern = env.relfn2path(pattern)
+            matches = [path for path in glob.glob(abspattern, recursive=True)
+                       if os.path.isfile(path)]
+            if not matches:
+                logger.warning('No files match dependency %r', pattern,
+                               location=(env.docname, self.lineno))
+            paths.update((os.path.relpath(path, env.srcdir), path)
+                         for path in matches)
+        for _, path in paths:
+            env.note_dependency(path)
+        return _digest_files(sorted(paths))
 
-_Command = namedtuple(
-    '_Command', 'command shell hide_standard_error working_directory')
+
+def _prompt_template_as_unicode(app):
+    tmpl = app.config.programoutput_prompt_template
+    if isinstance(tmpl, bytes):
+        for enc in 'utf-8', sys.getfilesystemencoding():
+            try:
+                tmpl = tmpl.decode(enc)
+            except UnicodeError: # pragma: no cover
+                pass
+            else:
+                app.config.programoutput_prompt_template = tmpl
+                break
+    return tmpl
 
 
-class Command(_Command):
-    """
-    A command to be executed.
+def _get_results(app, commands, lazy=False):
     """
+    Retrieve the results of all ``commands`` from
+    ``app.env.programoutput_cache``.
 
-    def __new__(cls, command, shell=False, hide_standard_error=False,
-                working_directory='/'):
-        # `chdir()` resolves symlinks, so we need to resolve them too for
-        # caching to make sure that different symlinks to the same directory
-        # don't result in different cache keys.  Also normalize paths to make
-        # sure that identical paths are also equal as strings.
-        working_directory = os.path.normpath(os.path.realpath(
-            working_directory))
-        # Likewise, normalize the command now for better caching, and so
-        # that we can present *exactly* what we run to the user.
-        command = cls.__normalize_command(command, shell)
-        return _Command.__new__(cls, command, shell, hide_standard_error,
-                                working_directory)
+    ``commands`` maps each command to its timeout.  Return a dictionary
+    mapping each command to either its ``(returncode, output)`` tuple, or to
+    the :exc:`EnvironmentError` raised when trying to execute it.  If
+    ``lazy`` is true, cached results are not read but map to ``None``, and
+    the ``output`` of executed commands is encoded like
+    :meth:`ProgramOutputCache.get_encoded` returns it.  Commands
+    that are not cached yet are executed concurrently, at most
+    :confval:`programoutput_max_workers` at a time, by the engine selected
+    with :confval:`programoutput_engine`.  Only the commands of each shell
+    session are executed one after the other, in order, in a thread.
+    """
+    return _get_cache_results(app.env.programoutput_cache, commands,
+                              app.config.programoutput_max_workers,
+                              app.config.programoutput_engine, lazy)
 
-    @staticmethod
-    def __normalize_command(command, shell): # pylint:disable=unused-private-member
-        # Returns either a native string, or a tuple.
-        if not shell and isinstance(command, str):
-            command = shlex.split(command)
 
-        if isinstance(command, list):
-            command = tuple(command)
+def _get_cache_results(cache, commands, max_workers=1, engine='thread',
+                       lazy=False):
+    """
+    Like :func:`_get_results`, but from and to the
+    :class:`ProgramOutputCache` ``cache``, executing at most
+    ``max_workers`` commands at a time with ``engine``.
+    """
+    results = {}
+    missing = []
+    for command in commands:
+        if command in cache and command not in cache.speculative:
+            results[command] = None if lazy else cache[command]
+        else:
+            missing.append(command)
+    if results and cache.statistics is not None:
+        cache.statistics.record_hits(list(results))
 
-        assert isinstance(command, (str, tuple)), command
+    groups, session_groups = _group_commands(missing)
+    if engine == 'asyncio' and missing:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            results.update(asyncio.run(_get_results_async(
+                cache, {command: commands[command] for command in missing
+                        if command.session is None},
+                max_workers)))
+            groups = session_groups
+        # Otherwise we can't block on a running loop, fall back to threads.
+
+    results.update(_get_group_results(cache, commands, groups, max_workers))
+    if lazy:
+        for command in missing:
+            result = results[command]
+            if not isinstance(result, EnvironmentError):
+                results[command] = (
+                    result[0], result[1].encode('utf-8', 'surrogateescape'))
+    return results
+
+
+def _group_commands(commands):
+    """
+    Group ``commands`` for execution, each in a group of its own, except
+    for the commands of each shell session, which must be executed one
+    after the other, in order.
 
-        return command
+    Return the list of all groups, and the list of the groups of sessions.
+    """
+    groups = []
+    sessions = {}
+    for command in commands:
+        if command.session is None:
+            groups.append([command])
+            continue
+        key = (command.session[0], command.working_directory)
+        if key not in sessions:
+            sessions[key] = []
+            groups.append(sessions[key])
+        sessions[key].append(command)
+    return groups, list(sessions.values())
+
+
+def _get_group_results(cache, commands, groups, max_workers):
+    """
+    Execute the ``groups`` of :func:`_group_commands` concurrently, at most
+    ``max_workers`` at a time, and the commands of each group in order,
+    with the timeouts in ``commands``.
 
-    @classmethod
-    def from_program_output_node(cls, node):
-        """
-        Create a command from a :class:`program_output` node.
-        """
-        extraargs = node.get('extraargs', '')
-        command = (node['command'] + ' ' + extraargs).strip()
-        return cls(command, node['use_shell'],
-                   node['hide_standard_error'], node['working_directory'])
+    Return a dictionary like :func:`_get_results`.
+    """
+    def get_results(group):
+        group_results = []
+        for command in group:
+            try:
+                result = cache.get_output(command, commands[command])
+            except EnvironmentError as error:
+                result = error
+            group_results.append((command, result))
+        return group_results
+
+    results = {}
+    if max_workers == 1 or len(groups) < 2:
+        for group in groups:
+            results.update(get_results(group))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers or None) as pool:
+            for group_results in pool.map(get_results, groups):
+                results.update(group_results)
+    return results
+
+
+async def _get_results_async(cache, commands, max_workers):
+    """
+    Execute ``commands``, a mapping of commands to timeouts, concurrently
+    in the running event loop, at most ``max_workers`` at a time (or without
+    a limit if ``max_workers`` is ``None`` or ``0``).
 
-    def execute(self):
-        """
-        Execute this command.
+    Return a dictionary like :func:`_get_results`.
+    """
+    semaphore = asyncio.Semaphore(max_workers) if max_workers else None
 
-        Return the :class:`~subprocess.Popen` object representing the running
-        command.
-        """
-        command = self.command
+    async def get_result(command):
+        try:
+            if semaphore is None:
+                return await cache.get_output_async(command, commands[command])
+            async with semaphore:
+                return await cache.get_output_async(command, commands[command])
+        except EnvironmentError as error:
+            return error
 
-        # Popen is a context manager only in Python 3, and we'd have to restructure
-        # the code to work with it anyway.
-        # pylint:disable=consider-using-with
-        return Popen(command, shell=self.shell, stdout=PIPE,
-                     stderr=PIPE if self.hide_standard_error else STDOUT,
-                     cwd=self.working_directory)
+    results = await asyncio.gather(*[get_result(command)
+                                     for command in commands])
+    return dict(zip(commands, results))
 
-    def get_output(self):
-        """
-        Get the output of this command.
 
-        Return a tuple ``(returncode, output)``.  ``returncode`` is the
-        integral return code of the process, ``output`` is the output as
-        unicode string, with final trailing spaces and new lines stripped.
-        """
-        process = self.execute()
-        output = process.communicate()[0].decode(
-            sys.getfilesystemencoding(), 'replace').rstrip()
-        return process.returncode, output
+def _merge_timeouts(timeouts, command, timeout):
+    """
+    Set the timeout of ``command`` in the dictionary ``timeouts`` to
+    ``timeout``, unless it already has a longer one.  ``None`` is longest.
+    """
+    if command in timeouts:
+        previous = timeouts[command]
+        if previous is None or timeout is None:
+            timeout = None
+        else:
+            timeout = max(previous, timeout)
+    timeouts[command] = timeout
 
-    def __str__(self):
-        command = self.command
-        command = list(command) if isinstance(command, tuple) else command
-        return repr(command)
 
+def _get_node_commands(app, doctree):
+    """
+    Return a list of ``(node, command)`` tuples for all ``program_output``
+    nodes in ``doctree``, and a dictionary mapping each of these commands to
+    its timeout, both in document order.
 
-class ProgramOutputCache(defaultdict):
+    A command used by several nodes gets the longest of their timeouts.
     """
-    Execute command and cache their output.
+    node_commands = [(node, Command.from_program_output_node(node))
+                     for node in doctree.findall(program_output)]
+    timeouts = {}
+    for node, command in node_commands:
+        _merge_timeouts(timeouts, command,
+                        node.get('timeout', app.config.programoutput_timeout))
+    return node_commands, timeouts
 
-    This class is a mapping.  Its keys are :class:`Command` objects represeting
-    command invocations.  Its values are tuples of the form ``(returncode,
-    output)``, where ``returncode`` is the integral return code of the command,
-    and ``output`` is the output as unicode string.
 
-    The first time, a key is retrieved from this object, the command is
-    invoked, and its result is cached.  Subsequent access to the same key
-    returns the cached value.
+def _render_output(output, window, strip_ansi, prompt):
     """
+    Return the text shown for the encoded ``output`` of a command, windowed
+    and stripped by :func:`_output_pipeline`, and formatted with the
+    ``(template, command, returncode)`` of the ``prompt``, if not ``None``.
+    """
+    text = _output_pipeline(window, strip_ansi)(output)
+    if prompt is not None:
+        template, command, returncode = prompt
+        text = template.format(command=command, output=text,
+                               returncode=returncode)
+    return text
 
-    def __missing__(self, command):
-        """
-        Called, if a command was not found in the cache.
 
-        ``command`` is an instance of :class:`Command`.
-        """
-        result = command.get_output()
-        self[command] = result
-        return result
+def _replace_nodes(app, doctree, node_commands, results):
+    """
+    Replace the nodes of ``node_commands`` in ``doctree`` with nodes for the
+    ``results`` of their commands, as returned by :func:`_get_results` with
+    ``lazy`` set.
+    """
+    for node, command in node_commands:
+        result = results[command]
+        if isinstance(result, EnvironmentError):
+            error_message = 'Command {0} failed: {1}'.format(command, result)
+            error_node = doctree.reporter.error(error_message, base_node=node)
+            # Sphinx 1.8.0b1 started dropping all system_message nodes with a
+            # level less than 5 by default (or 2 if `keep_warnings` is set to true).
+            # This appears to be undocumented. Reporting failures is an important
+            # part of what this extension does, so we raise the default level.
+            error_node['level'] = 6
+            node.replace_self(error_node)
+        else:
+            node.replace_self(_output_node(app, node, command, result))
 
 
-def _prompt_template_as_unicode(app):
-    tmpl = app.config.programoutput_prompt_template
-    if isinstance(tmpl, bytes):
-        for enc in 'utf-8', sys.getfilesystemencoding():
-            try:
-                tmpl = tmpl.decode(enc)
-            except UnicodeError: # pragma: no cover
-                pass
-            else:
-                app.config.programoutput_prompt_template = tmpl
-                break
-    return tmpl
+def _output_node(app, node, command, result):
+    # Return the node showing ``result``, as returned by _get_results with
+    # ``lazy`` set, of ``command`` for the program_output ``node``.
+    cache = app.env.programoutput_cache
+    returncode, digest, read = _result_digest(cache, command, result)
+    if returncode is not None and returncode != node['returncode']:
+        logger.warning(
+            'Unexpected return code %s from command %r (output=%r)',
+            returncode, command, read().decode('utf-8', 'surrogateescape')
+        )
+
+    # replace lines with ..., if ellipsis is specified, and the
+    # command did not already do so while reading its output, and
+    # strip ANSI formatting which cannot be rendered
+    window = None
+    if 'strip_lines' in node and command.window is None:
+        window = tuple(node['strip_lines'])
+    use_ansi = app.config.programoutput_use_ansi
+    strip_ansi = use_ansi and 'erbsland.sphinx.ansi' not in app.extensions
+
+    prompt = None
+    if node['show_prompt']:
+        # The command in the node is also guaranteed to be
+        # unicode, but the prompt template might not be. This
+        # could be a native string on Python 2, or one with an
+        # explicit b prefix on 2 or 3 (for some reason).
+        # Attempt to decode it using UTF-8, preferentially, or
+        # fallback to sys.getfilesystemencoding(). If all that fails, fall back
+        # to the default encoding (which may have often worked before).
+        prompt = (_prompt_template_as_unicode(app), node['command'],
+                  returncode)
+
+    # The same output is often shown the same way on many pages.
+    output = cache.get_rendered(
+        (digest, window, strip_ansi, prompt),
+        lambda: _render_output(read(), window, strip_ansi, prompt))
+
+    new_node = _create_output_node(output, use_ansi, app)
+    new_node['language'] = node['language']
+    if 'classes' in node:
+        new_node['classes'].extend(node['classes'])
+    return new_node
+
+
+def _result_digest(cache, command, result):
+    # Return the return code of ``result``, as returned by _get_results with
+    # ``lazy`` set, of ``command``, the digest of its output, and a function
+    # returning its output, which is only read from ``cache`` when called.
+    entry = cache.get_digest(command)
+    if entry is None:
+        # Evicted since, the output must be read to digest it.
+        if result is None:
+            result = cache.get_encoded(command)
+        returncode, output = result
+        return returncode, _digest_output(output), lambda: output
+    returncode, digest = entry
+    if result is None:
+        return returncode, digest, lambda: cache.get_encoded(command)[1]
+    return returncode, digest, lambda: result[1]
 
 
 def run_programs(app, doctree):
@@ -293,65 +661,64 @@ def run_programs(app, doctree):
     replaced with a node, that represents the output of this program.
 
     The program output is retrieved from the cache in
-    ``app.env.programoutput_cache``.
+    ``app.env.programoutput_cache``.  All commands of ``doctree`` are
+    collected first, so that those not yet cached can be executed
+    concurrently (see :confval:`programoutput_max_workers`); the nodes are
+    then replaced in document order.
+
+    If :confval:`programoutput_defer` is set, the commands are only recorded
+    here, executed by :func:`run_deferred_programs`, and the nodes replaced
+    by :func:`resolve_programs`.
     """
+    node_commands, commands = _get_node_commands(app, doctree)
+    if not commands:
+        return
+    app.env.programoutput_commands.setdefault(
+        app.env.docname, {}).update(commands)
 
-    cache = app.env.programoutput_cache
+    if app.config.programoutput_defer:
+        for command, timeout in commands.items():
+            _merge_timeouts(app.env.programoutput_pending, command, timeout)
+        return
 
-    for node in doctree.findall(program_output):
-        command = Command.from_program_output_node(node)
-        try:
-            returncode, output = cache[command]
-        except EnvironmentError as error:
-            error_message = 'Command {0} failed: {1}'.format(command, error)
-            error_node = doctree.reporter.error(error_message, base_node=node)
-            # Sphinx 1.8.0b1 started dropping all system_message nodes with a
-            # level less than 5 by default (or 2 if `keep_warnings` is set to true).
-            # This appears to be undocumented. Reporting failures is an important
-            # part of what this extension does, so we raise the default level.
-            error_node['level'] = 6
-            node.replace_self(error_node)
-        else:
-            if returncode != node['returncode']:
-                logger.warning(
-                    'Unexpected return code %s from command %r (output=%r)',
-                    returncode, command, output
-                )
-
-            # replace lines with ..., if ellipsis is specified
-
-            # Recall that `output` is guaranteed to be a unicode string on
-            # all versions of Python.
-            if 'strip_lines' in node:
-                start, stop = node['strip_lines']
-                lines = output.splitlines()
-                lines[start:stop] = ['...']
-                output = '\n'.join(lines)
-
-            if node['show_prompt']:
-                # The command in the node is also guaranteed to be
-                # unicode, but the prompt template might not be. This
-                # could be a native string on Python 2, or one with an
-                # explicit b prefix on 2 or 3 (for some reason).
-                # Attempt to decode it using UTF-8, preferentially, or
-                # fallback to sys.getfilesystemencoding(). If all that fails, fall back
-                # to the default encoding (which may have often worked before).
-                prompt_template = _prompt_template_as_unicode(app)
-                output = prompt_template.format(
-                    command=node['command'],
-                    output=output,
-                    returncode=returncode
-                )
-
-            new_node = _create_output_node(
-                output, app.config.programoutput_use_ansi, app
-            )
-            new_node['language'] = node['language']
-            if 'classes' in node:
-                new_node['classes'].extend(node['classes'])
-            node.replace_self(new_node)
+    _replace_nodes(app, doctree, node_commands,
+                   _get_results(app, commands, lazy=True))
 
 
+def run_deferred_programs(app, env):
+    """
+    Execute the commands of all documents read by this build at once, if
+    :confval:`programoutput_defer` is set.
+
+    Failures are kept in ``env.programoutput_cache.failures`` (but not
+    pickled) for :func:`resolve_programs`.
+    """
+    pending = env.programoutput_pending
+    if not pending:
+        return
+    results = _get_results(app, pending, lazy=True)
+    env.programoutput_cache.failures.update(
+        (command, result) for command, result in results.items()
+        if isinstance(result, EnvironmentError))
+    pending.clear()
+
+
+def resolve_programs(app, doctree, docname): # pylint:disable=unused-argument
+    """
+    Replace the ``program_output`` nodes left in ``doctree`` by
+    :confval:`programoutput_defer` with the output of their programs.
+    """
+    node_commands, commands = _get_node_commands(app, doctree)
+    if not commands:
+        return
+    failures = app.env.programoutput_cache.failures
+    results = {command: failures[command]
+               for command in commands if command in failures}
+    results.update(_get_results(app, {
+        command: timeout for command, timeout in commands.items()
+        if command not in failures}, lazy=True))
+    _replace_nodes(app, doctree, node_commands, results)
+
 
 def init_cache(app):
     """
@@ -359,20 +726,357 @@ def init_cache(app):
     ``app.env.programoutput_cache``, if not already present (e.g. being
     loaded from a pickled environment).
 
-    The cache is of type :class:`ProgramOutputCache`.
+    The cache is of type :class:`ProgramOutputCache`.  If
+    :confval:`programoutput_cache_dir` is set, the cache is backed by a
+    :class:`SQLiteResultStore` in that directory.  Its limits are set from
+    :confval:`programoutput_cache_max_entries`,
+    :confval:`programoutput_cache_max_bytes` and
+    :confval:`programoutput_cache_policy`, evicting results right away if
+    they were lowered.  New outputs are compressed with
+    :confval:`programoutput_cache_compression`.  The outputs are kept in a
+    :class:`BlobFile` in the doctree directory, see :func:`write_blobs`;
+    blob files no longer used by the environment are removed.
+
+    Also initialize ``app.env.programoutput_commands``, which maps the names
+    of documents to dictionaries mapping the commands they execute to their
+    timeouts, and ``app.env.programoutput_pending``, which holds the commands
+    of :confval:`programoutput_defer`.
+
+    When reading in parallel, the cache is given a :class:`SingleFlight` so
+    that the reader processes execute each command only once.
+
+    Python commands are spawned by a :class:`PythonZygote` preloading
+    :confval:`programoutput_python_preload`, started right away when reading
+    in parallel with modules to preload or documents which ran Python
+    commands before, so that the readers share it, and the commands of shell
+    sessions run by :class:`ShellSessions`, where supported.  If
+    :confval:`programoutput_spawn_server` is enabled, other commands are
+    started by a :class:`SpawnServer`, which is started right away while
+    Sphinx is still small.
+
+    In ``'replay'`` and ``'auto'`` :confval:`programoutput_mode`, results
+    are looked up in the :class:`Cassette` at
+    :confval:`programoutput_cassette` first.  In ``'replay'`` mode, no
+    commands are executed, and none of the above processes are started.
+
+    Finally, reset ``app.env.programoutput_statistics``, the
+    :class:`CommandStatistics` of this build.
     """
+    mode = app.config.programoutput_mode
     if not hasattr(app.env, 'programoutput_cache'):
-        app.env.programoutput_cache = ProgramOutputCache()
+        store = None
+        if app.config.programoutput_cache_dir and mode != 'replay':
+            store = SQLiteResultStore(os.path.join(
+                app.confdir, app.config.programoutput_cache_dir))
+        app.env.programoutput_cache = ProgramOutputCache(store)
+    cache = app.env.programoutput_cache
+    cache.max_entries = app.config.programoutput_cache_max_entries
+    cache.max_bytes = app.config.programoutput_cache_max_bytes
+    cache.policy = app.config.programoutput_cache_policy
+    cache.compression = app.config.programoutput_cache_compression
+    cache.spill_threshold = app.config.programoutput_spill_threshold
+    cache.evict()
+    _init_blob_file(cache, str(app.doctreedir))
+    if not hasattr(app.env, 'programoutput_commands'):
+        app.env.programoutput_commands = {}
+        app.env.programoutput_purged = set()
+    if not hasattr(app.env, 'programoutput_pending'):
+        app.env.programoutput_pending = {}
+    cache.cassette = None
+    if mode in {'replay', 'auto'}:
+        cache.cassette = Cassette(_cassette_path(app))
+    cache.offline = mode == 'replay'
+
+    if app.parallel > 1 and fcntl is not None:
+        directory = tempfile.mkdtemp(prefix='programoutput-')
+        app.env.programoutput_cache.single_flight = SingleFlight(directory)
+
+    if not cache.offline:
+        python_preload = app.config.programoutput_python_preload
+        _start_processes(cache, python_preload,
+                         app.config.programoutput_spawn_server,
+                         app.parallel > 1 and bool(
+                             python_preload or _has_python_commands(app.env)))
+
+    app.env.programoutput_statistics = CommandStatistics()
+    app.env.programoutput_cache.statistics = app.env.programoutput_statistics
+
+
+def _init_blob_file(cache, doctreedir):
+    """
+    Find the :class:`BlobFile` of ``cache`` in ``doctreedir``, even if that
+    was moved, or create one there, and remove the blob files there which
+    are no longer used.
+    """
+    if cache.blob_file is None:
+        cache.blob_file = BlobFile.create(doctreedir)
+    else:
+        cache.blob_file = BlobFile(os.path.join(
+            doctreedir, os.path.basename(cache.blob_file.path)))
+    for path in glob.glob(os.path.join(glob.escape(doctreedir),
+                                       BlobFile.pattern)):
+        if path != cache.blob_file.path:
+            try:
+                os.remove(path)
+            except OSError: # pragma: no cover
+                pass
+
+
+def _has_python_commands(env):
+    # Whether the documents read before executed ``python`` commands.
+    return any(command.python
+               for commands in env.programoutput_commands.values()
+               for command in commands)
+
+
+def _start_processes(cache, python_preload=(), spawn_server=False,
+                     start_zygote=False):
+    # Give ``cache`` the processes to execute commands with, where
+    # available.  The zygote is started when first used, unless
+    # ``start_zygote``: when reading in parallel, the forked readers should
+    # share one zygote, rather than each starting one of its own.
+    if PythonZygote.available:
+        cache.zygote = PythonZygote(python_preload)
+        if start_zygote:
+            try:
+                cache.zygote.start()
+            except OSError:
+                # Report this for the commands which need it.
+                pass
+    if ShellSessions.available:
+        cache.sessions = ShellSessions()
+    if spawn_server and SpawnServer.available:
+        cache.spawn_server = SpawnServer()
+        cache.spawn_server.start()
+
+
+def _stop_processes(cache):
+    cache.stop_speculating()
+    if cache.zygote is not None:
+        cache.zygote.close()
+        cache.zygote = None
+    if cache.sessions is not None:
+        cache.sessions.close()
+        cache.sessions = None
+    if cache.spawn_server is not None:
+        cache.spawn_server.close()
+        cache.spawn_server = None
+
+
+def find_changed_executables(app, env, added, changed, removed): # pylint:disable=unused-argument
+    """
+    Return the documents with a command whose fingerprint changed, e.g.
+    because the executable it runs was upgraded, so that they are read
+    again.
+    """
+    fingerprints = {}
+    outdated = []
+    for docname, commands in env.programoutput_commands.items():
+        for command in commands:
+            if command.fingerprint is None:
+                continue
+            if command not in fingerprints:
+                fingerprints[command] = _fingerprint(command, app.config)
+            if fingerprints[command] != command.fingerprint:
+                outdated.append(docname)
+                break
+    return outdated
+
+
+def find_changed_cassette(app, env, added, changed, removed): # pylint:disable=unused-argument
+    """
+    Return the documents with commands, if the cassette replayed in
+    :confval:`programoutput_mode` changed since they were read, e.g. because
+    it was recorded again, and forget their cached results, so that their
+    results are replayed from the cassette again.
+    """
+    cassette = env.programoutput_cache.cassette
+    if (cassette is None or cassette.digest ==
+            getattr(env, 'programoutput_cassette_digest', None)):
+        return []
+    env.programoutput_cassette_digest = cassette.digest
+    for commands in env.programoutput_commands.values():
+        for command in commands:
+            env.programoutput_cache.discard(command)
+    return list(env.programoutput_commands)
+
+
+def purge_commands(app, env, docname): # pylint:disable=unused-argument
+    """
+    Forget the commands of ``docname``, which is about to be read again.
+
+    Their output is kept in the cache until :func:`prune_cache`, so that
+    unchanged commands need not be executed again.
+    """
+    env.programoutput_purged.update(
+        env.programoutput_commands.pop(docname, ()))
+
+
+def merge_commands(app, env, docnames, other): # pylint:disable=unused-argument
+    """
+    Merge the commands of ``docnames`` and their output from the environment
+    of a parallel reader process into ``env``.
+    """
+    for docname in docnames:
+        if docname in other.programoutput_commands:
+            env.programoutput_commands[docname] = \
+                other.programoutput_commands[docname]
+    env.programoutput_cache.merge(other.programoutput_cache)
+    for command, timeout in other.programoutput_pending.items():
+        _merge_timeouts(env.programoutput_pending, command, timeout)
+    env.programoutput_statistics.merge(other.programoutput_statistics)
+
+
+def prune_cache(app, env): # pylint:disable=unused-argument
+    """
+    Remove the output of purged commands from the cache, unless a document
+    still executes them.
+    """
+    used = set().union(*env.programoutput_commands.values())
+    for command in env.programoutput_purged - used:
+        env.programoutput_cache.discard(command)
+    env.programoutput_purged.clear()
+
+
+def _cassette_path(app):
+    return os.path.join(app.confdir, app.config.programoutput_cassette)
+
+
+def record_cassette(app, env):
+    """
+    Record the results of the commands of all documents to the
+    :class:`Cassette` at :confval:`programoutput_cassette`, in ``'record'``
+    and ``'auto'`` :confval:`programoutput_mode`.
+
+    In ``'record'`` mode, the cassette is replaced with these results;
+    in ``'auto'`` mode, they are added to it.  Results which are not cached
+    (any longer) are retrieved again; those of commands which failed are
+    not recorded.
+    """
+    mode = app.config.programoutput_mode
+    if mode not in ('record', 'auto'):
+        return
+    cache = env.programoutput_cache
+    cassette = cache.cassette or Cassette(_cassette_path(app))
+
+    def results():
+        for command in set().union(*env.programoutput_commands.values()):
+            if command in cache.failures:
+                continue
+            try:
+                yield command, cache[command]
+            except EnvironmentError:
+                pass
+
+    cassette.record(results(), keep=mode == 'auto')
+    cassette.save()
+    env.programoutput_cassette_digest = cassette.digest
+
+
+def write_blobs(app, env): # pylint:disable=unused-argument
+    """
+    Move the output of commands out of the environment into the blob file
+    of the cache, before the environment is pickled, so that loading it
+    does not read all output.
+    """
+    env.programoutput_cache.write_blobs()
+
+
+def cleanup_single_flight(app, exception): # pylint:disable=unused-argument
+    single_flight = app.env.programoutput_cache.single_flight
+    if single_flight is not None:
+        shutil.rmtree(single_flight.directory, ignore_errors=True)
+        app.env.programoutput_cache.single_flight = None
+
+
+def stop_processes(app, exception): # pylint:disable=unused-argument
+    """
+    Stop the speculative executions, the zygote, the shell sessions and the
+    spawn server of this build.
+    """
+    _stop_processes(app.env.programoutput_cache)
+
+
+def _format_size(size):
+    if size is None:
+        return '-'
+    return '{0:.1f} MiB'.format(size / 1024.0 / 1024.0)
+
+
+def report_statistics(app, exception):
+    """
+    Log the :confval:`programoutput_report_slowest` slowest commands of this
+    build, and write all statistics to :confval:`programoutput_report_file`.
+    """
+    if exception is not None:
+        return
+    statistics = app.env.programoutput_statistics
+    count = app.config.programoutput_report_slowest
+    if count and statistics.executions:
+        logger.info(bold('slowest commands (wall, cpu, peak rss):'))
+        for command, stats in statistics.slowest(count):
+            cpu = None
+            if stats.get('user') is not None:
+                cpu = stats['user'] + stats['system']
+            logger.info('%8s %8s %10s  %s%s',
+                        '{0:.2f}s'.format(stats['wall'] or 0),
+                        '-' if cpu is None else '{0:.2f}s'.format(cpu),
+                        _format_size(stats.get('max_rss')), command,
+                        ' (failed)' if 'error' in stats else '')
+    if app.config.programoutput_report_file:
+        path = os.path.join(app.outdir, app.config.programoutput_report_file)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(statistics.as_json(app.env.programoutput_commands), f,
+                      indent=2, sort_keys=True)
 
 
 def setup(app):
     app.add_config_value('programoutput_prompt_template',
                          '$ {command}\n{output}', 'env')
     app.add_config_value('programoutput_use_ansi', False, 'env')
+    app.add_config_value('programoutput_max_workers', 1, '')
+    app.add_config_value('programoutput_cache_dir', None, 'env')
+    app.add_config_value('programoutput_cache_max_entries', None, '')
+    app.add_config_value('programoutput_cache_max_bytes', None, '')
+    app.add_config_value('programoutput_cache_policy', 'lru', '',
+                         ENUM('lru', 'lfu'))
+    app.add_config_value('programoutput_cache_compression', 'zlib', '',
+                         ENUM(None, 'zlib', 'lzma'))
+    app.add_config_value('programoutput_timeout', None, '')
+    app.add_config_value('programoutput_spill_threshold', None, '')
+    app.add_config_value('programoutput_stream_ellipsis', False, 'env',
+                         ENUM(False, True, 'stop'))
+    app.add_config_value('programoutput_engine', 'thread', '',
+                         ENUM('thread', 'asyncio'))
+    app.add_config_value('programoutput_defer', False, 'env')
+    app.add_config_value('programoutput_speculate', False, '')
+    app.add_config_value('programoutput_report_slowest', 0, '')
+    app.add_config_value('programoutput_report_file', None, '')
+    app.add_config_value('programoutput_python_preload', [], '')
+    app.add_config_value('programoutput_spawn_server', False, '')
+    app.add_config_value('programoutput_fingerprint', False, 'env',
+                         ENUM(False, True, 'hash'))
+    app.add_config_value('programoutput_fingerprint_environment', [], 'env')
+    app.add_config_value('programoutput_mode', None, 'env',
+                         ENUM(None, 'record', 'replay', 'auto'))
+    app.add_config_value('programoutput_cassette',
+                         'programoutput-cassette.json', '')
     app.add_directive('program-output', ProgramOutputDirective)
     app.add_directive('command-output', ProgramOutputDirective)
     app.connect('builder-inited', init_cache)
     app.connect('doctree-read', run_programs)
+    app.connect('env-get-outdated', find_changed_executables)
+    app.connect('env-get-outdated', find_changed_cassette)
+    app.connect('env-purge-doc', purge_commands)
+    app.connect('env-merge-info', merge_commands)
+    app.connect('env-updated', prune_cache)
+    app.connect('env-updated', run_deferred_programs)
+    app.connect('env-updated', record_cassette)
+    app.connect('env-updated', write_blobs)
+    app.connect('doctree-resolved', resolve_programs)
+    app.connect('build-finished', cleanup_single_flight)
+    app.connect('build-finished', stop_processes)
+    app.connect('build-finished', report_statistics)
     metadata = {
         'parallel_read_safe': True
     }
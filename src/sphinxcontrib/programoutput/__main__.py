@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput.__main__
+    ====================================
+
+    Execute the commands of a Sphinx project ahead of ``sphinx-build``,
+    possibly split across several machines::
+
+        python -m sphinxcontrib.programoutput manifest docs commands.json
+        python -m sphinxcontrib.programoutput run commands.json \\
+            results-1.json --shard 1/2
+        python -m sphinxcontrib.programoutput run commands.json \\
+            results-2.json --shard 2/2
+        python -m sphinxcontrib.programoutput merge docs/_cache \\
+            results-1.json results-2.json
+        sphinx-build -D programoutput_cache_dir=_cache docs html
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from sphinx.application import Sphinx
+
+from sphinxcontrib.programoutput import ProgramOutputCache
+from sphinxcontrib.programoutput import SQLiteResultStore
+from sphinxcontrib.programoutput import _get_cache_results
+from sphinxcontrib.programoutput import _merge_timeouts
+from sphinxcontrib.programoutput import _start_processes
+from sphinxcontrib.programoutput import _stop_processes
+from sphinxcontrib.programoutput._cache import _command_as_json
+from sphinxcontrib.programoutput._cache import _command_from_json
+
+#: The version of the format of manifest and result files.
+VERSION = 1
+
+
+def collect_commands(srcdir, confdir=None, confoverrides=None, jobs=1):
+    """
+    Return a dictionary mapping the commands of all documents of the Sphinx
+    project in ``srcdir`` to their timeouts, without executing any.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='programoutput-')
+    try:
+        # Replaying an empty cassette executes nothing, and deferring the
+        # commands does not report them as missing from it.
+        confoverrides = dict(
+            confoverrides or {}, programoutput_mode='replay',
+            programoutput_cassette=os.path.join(tmpdir, 'cassette.json'),
+            programoutput_defer=True)
+        app = Sphinx(srcdir, confdir or srcdir, os.path.join(tmpdir, 'out'),
+                     os.path.join(tmpdir, 'doctrees'), 'dummy',
+                     confoverrides=confoverrides, status=None,
+                     warning=sys.stderr, freshenv=True, parallel=jobs)
+        app.builder.read()
+        commands = {}
+        for document_commands in app.env.programoutput_commands.values():
+            for command, timeout in document_commands.items():
+                _merge_timeouts(commands, command, timeout)
+        return commands
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def shard(commands, index, count):
+    """
+    Return the commands of shard ``index`` (counting from 1) of ``count``
+    shards of the list ``commands``, in their order.
+
+    Commands are assigned to shards by a stable key, so that each shard of
+    the same commands is the same on every machine.  The commands of a shell
+    session are kept in the same shard, so that they run in one shell.
+    """
+    def key(command):
+        if command.session is None:
+            return json.dumps(command, sort_keys=True)
+        name, previous = command.session
+        first = previous[0] if previous else command.command
+        return json.dumps([name, command.working_directory, first])
+
+    keys = sorted({key(command) for command in commands})
+    selected = set(keys[index - 1::count])
+    return [command for command in commands if key(command) in selected]
+
+
+def _read(path, kind):
+    with open(path, encoding='utf-8') as f:
+        content = json.load(f)
+    if content.get('version') != VERSION or kind not in content:
+        raise ValueError('{0} is not a {1} file of version {2}'.format(
+            path, kind.rstrip('s'), VERSION))
+    return content
+
+
+def _write(path, content):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(content, version=VERSION), f, ensure_ascii=False,
+                  indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def manifest(args):
+    srcdir = os.path.abspath(args.srcdir)
+    confoverrides = dict(define.split('=', 1) for define in args.define)
+    commands = collect_commands(srcdir, args.confdir, confoverrides,
+                                args.jobs)
+    _write(args.manifest, dict(srcdir=srcdir, commands=[
+        dict(_command_as_json(command, srcdir), timeout=timeout)
+        for command, timeout in commands.items()]))
+    print('{0} commands'.format(len(commands)))
+    return 0
+
+
+def run(args):
+    content = _read(args.manifest, 'commands')
+    srcdir = os.path.abspath(args.srcdir or content['srcdir'])
+    commands = {}
+    for fields in content['commands']:
+        _merge_timeouts(commands, _command_from_json(fields, srcdir),
+                        fields.get('timeout'))
+    index, count = args.shard
+    commands = {command: commands[command]
+                for command in shard(list(commands), index, count)}
+
+    cache = ProgramOutputCache(compression=None)
+    _start_processes(cache, args.python_preload, args.spawn_server)
+    try:
+        results = _get_cache_results(cache, commands, args.jobs)
+    finally:
+        _stop_processes(cache)
+
+    status = 0
+    entries = []
+    for command, result in results.items():
+        if isinstance(result, EnvironmentError):
+            print('Command {0} failed: {1}'.format(command, result),
+                  file=sys.stderr)
+            status = 1
+            continue
+        returncode, output = result
+        entries.append(dict(_command_as_json(command, srcdir),
+                            returncode=returncode, output=output))
+    _write(args.results, dict(srcdir=srcdir, results=entries))
+    print('{0} of {1} commands executed'.format(len(entries), len(commands)))
+    return status
+
+
+def merge(args):
+    store = SQLiteResultStore(os.path.abspath(args.cache_dir))
+    count = 0
+    for path in args.results:
+        content = _read(path, 'results')
+        srcdir = os.path.abspath(args.srcdir or content['srcdir'])
+        for fields in content['results']:
+            store.set(_command_from_json(fields, srcdir),
+                      (fields['returncode'], fields['output']))
+            count += 1
+    print('{0} results merged into {1}'.format(count, store.directory))
+    return 0
+
+
+def _shard(value):
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            'expected I/N with 1 <= I <= N, got {0!r}'.format(value))
+    return index, count
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m sphinxcontrib.programoutput',
+        description='Execute the commands of a Sphinx project ahead of '
+        'sphinx-build, in shards.')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    subparser = subparsers.add_parser(
+        'manifest', help='write the commands of all documents of a project '
+        'to a manifest file, without executing them')
+    subparser.add_argument('srcdir', help='the source directory')
+    subparser.add_argument('manifest', help='the manifest file to write')
+    subparser.add_argument('-c', dest='confdir',
+                           help='the directory of conf.py, if not SRCDIR')
+    subparser.add_argument('-D', dest='define', action='append', default=[],
+                           metavar='setting=value',
+                           help='override a setting of conf.py')
+    subparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='read documents in parallel')
+    subparser.set_defaults(function=manifest)
+
+    subparser = subparsers.add_parser(
+        'run', help='execute the commands of a shard of a manifest, and '
+        'write their results to a file')
+    subparser.add_argument('manifest', help='the manifest file to read')
+    subparser.add_argument('results', help='the result file to write')
+    subparser.add_argument('--shard', type=_shard, default=(1, 1),
+                           metavar='I/N', help='execute the I-th of N shards '
+                           '(default: all commands)')
+    subparser.add_argument('--srcdir',
+                           help='the source directory, if moved since the '
+                           'manifest was written')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           default=os.cpu_count() or 1,
+                           help='execute commands in parallel '
+                           '(default: %(default)s)')
+    subparser.add_argument('--python-preload', action='append', default=[],
+                           metavar='MODULE',
+                           help='like programoutput_python_preload')
+    subparser.add_argument('--spawn-server', action='store_true',
+                           help='like programoutput_spawn_server')
+    subparser.set_defaults(function=run)
+
+    subparser = subparsers.add_parser(
+        'merge', help='merge result files into the persistent cache of '
+        'programoutput_cache_dir')
+    subparser.add_argument('cache_dir', help='the cache directory')
+    subparser.add_argument('results', nargs='+',
+                           help='the result files to merge')
+    subparser.add_argument('--srcdir',
+                           help='the source directory, if moved since the '
+                           'results were written')
+    subparser.set_defaults(function=merge)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run the command line ``argv``, and return its exit status.
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.function(args)
+    except (OSError, ValueError) as error:
+        sys.stderr.write('{0}: error: {1}\n'.format(parser.prog, error))
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
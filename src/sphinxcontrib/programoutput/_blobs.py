@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput._blobs
+    ==================================
+
+    Storing the outputs of commands once per distinct content, in memory or
+    in blob files.
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+try:
+    import lzma
+except ImportError: # pragma: no cover
+    # Python built without liblzma
+    lzma = None
+
+
+def _digest_output(data):
+    """
+    Return the digest by which :class:`ProgramOutputCache` identifies the
+    output ``data``, encoded like :meth:`ProgramOutputCache.get_encoded`
+    returns it.
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _compress(data, compression):
+    """
+    Compress the bytes ``data`` with ``compression``, ``'zlib'``, ``'lzma'``
+    or ``None``.
+
+    Return the compression used and the compressed data, which is left
+    uncompressed if compressing it does not make it smaller.
+    """
+    if compression == 'zlib':
+        compressed = zlib.compress(data)
+    elif compression == 'lzma' and lzma is not None:
+        compressed = lzma.compress(data)
+    else:
+        return None, data
+    if len(compressed) >= len(data):
+        return None, data
+    return compression, compressed
+
+
+def _decompress_blob(compression, data):
+    """
+    Return the output stored by :class:`ProgramOutputCache` as ``data``,
+    compressed with ``compression``, encoded in UTF-8.
+    """
+    if compression == 'zlib':
+        data = zlib.decompress(data)
+    elif compression == 'lzma':
+        data = lzma.decompress(data)
+    return data
+
+
+def _blob_size(data):
+    # The size of a stored output, in memory or in a blob file.
+    return data[1] if isinstance(data, tuple) else len(data)
+
+
+class BlobFile(object):
+    """
+    An append-only file at ``path`` holding the outputs of a
+    :class:`ProgramOutputCache`, which are read through :mod:`mmap` when
+    needed.
+
+    It is pickled by its path, and equal to other objects for the same
+    file.
+    """
+
+    #: The pattern of the names of the files created by :meth:`create`.
+    pattern = 'programoutput-*.blobs'
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, directory):
+        """
+        Return a new blob file in ``directory``.
+        """
+        return cls(os.path.join(
+            directory, cls.pattern.replace('*', uuid.uuid4().hex)))
+
+    def __reduce__(self):
+        return (type(self), (self.path,))
+
+    def __eq__(self, other):
+        if not isinstance(other, BlobFile):
+            return NotImplemented
+        return self.path == other.path
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def size(self):
+        """
+        The size of the file, or 0 if it does not exist.
+        """
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, chunks):
+        """
+        Append the byte strings ``chunks`` to the file, and return a list of
+        their offsets and lengths.
+        """
+        positions = []
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                for chunk in chunks:
+                    f.write(chunk)
+                    positions.append((offset, len(chunk)))
+                    offset += len(chunk)
+        return positions
+
+    def read(self, offset, length):
+        """
+        Return ``length`` bytes at ``offset``.
+
+        Raise :exc:`OSError` if the file does not exist, and
+        :exc:`ValueError` if it is too short.
+        """
+        if not length:
+            return b''
+        with self._lock:
+            if self._map is None or offset + length > len(self._map):
+                self._close()
+                with open(self.path, 'rb') as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self._map[offset:offset + length]
+        if len(data) != length:
+            raise ValueError('{0} is truncated'.format(self.path))
+        return data
+
+    def close(self):
+        """
+        Unmap the file.
+        """
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+#: The errors raised when reading an output from a damaged :class:`BlobFile`.
+_BLOB_FILE_ERRORS = (OSError, ValueError, zlib.error) + (
+    (lzma.LZMAError,) if lzma is not None else ())
+
+
+class _Outputs(object):
+    """
+    The results of the commands of a :class:`ProgramOutputCache`, holding
+    each distinct output once, within the limits of the cache.
+
+    Outputs are compressed with :attr:`compression` unless that does not
+    make them smaller, and only decompressed when read.  The limits are not
+    pickled, but the order and frequency of use of the results are.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru',
+                 compression='zlib'):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.compression = compression
+        self.blob_file = None
+        #: The total number of bytes of stored output.
+        self.size = 0
+        # results maps commands to their return code and the digest of their
+        # output, and uses maps them, from the least to the most recently
+        # used, to their number of uses.  blobs maps digests to the
+        # compression and data of the output, or its offset and length in
+        # the blob file, and the number of commands sharing it.
+        self.results = {}
+        self.uses = OrderedDict()
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        with self.lock:
+            entries = [(command,) + self.results[command] + (uses,)
+                       for command, uses in self.uses.items()]
+            blobs = {digest: tuple(blob[:2])
+                     for digest, blob in self.blobs.items()}
+        return (type(self), (), (entries, blobs, self.blob_file))
+
+    def __setstate__(self, state):
+        entries, blobs, self.blob_file = state
+        for command, returncode, digest, uses in entries:
+            self._add(command, returncode, digest, *blobs[digest])
+            self.uses[command] = uses
+
+    def __len__(self):
+        return len(self.uses)
+
+    def __iter__(self):
+        return iter(list(self.uses))
+
+    def __contains__(self, command):
+        return command in self.uses
+
+    def get_digest(self, command):
+        """
+        Use the result of ``command``, and return its return code and the
+        digest of its output, or ``None`` if there is none.
+        """
+        with self.lock:
+            if command not in self.uses:
+                return None
+            self._use(command)
+            return self.results[command]
+
+    def lookup(self, command, read):
+        """
+        Use the result of ``command``, and return its return code and its
+        output read by ``read``, :meth:`decode` or :meth:`read`, or ``None``
+        if there is none or its output cannot be read any more.
+        """
+        with self.lock:
+            if command not in self.uses:
+                return None
+            self._use(command)
+            returncode, blob = self._get_blob(command)
+        try:
+            return returncode, read(blob)
+        except _BLOB_FILE_ERRORS:
+            # The blob file is gone or damaged, execute the command again.
+            self.discard(command)
+            return None
+
+    def results_snapshot(self):
+        """
+        Return a list of all commands and their results, without using them.
+        """
+        with self.lock:
+            blobs = [(command, self._get_blob(command))
+                     for command in self.uses]
+        return [(command, (returncode, self.decode(blob)))
+                for command, (returncode, blob) in blobs]
+
+    def set(self, command, result):
+        """
+        Keep the ``(returncode, output)`` tuple ``result`` of ``command``.
+        """
+        returncode, output = result
+        data = output.encode('utf-8', 'surrogateescape')
+        digest = _digest_output(data)
+        compression = None
+        if digest not in self.blobs:
+            # Compress outside of the lock, the same output is rarely set
+            # concurrently.
+            compression, data = _compress(data, self.compression)
+        with self.lock:
+            self._discard(command)
+            self._add(command, returncode, digest, compression, data)
+            self._evict(keep=command)
+
+    def pop(self, command):
+        """
+        Remove the result of ``command``, and return it, or ``None`` if
+        there is none.
+        """
+        with self.lock:
+            if command not in self.uses:
+                return None
+            returncode, blob = self._get_blob(command)
+            self._discard(command)
+        return returncode, self.decode(blob)
+
+    def discard(self, command):
+        """
+        Remove the result of ``command``, if any.
+        """
+        with self.lock:
+            self._discard(command)
+
+    def clear(self):
+        """
+        Remove all results.
+        """
+        with self.lock:
+            self.results.clear()
+            self.uses.clear()
+            self.blobs.clear()
+            self.size = 0
+
+    def merge(self, other):
+        """
+        Add the results of the :class:`_Outputs` ``other`` which are missing
+        here, without compressing them again.
+        """
+        with self.lock:
+            for command, uses in list(other.uses.items()):
+                if command in self.uses:
+                    continue
+                returncode, digest = other.results[command]
+                compression, data = other.blobs[digest][:2]
+                if isinstance(data, tuple) and other.blob_file != self.blob_file:
+                    data = other.blob_file.read(*data)
+                self._add(command, returncode, digest, compression, data)
+                self.uses[command] = uses
+            self._evict()
+
+    def write_blobs(self):
+        """
+        Move the outputs held in memory to :attr:`blob_file`, if set, or to
+        a new one replacing it, see :meth:`ProgramOutputCache.write_blobs`.
+        """
+        if self.blob_file is None:
+            return
+        with self.lock:
+            blobs = list(self.blobs.values())
+            stored = sum(blob[1][1] for blob in blobs
+                         if isinstance(blob[1], tuple))
+            garbage = self.blob_file.size - stored
+            if garbage > max(stored, 1024 * 1024):
+                old_file = self.blob_file
+                self.blob_file = BlobFile.create(
+                    os.path.dirname(old_file.path))
+                for blob in blobs:
+                    if isinstance(blob[1], tuple):
+                        blob[1] = old_file.read(*blob[1])
+                old_file.close()
+            else:
+                blobs = [blob for blob in blobs if isinstance(blob[1], bytes)]
+            positions = self.blob_file.append(blob[1] for blob in blobs)
+            for blob, position in zip(blobs, positions):
+                blob[1] = position
+
+    def decode(self, blob):
+        """
+        Return the output stored as ``blob``.
+        """
+        return self.read(blob).decode('utf-8', 'surrogateescape')
+
+    def read(self, blob):
+        """
+        Return the output stored as ``blob``, encoded in UTF-8.
+        """
+        compression, data = blob
+        if isinstance(data, tuple):
+            data = self.blob_file.read(*data)
+        return _decompress_blob(compression, data)
+
+    def evict(self):
+        """
+        Evict results until within the limits again.
+        """
+        with self.lock:
+            self._evict()
+
+    def _use(self, command):
+        self.uses[command] += 1
+        self.uses.move_to_end(command)
+
+    def _get_blob(self, command):
+        returncode, digest = self.results[command]
+        blob = self.blobs[digest]
+        return returncode, (blob[0], blob[1])
+
+    def _add(self, command, returncode, digest, compression, data):
+        blob = self.blobs.get(digest)
+        if blob is None:
+            blob = self.blobs[digest] = [compression, data, 0]
+            self.size += _blob_size(data)
+        blob[2] += 1
+        self.results[command] = (returncode, digest)
+        self.uses[command] = 1
+
+    def _discard(self, command):
+        if self.uses.pop(command, None) is None:
+            return
+        digest = self.results.pop(command)[1]
+        blob = self.blobs[digest]
+        blob[2] -= 1
+        if not blob[2]:
+            del self.blobs[digest]
+            self.size -= _blob_size(blob[1])
+
+    def _evict(self, keep=None):
+        # Evict other results than ``keep`` first, which is only evicted if
+        # it exceeds the limits all by itself.
+        while ((self.max_entries is not None
+                and len(self.uses) > self.max_entries)
+               or (self.max_bytes is not None and self.size > self.max_bytes)):
+            candidates = (command for command in self.uses
+                          if command != keep)
+            if self.policy == 'lfu':
+                victim = min(candidates, key=self.uses.__getitem__,
+                             default=keep)
+            else:
+                victim = next(candidates, keep)
+            self._discard(victim)
@@ -0,0 +1,780 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput._cache
+    ==================================
+
+    Caching, storing and recording the results of commands.
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import types
+from collections import Counter
+from collections import OrderedDict
+from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+from sphinxcontrib.programoutput._blobs import _Outputs
+from sphinxcontrib.programoutput._command import Command
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    # Windows
+    fcntl = None
+
+
+def _cache_key(command):
+    """
+    Return a stable string identifying ``command`` across processes.
+    """
+    serialized = json.dumps(list(command), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def _command_as_json(command, directory):
+    """
+    Return the fields of ``command`` as a dictionary for :mod:`json`, with
+    its working directory relative to ``directory``.
+    """
+    fields = command._asdict()
+    try:
+        working_directory = os.path.relpath(command.working_directory,
+                                            directory)
+    except ValueError: # pragma: no cover
+        # On another drive on Windows.
+        working_directory = command.working_directory
+    fields['working_directory'] = working_directory.replace(os.sep, '/')
+    return fields
+
+
+def _command_from_json(fields, directory):
+    """
+    Return the :class:`Command` of ``fields`` as returned by
+    :func:`_command_as_json` for ``directory``, ignoring other keys.
+    """
+    fields = {name: fields[name] for name in Command._fields
+              if name in fields}
+    fields['working_directory'] = os.path.join(
+        directory, *fields['working_directory'].split('/'))
+    return Command(**fields)
+
+
+class SQLiteResultStore(object):
+    """
+    A persistent store for command results in a SQLite database.
+
+    The database is created as ``programoutput.sqlite`` in ``directory``.
+    Results are keyed on the normalized fields of a :class:`Command`, so a
+    store can be shared between several Sphinx projects, and between
+    concurrent builds on the same host.
+
+    Stores only pickle their directory, so they can be attached to the
+    Sphinx environment.
+    """
+
+    filename = 'programoutput.sqlite'
+
+    #: Seconds to wait for a lock held by a concurrent build.
+    timeout = 60
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._local = threading.local()
+
+    def __reduce__(self):
+        return (type(self), (self.directory,))
+
+    def _connect(self):
+        # SQLite connections must not be used across fork(), so a forked
+        # process, like a parallel reader of Sphinx, opens its own.
+        connection, pid = getattr(self._local, 'connection', (None, None))
+        if connection is None or pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            connection = sqlite3.connect(
+                os.path.join(self.directory, self.filename),
+                timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, command TEXT, '
+                'returncode INTEGER, output TEXT)')
+            self._local.connection = (connection, os.getpid())
+        return connection
+
+    def get(self, command):
+        """
+        Return the stored ``(returncode, output)`` of ``command``, or
+        ``None`` if there is none.
+        """
+        row = self._connect().execute(
+            'SELECT returncode, output FROM results WHERE key = ?',
+            (_cache_key(command),)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set(self, command, result):
+        """
+        Store the ``(returncode, output)`` tuple ``result`` of ``command``.
+        """
+        returncode, output = result
+        self._connect().execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+            (_cache_key(command), str(command), returncode, output))
+
+
+class CassetteMissError(EnvironmentError):
+    """
+    Raised instead of executing a command whose result is missing from the
+    :class:`Cassette` replayed in ``'replay'``
+    :confval:`programoutput_mode`.
+    """
+
+    def __init__(self, command, path):
+        super().__init__(
+            "not recorded in {0}; record it with programoutput_mode = "
+            "'record' or 'auto'".format(path))
+        self.command = command
+        self.path = path
+
+    def __reduce__(self):
+        return (type(self), (self.command, self.path))
+
+
+class Cassette(object):
+    """
+    The results of commands, recorded to a JSON file at ``path`` to be kept
+    under version control, and replayed by builds which cannot or should
+    not execute the commands.
+
+    The file holds its format :attr:`version`, and a list of ``commands``
+    with the fields of each :class:`Command`, its ``returncode`` and its
+    ``output`` as a list of lines, sorted so that recording again only
+    changes the lines of changed outputs.  The ``working_directory`` of
+    commands is relative to the directory of the file, and their
+    ``fingerprint`` is left out, so that results recorded in one checkout
+    are replayed in others, even without the executables.
+
+    :attr:`digest` is the SHA-256 digest of the file, or ``None`` if it does
+    not exist.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.digest = None
+        self._entries = {}
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        content = json.loads(data.decode('utf-8'))
+        if content.get('version') != self.version:
+            raise ValueError('Unsupported version {0!r} of cassette {1}'
+                             .format(content.get('version'), path))
+        for entry in content['commands']:
+            key = dict(entry)
+            del key['returncode'], key['output']
+            self._entries[json.dumps(key, sort_keys=True)] = entry
+        self.digest = hashlib.sha256(data).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, command):
+        key = _command_as_json(command, os.path.dirname(self.path))
+        del key['fingerprint']
+        return key
+
+    def get(self, command):
+        """
+        Return the recorded ``(returncode, output)`` of ``command``, or
+        ``None`` if there is none.
+        """
+        entry = self._entries.get(json.dumps(self._key(command),
+                                             sort_keys=True))
+        if entry is None:
+            return None
+        return entry['returncode'], '\n'.join(entry['output'])
+
+    def record(self, results, keep=False):
+        """
+        Record ``results``, an iterable of ``(command, (returncode,
+        output))`` tuples, replacing all recorded results unless ``keep`` is
+        true.
+        """
+        if not keep:
+            self._entries = {}
+        for command, (returncode, output) in results:
+            key = self._key(command)
+            self._entries[json.dumps(key, sort_keys=True)] = dict(
+                key, returncode=returncode, output=output.split('\n'))
+
+    def save(self):
+        """
+        Write the recorded results to the file, if they changed.
+        """
+        content = dict(version=self.version, commands=[
+            self._entries[key] for key in sorted(self._entries)])
+        data = (json.dumps(content, ensure_ascii=False, indent=2,
+                           sort_keys=True) + '\n').encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self.digest:
+            return
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+        self.digest = digest
+
+
+class SingleFlight(object):
+    """
+    Make sure that concurrent processes execute each command only once.
+
+    Processes sharing the same ``directory`` serialize the execution of equal
+    commands with a file lock per command.  The first process to acquire the
+    lock executes the command and saves its result in ``directory``; all
+    other processes waiting for the lock load that result instead of
+    executing the command again.
+
+    This requires :func:`fcntl.flock`, and is thus not available on Windows.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, command, execute):
+        """
+        Return the result of ``command``, calling ``execute(command)`` if no
+        other process has done so yet.
+        """
+        path = os.path.join(self.directory, _cache_key(command))
+        with open(path + '.lock', 'ab') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path + '.result', 'rb') as f:
+                        return pickle.load(f)
+                except FileNotFoundError:
+                    pass
+                result = execute(command)
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path + '.result')
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class CommandStatistics(object):
+    """
+    Collect the resources used by the commands executed during a build.
+
+    :attr:`executions` maps each executed :class:`Command` to a dictionary
+    as filled by :meth:`Command.get_output`, plus the ``error`` of failed
+    commands.  The :class:`~collections.Counter` :attr:`misses` counts the
+    executions of each command, and :attr:`hits` how often its output was
+    found in a cache instead.
+    """
+
+    def __init__(self):
+        self.executions = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record_execution(self, command, statistics):
+        with self._lock:
+            self.executions[command] = statistics
+            self.misses[command] += 1
+
+    def record_hits(self, commands):
+        with self._lock:
+            self.hits.update(commands)
+
+    def merge(self, other):
+        """
+        Merge the statistics of ``other`` into this object.
+        """
+        with self._lock:
+            self.executions.update(other.executions)
+            self.hits.update(other.hits)
+            self.misses.update(other.misses)
+
+    def slowest(self, count):
+        """
+        Return a list of the ``count`` slowest ``(command, statistics)``
+        tuples, slowest first.
+        """
+        return sorted(self.executions.items(),
+                      key=lambda item: item[1].get('wall') or 0,
+                      reverse=True)[:count]
+
+    def as_json(self, document_commands):
+        """
+        Return the statistics as JSON-compatible dictionary, with totals for
+        each document in ``document_commands``, a mapping of document names
+        to the commands they execute.
+        """
+        documents_of = defaultdict(list)
+        documents = {}
+        for docname in sorted(document_commands):
+            executed = [self.executions[command]
+                        for command in document_commands[docname]
+                        if command in self.executions]
+            documents[docname] = dict(
+                commands=len(document_commands[docname]),
+                executed=len(executed),
+                **{key: sum(stats.get(key) or 0 for stats in executed)
+                   for key in ('wall', 'user', 'system')})
+            for command in document_commands[docname]:
+                documents_of[command].append(docname)
+
+        # The executed commands, slowest first, then those only found in a
+        # cache.
+        ordered = [command for command, _
+                   in self.slowest(len(self.executions))]
+        ordered.extend(sorted((command for command in self.hits
+                               if command not in self.executions), key=str))
+        commands = []
+        for command in ordered:
+            entry = dict(
+                command=(list(command.command)
+                         if isinstance(command.command, tuple)
+                         else command.command),
+                shell=command.shell,
+                working_directory=command.working_directory,
+                documents=documents_of[command],
+                hits=self.hits[command],
+                misses=self.misses[command])
+            entry.update(self.executions.get(command, {}))
+            commands.append(entry)
+
+        return dict(
+            hits=sum(self.hits.values()),
+            misses=sum(self.misses.values()),
+            executions=len(self.executions),
+            wall=sum(stats.get('wall') or 0
+                     for stats in self.executions.values()),
+            commands=commands,
+            documents=documents)
+
+
+#: The default of :meth:`ProgramOutputCache.pop`, which raises if missing.
+_MISSING = object()
+
+
+class _Delegated(object):
+    """
+    An attribute of :class:`ProgramOutputCache` held by one of its parts.
+    """
+
+    def __init__(self, part):
+        self.part = part
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return getattr(getattr(instance, self.part), self.name)
+
+    def __set__(self, instance, value):
+        setattr(getattr(instance, self.part), self.name, value)
+
+
+class _RenderedTexts(OrderedDict):
+    # The texts shown for outputs, from the least to the most recently used,
+    # and their total length.
+
+    def __init__(self):
+        super().__init__()
+        self.size = 0
+
+
+class ProgramOutputCache(MutableMapping):
+    """
+    Execute command and cache their output.
+
+    This class is a mapping.  Its keys are :class:`Command` objects represeting
+    command invocations.  Its values are tuples of the form ``(returncode,
+    output)``, where ``returncode`` is the integral return code of the command,
+    and ``output`` is the output as unicode string.
+
+    The first time, a key is retrieved from this object, the command is
+    invoked, and its result is cached.  Subsequent access to the same key
+    returns the cached value.  Results missing from the cache are looked up
+    in the :attr:`cassette` and the ``store`` first, if set.
+
+    At most :attr:`max_entries` results with :attr:`max_bytes` bytes of
+    output are kept, evicting the least recently (or with :attr:`policy`
+    ``'lfu'``, frequently) used ones, and equal outputs are kept once,
+    compressed with :attr:`compression`.  Only the results and the
+    :attr:`store` are pickled.
+    """
+
+    #: The total length of the texts kept in :attr:`rendered`.
+    max_rendered_size = 32 * 1024 * 1024
+
+    max_entries = _Delegated('_outputs')
+    max_bytes = _Delegated('_outputs')
+    policy = _Delegated('_outputs')
+    compression = _Delegated('_outputs')
+    #: The :class:`BlobFile` to move outputs to with :meth:`write_blobs`.
+    blob_file = _Delegated('_outputs')
+    #: The total number of bytes of stored output.
+    size = _Delegated('_outputs')
+
+    #: The :class:`PythonZygote`, :class:`ShellSessions` and
+    #: :class:`SpawnServer` commands are run with, and the
+    #: ``spill_threshold``, see :meth:`Command.get_output`.
+    zygote = _Delegated('_options')
+    sessions = _Delegated('_options')
+    spawn_server = _Delegated('_options')
+    spill_threshold = _Delegated('_options')
+
+    def __init__(self, store=None, max_entries=None, max_bytes=None,
+                 policy='lru', compression='zlib'):
+        self.store = store
+        self._outputs = _Outputs(max_entries, max_bytes, policy, compression)
+        self._options = types.SimpleNamespace(
+            zygote=None, sessions=None, spawn_server=None,
+            spill_threshold=None)
+        #: A :class:`Cassette` to replay, and whether to raise
+        #: :exc:`CassetteMissError` instead of executing commands.
+        self.cassette = None
+        self.offline = False
+        #: A :class:`SingleFlight` to execute commands through.
+        self.single_flight = None
+        #: A :class:`CommandStatistics` recording executions and hits.
+        self.statistics = None
+        #: Maps commands to the errors they raised when executed in a batch.
+        self.failures = {}
+        #: The futures of commands started with :meth:`speculate`.
+        self.speculative = {}
+        #: The texts kept by :meth:`get_rendered`.
+        self.rendered = _RenderedTexts()
+        # The futures of the executions of get_output_async(), and the
+        # executor of speculate() with the process which started it.
+        self._in_flight = {}
+        self._executor = None
+
+    def __reduce__(self):
+        return (type(self), (self.store,), self._outputs)
+
+    def __setstate__(self, outputs):
+        self._outputs = outputs
+
+    def __getitem__(self, command):
+        result = self._outputs.lookup(command, self._outputs.decode)
+        return self.__missing__(command) if result is None else result
+
+    def get_encoded(self, command):
+        """
+        Like ``self[command]``, but return the output encoded in UTF-8 (with
+        ``surrogateescape``), the way it is stored, without decoding it.
+        """
+        result = self._outputs.lookup(command, self._outputs.read)
+        if result is None:
+            returncode, output = self.__missing__(command)
+            result = returncode, output.encode('utf-8', 'surrogateescape')
+        return result
+
+    def get_digest(self, command):
+        """
+        Return ``(returncode, digest)`` for the cached result of ``command``,
+        with the :func:`_digest_output` of its output, without reading the
+        output, or ``None`` if it is not cached.
+        """
+        return self._outputs.get_digest(command)
+
+    def __setitem__(self, command, result):
+        self._outputs.set(command, result)
+
+    def __delitem__(self, command):
+        if self._outputs.pop(command) is None:
+            raise KeyError(command)
+
+    def __contains__(self, command):
+        return command in self._outputs
+
+    def __iter__(self):
+        return iter(self._outputs)
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def get(self, key, default=None):
+        if key in self._outputs:
+            return self[key]
+        return default
+
+    def pop(self, key, default=_MISSING):
+        result = self._outputs.pop(key)
+        if result is not None:
+            return result
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def discard(self, command):
+        """
+        Remove the result of ``command``, if cached, without retrieving it.
+        """
+        self._outputs.discard(command)
+
+    def clear(self):
+        self._outputs.clear()
+
+    def items(self):
+        """
+        Return a view of the commands and their results, without using them.
+        """
+        return dict(self._outputs.results_snapshot()).items()
+
+    def values(self):
+        return dict(self._outputs.results_snapshot()).values()
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, dict(self.items()))
+
+    def merge(self, other):
+        """
+        Add the results of the :class:`ProgramOutputCache` ``other`` which
+        are missing from this cache, without compressing them again.
+        """
+        self._outputs.merge(other._outputs) # pylint:disable=protected-access
+
+    def write_blobs(self):
+        """
+        Move the outputs held in memory to :attr:`blob_file`, if set, so that
+        only their position is kept in memory and pickled.
+
+        Once the file holds more outputs no longer cached than cached ones,
+        the cached outputs are written to a new :class:`BlobFile` instead,
+        which replaces :attr:`blob_file`.  The old file is left for
+        :func:`init_cache` to remove, as long as a pickled environment may
+        still refer to it.
+        """
+        self._outputs.write_blobs()
+
+    def evict(self):
+        """
+        Evict results until the cache is within its limits again.
+        """
+        self._outputs.evict()
+
+    def get_rendered(self, key, render):
+        """
+        Return the text returned by ``render()`` for ``key``, a tuple of the
+        digest of an output and the options it is shown with, calling
+        ``render`` only if it is not kept in :attr:`rendered` yet.
+
+        The most recently used texts are kept, as long as they are at most
+        :attr:`max_rendered_size` characters long in total.
+        """
+        rendered = self.rendered
+        with self._outputs.lock:
+            text = rendered.get(key)
+            if text is not None:
+                rendered.move_to_end(key)
+                return text
+        text = render()
+        with self._outputs.lock:
+            if key not in rendered:
+                rendered[key] = text
+                rendered.size += len(text)
+            while rendered.size > self.max_rendered_size:
+                _, evicted = rendered.popitem(last=False)
+                rendered.size -= len(evicted)
+        return text
+
+    def __missing__(self, command):
+        """
+        Called, if a command was not found in the cache.
+
+        ``command`` is an instance of :class:`Command`.
+        """
+        return self.get_output(command)
+
+    def speculate(self, command, timeout=None, max_workers=1):
+        """
+        Start executing ``command`` with ``timeout`` in the background,
+        unless it is cached or already started, so that :meth:`get_output`
+        returns the result of this execution.
+
+        At most ``max_workers`` commands are executed in the background at a
+        time, or as many as :class:`~concurrent.futures.ThreadPoolExecutor`
+        does by default if that is ``None`` or ``0``.
+        """
+        with self._outputs.lock:
+            if command in self._outputs or command in self.speculative:
+                return
+            if self._executor is None or self._executor[1] != os.getpid():
+                # Threads are not inherited by forked reader processes.
+                self._executor = (ThreadPoolExecutor(
+                    max_workers=max_workers or None,
+                    thread_name_prefix='programoutput-speculate'),
+                                  os.getpid())
+            self.speculative[command] = self._executor[0].submit(
+                self._get_output, command, timeout)
+
+    def stop_speculating(self):
+        """
+        Cancel the speculative executions which have not started yet, and
+        wait for the others to finish.
+        """
+        executor, self._executor = self._executor, None
+        if executor is not None and executor[1] == os.getpid():
+            executor[0].shutdown(wait=True, cancel_futures=True)
+        self.speculative.clear()
+
+    def get_output(self, command, timeout=None):
+        """
+        Return the cached result of ``command``, executing it with
+        ``timeout`` if it is not cached yet, or waiting for its
+        speculative execution if started by :meth:`speculate`.
+        """
+        future = self.speculative.pop(command, None)
+        if future is not None:
+            return future.result()
+        return self._get_output(command, timeout)
+
+    def _get_output(self, command, timeout=None):
+        if command in self:
+            return self[command]
+        result = self._get_stored(command)
+        if result is None:
+            execute = functools.partial(self._execute, timeout=timeout)
+            if self.single_flight is not None:
+                result = self.single_flight(command, execute)
+            else:
+                result = execute(command)
+        self[command] = result
+        return result
+
+    def _get_stored(self, command):
+        result = None
+        if self.cassette is not None:
+            result = self.cassette.get(command)
+        if result is None and self.store is not None:
+            result = self.store.get(command)
+        if result is not None and self.statistics is not None:
+            self.statistics.record_hits([command])
+        return result
+
+    def _check_offline(self, command):
+        if self.offline:
+            path = self.cassette.path if self.cassette is not None else None
+            raise CassetteMissError(command, path)
+
+    def _execute(self, command, timeout=None):
+        self._check_offline(command)
+        statistics = {}
+        try:
+            result = command.get_output(timeout=timeout,
+                                        statistics=statistics,
+                                        **vars(self._options))
+        except EnvironmentError as error:
+            self._record_error(command, error)
+            raise
+        if self.statistics is not None:
+            self.statistics.record_execution(command, statistics)
+        if self.store is not None:
+            self.store.set(command, result)
+        return result
+
+    def _record_error(self, command, error):
+        if self.statistics is not None:
+            self.statistics.record_execution(command, dict(
+                wall=getattr(error, 'elapsed', None), user=None, system=None,
+                max_rss=None, error=str(error)))
+
+    async def get_output_async(self, command, timeout=None):
+        """
+        Like :meth:`get_output`, but execute ``command`` with
+        :meth:`Command.get_output_async`.
+        """
+        future = self.speculative.pop(command, None)
+        if future is not None:
+            return await asyncio.wrap_future(future)
+        if command in self:
+            return self[command]
+        future = self._in_flight.get(command)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._execute_async(command, timeout))
+            self._in_flight[command] = future
+            future.add_done_callback(
+                lambda _: self._in_flight.pop(command, None))
+        return await asyncio.shield(future)
+
+    async def _execute_async(self, command, timeout):
+        result = self._get_stored(command)
+        if result is None:
+            if self.single_flight is not None:
+                # The file lock blocks, so wait for it in a thread.
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, self.single_flight, command,
+                    functools.partial(self._execute, timeout=timeout))
+            else:
+                self._check_offline(command)
+                start = time.monotonic()
+                try:
+                    result = await command.get_output_async(
+                        timeout=timeout, **vars(self._options))
+                except EnvironmentError as error:
+                    self._record_error(command, error)
+                    raise
+                if self.statistics is not None:
+                    self.statistics.record_execution(command, dict(
+                        wall=time.monotonic() - start, user=None,
+                        system=None, max_rss=None))
+                if self.store is not None:
+                    self.store.set(command, result)
+        self[command] = result
+        return result
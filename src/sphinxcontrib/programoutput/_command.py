@@ -0,0 +1,674 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput._command
+    ====================================
+
+    Running commands, directly, in a shell, or in a shell session.
+"""
+
+import asyncio
+import contextlib
+import functools
+import os
+import re
+import shlex
+import shutil
+import signal
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from collections import namedtuple
+from subprocess import DEVNULL
+from subprocess import PIPE
+from subprocess import STDOUT
+from subprocess import Popen
+
+from sphinxcontrib.programoutput._output import _OutputWindow
+from sphinxcontrib.programoutput._output import _output_text
+from sphinxcontrib.programoutput._output import _spool
+from sphinxcontrib.programoutput._output import _spooled_text
+from sphinxcontrib.programoutput._zygote import _ServerProcess
+from sphinxcontrib.programoutput._zygote import _python_invocation
+
+
+def _kill(process):
+    """
+    Kill ``process``, and its process group if it has its own.
+    """
+    try:
+        if os.name == 'posix' and os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError: # pragma: no cover
+        # Already gone.
+        pass
+
+
+def _wait(process):
+    """
+    Wait for ``process`` to terminate, and return a dictionary with the
+    ``user`` and ``system`` time it took in seconds, and its peak resident
+    set size ``max_rss`` in bytes, or ``None`` for each if unknown.
+    """
+    if isinstance(process, _ServerProcess):
+        return process.wait()
+    if not hasattr(os, 'wait4'): # pragma: no cover
+        process.wait()
+        return dict(user=None, system=None, max_rss=None)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # Linux reports kilobytes, macOS bytes.
+    max_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return dict(user=rusage.ru_utime, system=rusage.ru_stime, max_rss=max_rss)
+
+
+@contextlib.contextmanager
+def _killed_after(process, timeout):
+    """
+    Kill ``process``, and its process group if it has its own, if it is
+    still running ``timeout`` seconds after entering the context, unless
+    ``timeout`` is ``None``.
+
+    Yield a :class:`threading.Event` which is set once it was killed.
+    """
+    timed_out = threading.Event()
+    if timeout is None:
+        yield timed_out
+        return
+
+    def expire():
+        timed_out.set()
+        _kill(process)
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        yield timed_out
+    finally:
+        timer.cancel()
+
+
+class CommandTimeoutError(EnvironmentError):
+    """
+    Raised if a command did not finish within its timeout.
+
+    ``timeout`` is the timeout in seconds, and ``elapsed`` the number of
+    seconds actually spent until the command was killed.
+    """
+
+    def __init__(self, command, timeout, elapsed):
+        super().__init__(
+            'timed out after {0:g} seconds (killed after {1:.2f} seconds)'
+            .format(timeout, elapsed))
+        self.command = command
+        self.timeout = timeout
+        self.elapsed = elapsed
+
+    def __reduce__(self):
+        return (type(self), (self.command, self.timeout, self.elapsed))
+
+
+class _ShellSession(object):
+    """
+    A shell running commands one after the other, in its own process group.
+
+    :attr:`history` lists the commands it ran so far.
+    """
+
+    def __init__(self, working_directory):
+        # pylint:disable=consider-using-with
+        self.process = Popen(['/bin/sh'], stdin=PIPE, stdout=PIPE,
+                             stderr=STDOUT, cwd=working_directory,
+                             start_new_session=True)
+        self.history = []
+        self.owner = os.getpid()
+        self.timed_out = False
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, command, hide_standard_error, feed, timeout=None):
+        """
+        Run the shell command ``command``, and call ``feed`` with each line
+        of its output.
+
+        Return the exit status of ``command``, or of the shell if the
+        command made it exit.  If ``command`` does not finish within
+        ``timeout`` seconds, kill the shell and set :attr:`timed_out`.
+        """
+        def expire():
+            self.timed_out = True
+            _kill(self.process)
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, expire)
+            timer.start()
+        try:
+            return self._run(command, hide_standard_error, feed)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def _run(self, command, hide_standard_error, feed):
+        # Frame the output with a sentinel, which starts a new line even if
+        # the output does not end with one.  The trailing new line added
+        # this way is stripped with the output.  The command is a single
+        # quoted word of ``eval``, so that a syntax error in it cannot take
+        # the sentinel along, but fails the command (or exits the shell).
+        sentinel = ('programoutput-' + uuid.uuid4().hex).encode('ascii')
+        script = 'eval %s %s </dev/null\nprintf "\\n%s %%d\\n" "$?"\n' % (
+            shlex.quote(command),
+            '2>/dev/null' if hide_standard_error else '2>&1',
+            sentinel.decode('ascii'))
+        try:
+            self.process.stdin.write(os.fsencode(script))
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        for line in self.process.stdout:
+            if line.startswith(sentinel + b' '):
+                self.history.append(command)
+                return int(line[len(sentinel) + 1:])
+            feed(line)
+        self.close()
+        return self.process.returncode
+
+    def close(self):
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+        self.process.wait()
+
+
+class ShellSessions(object):
+    """
+    Run the commands of shell sessions in long-lived shells.
+
+    Commands with the same session name and working directory share a
+    shell, so that changes to its state, e.g. of the working directory or
+    of environment variables, carry over to the following commands.  If the
+    shell of a session has not run exactly the commands preceding a command
+    in its session, e.g. because their output was cached, a new shell is
+    started, and these commands are run again first, with their output
+    discarded.  A command that makes the shell exit, or is killed after its
+    timeout, ends its shell; the following commands run in a new one.
+
+    This requires a POSIX shell, see :attr:`available`.
+    """
+
+    #: Whether shell sessions are supported on this platform.
+    available = os.name == 'posix'
+
+    def __init__(self):
+        self._sessions = {}
+        # The histories of the shells which ended.
+        self._ended = {}
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def run(self, command, feed, timeout=None):
+        """
+        Run ``command``, a :class:`Command` with a ``session``, in the shell
+        of its session, and call ``feed`` with each line of its output.
+
+        Return its exit status, or raise :exc:`CommandTimeoutError` if it
+        does not finish within ``timeout`` seconds.
+        """
+        name, previous = command.session
+        key = (name, command.working_directory)
+        with self._lock:
+            lock = self._locks[key]
+        with lock:
+            session = self._sessions.pop(key, None)
+            if session is not None and session.owner != os.getpid():
+                # Inherited by a forked process, let the parent handle it.
+                session = None
+            previous = list(previous)
+            if (session is None or not session.alive
+                    or session.history != previous):
+                if session is not None:
+                    session.close()
+                if self._ended.get(key) == previous:
+                    session = _ShellSession(command.working_directory)
+                    session.history = previous
+                else:
+                    session = self._replay(command.working_directory,
+                                           previous, timeout)
+
+            start = time.monotonic()
+            returncode = session.run(command.command,
+                                     command.hide_standard_error, feed,
+                                     timeout)
+            if session.alive:
+                self._sessions[key] = session
+            else:
+                session.close()
+                self._ended[key] = previous + [command.command]
+            if session.timed_out:
+                raise CommandTimeoutError(command, timeout,
+                                          time.monotonic() - start)
+            return returncode
+
+    @staticmethod
+    def _replay(working_directory, commands, timeout):
+        session = _ShellSession(working_directory)
+        for command in commands:
+            session.run(command, True, lambda line: None, timeout)
+            if not session.alive:
+                session.close()
+                session = _ShellSession(working_directory)
+        session.history = list(commands)
+        return session
+
+    def close(self):
+        """
+        Stop all shells started by this process.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            if session.owner == os.getpid():
+                session.close()
+
+
+#: Shell commands made of blanks, words of characters the shell takes
+#: literally, and quoted strings which it does not expand, see
+#: :func:`_shell_words`.
+_SHELL_SAFE = re.compile(
+    r"""(?:[\w@%+=:,./ \t-]|'[^']*'|"[^"$`\\!]*")*""")
+
+
+#: Words which the shell runs as builtins or keywords, rather than the
+#: executable of the same name, if any.  ``echo`` and ``printf`` are among
+#: them because their options differ between shells.
+_SHELL_BUILTINS = frozenset("""
+    . : alias bg break builtin case cd command continue declare dirs do done
+    echo elif else enable esac eval exec exit export false fc fg fi for
+    function getopts hash history if in jobs kill let local logout popd
+    printf pushd pwd read readonly return select set shift shopt source test
+    then time times trap true type typeset ulimit umask unalias unset until
+    wait while
+    """.split())
+
+
+#: The leading bytes of the executables which the system runs itself:
+#: scripts with a ``#!`` line, ELF, Mach-O and PE executables.
+_EXECUTABLE_MAGIC = (b'#!', b'\x7fELF', b'\xfe\xed\xfa', b'\xce\xfa\xed\xfe',
+                     b'\xcf\xfa\xed\xfe', b'\xca\xfe\xba\xbe', b'MZ')
+
+
+@functools.lru_cache(maxsize=None)
+def _has_executable_magic(path, size, mtime): # pylint:disable=unused-argument
+    # The size and modification time only invalidate the cached result.
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4).startswith(_EXECUTABLE_MAGIC)
+    except OSError:
+        return False
+
+
+def _executes_directly(name):
+    """
+    Return whether the executable ``name`` is found on the ``PATH``, and
+    can be executed without the shell.
+    """
+    path = shutil.which(name)
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return False
+    return _has_executable_magic(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _shell_words(command):
+    """
+    Return the list of words of the shell command string ``command``, if
+    the shell would just execute them, or ``None`` if it would do more, e.g.
+    expand variables or patterns, redirect, pipe or run builtins.
+
+    Executables given by a path, or which are not found on the ``PATH`` or
+    cannot be executed directly, like scripts without a ``#!`` line, are
+    left to the shell, which runs such scripts itself, and reports missing
+    executables with its exit status 127.
+    """
+    if not _SHELL_SAFE.fullmatch(command):
+        return None
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    if (not words or '=' in words[0] or '/' in words[0]
+            or words[0] in _SHELL_BUILTINS
+            or not _executes_directly(words[0])):
+        return None
+    return words
+
+
+_Command = namedtuple(
+    '_Command',
+    'command shell hide_standard_error working_directory depends window '
+    'python session fingerprint')
+
+
+class Command(_Command):
+    """
+    A command to be executed.
+
+    ``depends`` is an optional digest of the files the output of the command
+    depends on.  It is not used to execute the command, but makes it part of
+    the cache key.
+
+    ``window`` is an optional tuple ``(start, stop, stop_early)``.  If given,
+    the output is read incrementally, and only the lines which remain
+    visible after replacing ``lines[start:stop]`` with an ellipsis are kept.
+    If ``stop_early`` is true, the command is killed as soon as no further
+    output can be visible; its return code is then ``None``.
+
+    If ``python`` is true, the command is a Python invocation, which is run
+    by :data:`sys.executable` whatever interpreter it names, and in a
+    :class:`PythonZygote` if one is given to :meth:`get_output`.
+
+    ``session`` is an optional tuple ``(name, previous)`` of the name of the
+    shell session to run the shell command in, and the commands run in it
+    before, see :class:`ShellSessions`.
+
+    A ``shell`` command which the shell would just execute, without
+    expanding or redirecting anything, is executed without the shell; it is
+    then equal to the same command without ``shell``.
+
+    ``fingerprint`` is an optional digest of the executables the command
+    runs and of the environment, see :func:`_fingerprint`.  Like
+    ``depends``, it only makes them part of the cache key.
+    """
+
+    def __new__(cls, command, shell=False, hide_standard_error=False,
+                working_directory='/', *, depends=None, window=None,
+                python=False, session=None, fingerprint=None):
+        # `chdir()` resolves symlinks, so we need to resolve them too for
+        # caching to make sure that different symlinks to the same directory
+        # don't result in different cache keys.  Also normalize paths to make
+        # sure that identical paths are also equal as strings.
+        working_directory = os.path.normpath(os.path.realpath(
+            working_directory))
+        # Likewise, normalize the command now for better caching, and so
+        # that we can present *exactly* what we run to the user.
+        # Run simple shell commands without the shell, under the same key as
+        # when written without the ``shell`` option.  The commands of
+        # sessions must run in the shell of the session.
+        if shell and session is None and isinstance(command, str):
+            words = _shell_words(command)
+            if words is not None:
+                command, shell = words, False
+        command = cls.__normalize_command(command, shell)
+        if window is not None:
+            window = tuple(window)
+        if session is not None:
+            session = (session[0], tuple(session[1]))
+        return _Command.__new__(cls, command, shell, hide_standard_error,
+                                working_directory, depends, window, python,
+                                session, fingerprint)
+
+    def __getnewargs_ex__(self):
+        # The fields after the working directory are keyword-only.
+        return tuple(self[:4]), dict(zip(self._fields[4:], self[4:]))
+
+    @staticmethod
+    def __normalize_command(command, shell): # pylint:disable=unused-private-member
+        # Returns either a native string, or a tuple.
+        if not shell and isinstance(command, str):
+            command = shlex.split(command)
+
+        if isinstance(command, list):
+            command = tuple(command)
+
+        assert isinstance(command, (str, tuple)), command
+
+        return command
+
+    @classmethod
+    def from_program_output_node(cls, node):
+        """
+        Create a command from a :class:`program_output` node.
+        """
+        extraargs = node.get('extraargs', '')
+        command = (node['command'] + ' ' + extraargs).strip()
+        return cls(command, node['use_shell'],
+                   node['hide_standard_error'], node['working_directory'],
+                   depends=node.get('depends'), window=node.get('window'),
+                   python=node.get('python', False),
+                   session=node.get('session'),
+                   fingerprint=node.get('fingerprint'))
+
+    def execute(self, **kwargs):
+        """
+        Execute this command.
+
+        Return the :class:`~subprocess.Popen` object representing the running
+        command.  Keyword arguments are passed to :class:`~subprocess.Popen`.
+        """
+        command = self._arguments()
+
+        kwargs.setdefault('stderr',
+                          PIPE if self.hide_standard_error else STDOUT)
+        # Popen is a context manager only in Python 3, and we'd have to restructure
+        # the code to work with it anyway.
+        # pylint:disable=consider-using-with
+        return Popen(command, shell=self.shell, stdout=PIPE,
+                     cwd=self.working_directory, **kwargs)
+
+    def get_output(self, timeout=None, statistics=None, *, zygote=None,
+                   sessions=None, spawn_server=None, spill_threshold=None):
+        """
+        Get the output of this command.
+
+        Return a tuple ``(returncode, output)``.  ``returncode`` is the
+        integral return code of the process, ``output`` is the output as
+        unicode string, with final trailing spaces and new lines stripped.
+
+        If the command does not finish within ``timeout`` seconds, kill it
+        along with all processes it started, and raise
+        :exc:`CommandTimeoutError`.
+
+        If ``statistics`` is a dictionary, it is updated with the ``wall``,
+        ``user`` and ``system`` time the command took in seconds, and its
+        peak resident set size ``max_rss`` in bytes.  The latter three are
+        ``None`` where :func:`os.wait4` is not available.
+
+        Python commands are spawned by the :class:`PythonZygote` ``zygote``,
+        if given and if it supports their invocation.  Other commands are
+        started by the :class:`SpawnServer` ``spawn_server``, if given.
+        Commands with a ``session`` are run by :class:`ShellSessions`
+        ``sessions``, or in a new shell if not given.
+
+        If ``spill_threshold`` is given, an output of more bytes is copied to
+        a temporary file instead of memory, and decoded, stripped and
+        windowed through a memory map of that file, so that only the text
+        returned is held in memory.  A ``window`` is then applied once the
+        command finished, unless it stops the command early.
+        """
+        if self.session is not None and ShellSessions.available:
+            return self._get_session_output(timeout, statistics, sessions)
+        stop_early = self.window is not None and self.window[2]
+        if stop_early:
+            spill_threshold = None
+        process = self._spawn(zygote, spawn_server,
+                              timeout is not None or stop_early)
+        start = time.monotonic()
+        with _killed_after(process, timeout) as timed_out:
+            with process.stdout:
+                output = self._read_output(process, spill_threshold)
+            try:
+                usage = _wait(process)
+                elapsed = time.monotonic() - start
+                if timed_out.is_set():
+                    raise CommandTimeoutError(self, timeout, elapsed)
+            except BaseException:
+                if not isinstance(output, (bytes, tuple)):
+                    output.close()
+                raise
+        if statistics is not None:
+            statistics.update(usage, wall=elapsed)
+        return self._result(process.returncode, output)
+
+    async def get_output_async(self, timeout=None, zygote=None,
+                               sessions=None, spawn_server=None,
+                               spill_threshold=None):
+        """
+        Like :meth:`get_output`, but execute the command with :mod:`asyncio`.
+
+        Commands with a ``window`` or a ``session``, those spawned by
+        ``zygote`` or ``spawn_server``, and all commands if given a
+        ``spill_threshold``, are run by :meth:`get_output` in the default
+        executor of the running loop.
+        """
+        loop = asyncio.get_running_loop()
+        if (self.window is not None or self.session is not None
+                or self._use_zygote(zygote) or spawn_server is not None
+                or spill_threshold is not None):
+            return await loop.run_in_executor(None, functools.partial(
+                self.get_output, timeout, zygote=zygote, sessions=sessions,
+                spawn_server=spawn_server, spill_threshold=spill_threshold))
+        kwargs = dict(
+            stdout=asyncio.subprocess.PIPE,
+            stderr=(asyncio.subprocess.PIPE if self.hide_standard_error
+                    else asyncio.subprocess.STDOUT),
+            cwd=self.working_directory,
+            start_new_session=timeout is not None and os.name == 'posix')
+        if self.shell:
+            process = await asyncio.create_subprocess_shell(
+                self.command, **kwargs)
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *self._arguments(), **kwargs)
+        start = time.monotonic()
+        try:
+            stdout = (await asyncio.wait_for(process.communicate(),
+                                             timeout))[0]
+        except asyncio.TimeoutError:
+            _kill(process)
+            await process.communicate()
+            raise CommandTimeoutError( # pylint:disable=raise-missing-from
+                self, timeout, time.monotonic() - start)
+        return process.returncode, _output_text(
+            stdout, None, sys.getfilesystemencoding())
+
+    def _get_session_output(self, timeout, statistics, sessions):
+        encoding = sys.getfilesystemencoding()
+        if self.window is not None:
+            window = _OutputWindow(*self.window[:2])
+
+            def feed(line):
+                for part in line.decode(encoding, 'replace').splitlines():
+                    window.feed(part)
+        else:
+            chunks = []
+            feed = chunks.append
+
+        start = time.monotonic()
+        if sessions is None:
+            sessions = ShellSessions()
+            try:
+                returncode = sessions.run(self, feed, timeout)
+            finally:
+                sessions.close()
+        else:
+            returncode = sessions.run(self, feed, timeout)
+        if statistics is not None:
+            statistics.update(wall=time.monotonic() - start, user=None,
+                              system=None, max_rss=None)
+
+        if self.window is not None:
+            return returncode, '\n'.join(window.lines())
+        output = b''.join(chunks).decode(encoding, 'replace').rstrip()
+        return returncode, output
+
+    def _arguments(self):
+        if self.python:
+            return (sys.executable,) + self.command[1:]
+        return self.command
+
+    def _use_zygote(self, zygote):
+        return (self.python and zygote is not None
+                and _python_invocation(self.command) is not None)
+
+    def _spawn(self, zygote, spawn_server, own_group):
+        # Start this command, in a process group of its own if ``own_group``,
+        # so that we can kill any processes it started, too.
+        if self._use_zygote(zygote):
+            return zygote.spawn(self)
+        if spawn_server is not None:
+            return spawn_server.spawn(self)
+        return self.execute(
+            start_new_session=os.name == 'posix' and own_group,
+            stderr=DEVNULL if self.hide_standard_error else STDOUT)
+
+    def _read_output(self, process, spill_threshold):
+        # Return the output of ``process`` as returned by _spool() if given a
+        # ``spill_threshold``, or else its visible lines and whether it was
+        # killed early if it has a window, or else its bytes.
+        if spill_threshold is not None:
+            return _spool(process.stdout, spill_threshold)
+        if self.window is not None:
+            return self._read_window(process)
+        return process.stdout.read()
+
+    def _result(self, returncode, output):
+        # Return the result of this command from its return code and the
+        # output returned by _read_output().
+        if isinstance(output, tuple):
+            lines, stopped = output
+            return None if stopped else returncode, '\n'.join(lines)
+        return returncode, _spooled_text(
+            output, self.window and self.window[:2],
+            sys.getfilesystemencoding())
+
+    def _read_window(self, process):
+        # Return the visible lines of the output of ``process``, and whether
+        # it was killed early.
+        start, stop, stop_early = self.window
+        window = _OutputWindow(start, stop)
+        encoding = sys.getfilesystemencoding()
+        for line in process.stdout:
+            for part in line.decode(encoding, 'replace').splitlines():
+                window.feed(part)
+            if stop_early and window.done:
+                _kill(process)
+                return window.lines(), True
+        return window.lines(), False
+
+    def __str__(self):
+        command = self.command
+        command = list(command) if isinstance(command, tuple) else command
+        return repr(command)
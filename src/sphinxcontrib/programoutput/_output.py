@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput._output
+    ===================================
+
+    Windowing, decoding and filtering the output of commands.
+"""
+
+import codecs
+import functools
+import mmap
+import re
+import shutil
+import tempfile
+from collections import deque
+
+
+_ANSI_FORMAT_SEQUENCE = re.compile(r'\x1b\[[^m]+m')
+
+
+def _strip_ansi_formatting(text):
+    return _ANSI_FORMAT_SEQUENCE.sub('', text)
+
+
+class _OutputWindow(object):
+    """
+    Collect the lines of an output which remain visible after replacing
+    ``lines[start:stop]`` with a single ellipsis.
+
+    Lines are fed one at a time with :meth:`feed`, and only those lines which
+    might be visible are kept: a head of ``start`` lines, and a ring buffer
+    for a negative ``stop``.  Like :meth:`str.rstrip` on the whole output,
+    trailing whitespace is ignored.
+    """
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+        self.count = 0
+        self.head = []
+        if start >= 0 and stop is not None and stop < 0:
+            self.tail = deque(maxlen=-stop)
+        else:
+            self.tail = []
+        # Lines which are not emitted yet, because they might be trailing
+        # whitespace: the last non-blank line, and the blank lines after it.
+        self._held = []
+
+    @property
+    def done(self):
+        """
+        Whether further lines cannot be visible.
+        """
+        return self.start >= 0 and self.stop is None and self.count >= self.start
+
+    def feed(self, line):
+        if not line.strip():
+            self._held.append(line)
+            return
+        for held in self._held:
+            self._emit(held)
+        self._held = [line]
+
+    def _emit(self, line):
+        index = self.count
+        self.count += 1
+        if self.start < 0:
+            self.head.append(line)
+        elif index < self.start:
+            self.head.append(line)
+        elif self.stop is None:
+            pass
+        elif self.stop >= 0:
+            if index >= self.stop:
+                self.tail.append(line)
+        else:
+            self.tail.append((index, line))
+
+    def lines(self):
+        """
+        Return the visible lines, with the ellipsis.
+        """
+        if self._held and self._held[0].strip():
+            self._emit(self._held[0].rstrip())
+        self._held = []
+        if self.start < 0:
+            lines = list(self.head)
+            lines[self.start:self.stop] = ['...']
+            return lines
+        count = self.count
+        tail = self.tail
+        if self.stop is not None and self.stop < 0:
+            first = max(min(self.start, count), count + self.stop)
+            tail = [line for index, line in tail if index >= first]
+        return self.head + ['...'] + list(tail)
+
+
+#: The bytes :meth:`str.rstrip` strips from ASCII-compatible text.
+_TRAILING_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
+
+#: Line breaks of :meth:`str.splitlines` other than ``\n``, in UTF-8.
+_LINE_BREAKS = (b'\r', b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e',
+                b'\xc2\x85', b'\xe2\x80\xa8', b'\xe2\x80\xa9')
+
+
+def _spool(stream, threshold):
+    """
+    Read the binary ``stream`` to its end.  Return the bytes read, if at
+    most ``threshold``, or else a temporary file holding them.
+    """
+    data = stream.read(threshold + 1)
+    if len(data) <= threshold:
+        return data
+    spool = tempfile.TemporaryFile(prefix='programoutput-')
+    try:
+        spool.write(data)
+        del data
+        shutil.copyfileobj(stream, spool, 1 << 20)
+        spool.flush()
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+def _spooled_text(spool, window, encoding):
+    """
+    Return :func:`_output_text` of the output returned by :func:`_spool`,
+    reading a temporary file through a memory map, and close it.
+    """
+    if isinstance(spool, bytes):
+        return _output_text(spool, window, encoding)
+    with spool, mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _output_text(data, window, encoding)
+
+
+def _decode(view, start, end, encoding, errors='replace'):
+    with view[start:end] as part:
+        return str(part, encoding, errors)
+
+
+def _text_end(data):
+    # The length of the UTF-8 output ``data`` without trailing ASCII
+    # whitespace.
+    end = len(data)
+    while end and data[end - 1] in _TRAILING_WHITESPACE:
+        end -= 1
+    return end
+
+
+def _output_text(data, window, encoding, errors='replace'):
+    """
+    Return the output ``data``, :class:`bytes` or a :class:`mmap.mmap`,
+    decoded with ``encoding`` and without trailing whitespace, or only its
+    lines visible in ``window``, a tuple ``(start, stop)`` like the
+    arguments of :class:`_OutputWindow`, joined.
+
+    Trailing whitespace is stripped, and UTF-8 output is windowed, on the
+    undecoded bytes, so that only the text returned is decoded.
+    """
+    utf8 = codecs.lookup(encoding).name == 'utf-8'
+    end = _text_end(data) if utf8 else len(data)
+    with memoryview(data) as view:
+        if window is None:
+            return _decode(view, 0, end, encoding, errors).rstrip()
+        spans = _window_spans(data, end, *window) if utf8 else None
+        if spans is not None:
+            head, tail = spans
+            lines = ['...']
+            if head is not None:
+                lines.insert(0, _decode(view, 0, head, encoding, errors))
+            if tail is not None:
+                lines.append(_decode(view, tail, end, encoding, errors))
+            return '\n'.join(lines)
+    return _windowed_text(data, window, encoding, errors)
+
+
+def _windowed_text(data, window, encoding, errors):
+    # Return the lines of ``data`` visible in ``window``, joined, decoding
+    # all of it a line at a time.
+    output_window = _OutputWindow(*window)
+    start = 0
+    while start < len(data):
+        stop = data.find(b'\n', start) + 1 or len(data)
+        for part in data[start:stop].decode(encoding, errors).splitlines():
+            output_window.feed(part)
+        start = stop
+    return '\n'.join(output_window.lines())
+
+
+def _window_spans(data, end, start, stop):
+    # Return the ends ``(head, tail)`` of the parts of the UTF-8 output
+    # ``data[:end]`` without trailing whitespace which remain visible after
+    # replacing ``lines[start:stop]`` with an ellipsis, ``data[:head]`` and
+    # ``data[tail:end]``, either ``None`` if empty, finding lines by their
+    # ``\n`` only.  Return None if other line breaks, or trailing whitespace
+    # which is not ASCII, require decoding all of it.
+    if any(data.find(line_break, 0, end) != -1
+           for line_break in _LINE_BREAKS):
+        return None
+    # Characters are at most four bytes long in UTF-8.
+    last = data[max(0, end - 4):end].decode('utf-8', 'replace')
+    if last[-1:].isspace():
+        return None
+    count = 0
+    if end:
+        count = 1 + sum(data[offset:min(offset + (1 << 20), end)].count(b'\n')
+                        for offset in range(0, end, 1 << 20))
+
+    def offset(line):
+        # The offset of the start of ``line``.
+        if line <= count // 2:
+            position = -1
+            for _ in range(line):
+                position = data.find(b'\n', position + 1, end)
+        else:
+            position = end
+            for _ in range(count - line):
+                position = data.rfind(b'\n', 0, position)
+        return position + 1
+
+    start, stop, _ = slice(start, stop).indices(count)
+    stop = max(start, stop)
+    head = offset(start) - 1 if start else None
+    tail = offset(stop) if stop < count else None
+    return head, tail
+
+
+@functools.lru_cache(maxsize=None)
+def _output_pipeline(window, strip_ansi):
+    """
+    Return a function which turns the output of a command, encoded like
+    :meth:`ProgramOutputCache.get_encoded` returns it, into the text shown
+    for it: only its lines visible in ``window`` (see :func:`_output_text`),
+    if not ``None``, and without ANSI formatting if ``strip_ansi``.
+
+    The output is windowed before it is decoded, so that only the text shown
+    is decoded, once.  The function is built once for each configuration.
+    """
+    def decode(data):
+        return data.decode('utf-8', 'surrogateescape')
+
+    def window_text(data):
+        end = _text_end(data)
+        spans = _window_spans(data, end, *window)
+        if spans is None:
+            return _windowed_text(data, window, 'utf-8', 'surrogateescape')
+        head, tail = spans
+        parts = [b'...']
+        if head is not None:
+            parts.insert(0, data[:head])
+        if tail is not None:
+            parts.append(data[tail:end])
+        return decode(b'\n'.join(parts))
+
+    # Stripping ANSI formatting is faster on text than on bytes, and does
+    # not copy text without any.
+    stages = [decode if window is None else window_text]
+    if strip_ansi:
+        stages.append(_strip_ansi_formatting)
+
+    def pipeline(data):
+        for stage in stages:
+            data = stage(data)
+        return data
+    return pipeline
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput._spawn
+    ==================================
+
+    A small server which starts shell-less commands.
+"""
+
+import os
+import socket
+
+from sphinxcontrib.programoutput._zygote import _Server
+
+
+#: The source of :class:`SpawnServer`, run with ``python -c``.
+#:
+#: The server accepts connections on the Unix socket given as first argument,
+#: and starts the command of each request with :func:`os.posix_spawn` in a
+#: process group of its own.  It reaps the commands when notified of their
+#: termination through :func:`signal.set_wakeup_fd`, and reports their return
+#: code and resource usage on the connection of the request.  The server
+#: exits when its standard input is closed.
+_SPAWN_SERVER_SOURCE = r'''
+import errno, json, os, select, shutil, signal, socket, sys
+
+def launch(request, output, null):
+    args = request['args']
+    environment = request['environment']
+    # posix_spawn() cannot change the working directory of the command, so
+    # spawn it from there, and look the executable up like execvpe() would.
+    os.chdir(request['working_directory'])
+    try:
+        executable = args[0]
+        if os.sep not in executable:
+            executable = shutil.which(
+                executable, path=environment.get('PATH', os.defpath))
+            if executable is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), args[0])
+        return os.posix_spawn(executable, args, environment, file_actions=[
+            (os.POSIX_SPAWN_DUP2, null, 0),
+            (os.POSIX_SPAWN_DUP2, output, 1),
+            (os.POSIX_SPAWN_DUP2,
+             null if request['hide_standard_error'] else output, 2),
+        ], setpgroup=0, setsigdef=(signal.SIGINT, signal.SIGPIPE,
+                                   signal.SIGXFSZ))
+    finally:
+        os.chdir('/')
+
+def accept(connection, null):
+    data, fds = socket.recv_fds(connection, 65536, 1)[:2]
+    if not fds:
+        return None
+    output = fds[0]
+    try:
+        while not data.endswith(b'\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                return None
+            data += chunk
+        try:
+            pid = launch(json.loads(data), output, null)
+        except OSError as error:
+            connection.sendall(json.dumps(dict(
+                errno=error.errno, strerror=error.strerror,
+                filename=error.filename)).encode() + b'\n')
+            return None
+    finally:
+        os.close(output)
+    connection.sendall(json.dumps(dict(pid=pid)).encode() + b'\n')
+    return pid
+
+def reap(running):
+    while running:
+        try:
+            pid, status, usage = os.wait4(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+        connection = running.pop(pid, None)
+        if connection is None:
+            continue
+        try:
+            connection.sendall(json.dumps(dict(
+                returncode=os.waitstatus_to_exitcode(status),
+                user=usage.ru_utime, system=usage.ru_stime,
+                max_rss=usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+            )).encode() + b'\n')
+        except OSError:
+            pass
+        connection.close()
+
+def serve(path):
+    os.chdir('/')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    wakeup, notify = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(notify, False)
+    signal.set_wakeup_fd(notify)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    null = os.open(os.devnull, os.O_RDWR)
+    running = {}
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    while True:
+        readable = select.select([listener, sys.stdin, wakeup], [], [])[0]
+        if sys.stdin in readable and not os.read(0, 1024):
+            return
+        if wakeup in readable:
+            while True:
+                try:
+                    if not os.read(wakeup, 1024):
+                        break
+                except BlockingIOError:
+                    break
+            reap(running)
+        if listener in readable:
+            connection = listener.accept()[0]
+            try:
+                pid = accept(connection, null)
+            except OSError:
+                pid = None
+            if pid is None:
+                connection.close()
+            else:
+                running[pid] = connection
+                # The command may have terminated before it was registered.
+                reap(running)
+
+serve(sys.argv[1])
+'''
+
+
+class SpawnServer(_Server):
+    """
+    Start commands from a small server process.
+
+    Forking a process costs time in proportion to its size, which grows
+    large in Sphinx builds, and may fail under memory pressure.  The server
+    is a fresh interpreter which runs no more than :mod:`json`,
+    :mod:`socket` and :mod:`select`, and starts commands with
+    :func:`os.posix_spawn`, with the arguments, environment, working
+    directory and standard streams :meth:`Command.execute` would give them,
+    and in a process group of their own.  Start it with :meth:`start`
+    while the build is still small.
+
+    This requires :func:`os.posix_spawn` and :func:`socket.send_fds`, see
+    :attr:`available`.
+    """
+
+    #: Whether spawn servers are supported on this platform.
+    available = hasattr(os, 'posix_spawn') and hasattr(socket, 'send_fds')
+
+    source = _SPAWN_SERVER_SOURCE
+
+    def spawn(self, command):
+        """
+        Start :class:`Command` ``command``.
+
+        Return an object like :class:`~subprocess.Popen` to read the output
+        from and wait for.  Raise :exc:`OSError` if the command cannot be
+        started, like :class:`~subprocess.Popen` would.
+        """
+        if command.shell:
+            args = ['/bin/sh', '-c', command.command]
+        else:
+            args = list(command._arguments()) # pylint:disable=protected-access
+        return self._request(dict(
+            args=args, environment=dict(os.environ),
+            working_directory=os.path.abspath(command.working_directory),
+            hide_standard_error=command.hide_standard_error))
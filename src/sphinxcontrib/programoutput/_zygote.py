@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010, 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    sphinxcontrib.programoutput._zygote
+    ===================================
+
+    A warm Python interpreter which forks to run ``python`` commands.
+"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from subprocess import PIPE
+from subprocess import Popen
+
+
+#: The source of the zygote of :class:`PythonZygote`, run with ``python -c``.
+#:
+#: The zygote imports the modules given on its command line, and then accepts
+#: connections on the Unix socket given as first argument.  For each
+#: connection it forks a runner, which receives a JSON request and the write
+#: end of a pipe for the output, and forks again to run the command.  The
+#: runner reports the pid of the command, and then its return code and
+#: resource usage.  Only the command process leaves ``serve()``, to run the
+#: command at the top level like a fresh interpreter would.  The zygote exits
+#: when its standard input is closed.
+_ZYGOTE_SOURCE = r'''
+import importlib, json, os, select, signal, socket, sys, traceback
+
+def serve(path):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    while True:
+        readable = select.select([listener, sys.stdin], [], [])[0]
+        if sys.stdin in readable and not os.read(0, 1024):
+            # Clean up after a process which exits without closing us, like
+            # the readers of a parallel build.
+            listener.close()
+            try:
+                os.unlink(path)
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+            return None
+        if listener not in readable:
+            continue
+        connection = listener.accept()[0]
+        if os.fork():
+            connection.close()
+            continue
+        listener.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        data, fds = socket.recv_fds(connection, 65536, 1)[:2]
+        while not data.endswith(b'\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                os._exit(1)
+            data += chunk
+        pid = os.fork()
+        if not pid:
+            connection.close()
+            os.setpgid(0, 0)
+            return json.loads(data), fds[0]
+        os.close(fds[0])
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        connection.sendall(json.dumps(dict(pid=pid)).encode() + b'\n')
+        _, status, usage = os.wait4(pid, 0)
+        connection.sendall(json.dumps(dict(
+            returncode=os.waitstatus_to_exitcode(status),
+            user=usage.ru_utime, system=usage.ru_stime,
+            max_rss=usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        )).encode() + b'\n')
+        os._exit(0)
+
+for _name in sys.argv[2:]:
+    try:
+        importlib.import_module(_name)
+    except Exception:
+        traceback.print_exc()
+_request = serve(sys.argv[1])
+if _request is None:
+    sys.exit(0)
+_request, _fd = _request
+_null = os.open(os.devnull, os.O_RDWR)
+os.dup2(_null, 0)
+os.dup2(_fd, 1)
+os.dup2(_null if _request['hide_standard_error'] else _fd, 2)
+os.close(_fd)
+os.close(_null)
+os.chdir(_request['working_directory'])
+import importlib.machinery, runpy, types
+_mode, _target, _args = _request['mode'], _request['target'], _request['args']
+_main = types.ModuleType('__main__')
+_main.__loader__ = sys.modules['__main__'].__loader__
+_main.__annotations__ = {}
+_main.__builtins__ = sys.modules['__main__'].__builtins__
+sys.modules['__main__'] = _main
+try:
+    if _mode == '-m':
+        sys.argv[:] = ['-m'] + _args
+        sys.path[0] = os.getcwd()
+        runpy._run_module_as_main(_target)
+    elif _mode == '-c':
+        sys.argv[:] = ['-c'] + _args
+        sys.path[0] = ''
+        exec(compile(_target, '<string>', 'exec'), _main.__dict__)
+    elif os.path.isfile(_target):
+        sys.argv[:] = [_target] + _args
+        sys.path[0] = os.path.dirname(os.path.realpath(_target))
+        _main.__file__ = os.path.abspath(_target)
+        _main.__cached__ = None
+        _main.__loader__ = importlib.machinery.SourceFileLoader(
+            '__main__', _main.__file__)
+        with open(_main.__file__, 'rb') as _f:
+            _code = compile(_f.read(), _main.__file__, 'exec')
+        exec(_code, _main.__dict__)
+    elif os.path.exists(_target):
+        sys.argv[:] = [_target] + _args
+        sys.path[0] = os.path.abspath(_target)
+        runpy.run_path(_target, run_name='__main__')
+    else:
+        sys.stderr.write("%s: can't open file %r: [Errno 2] %s\n" % (
+            sys.executable,
+            _target if os.path.isabs(_target) else os.getcwd() + '/' + _target,
+            os.strerror(2)))
+        sys.exit(2)
+except SystemExit:
+    raise
+except BaseException as _error:
+    # Report the error without the frames of the zygote, and of runpy for
+    # scripts, like a fresh interpreter would.
+    _traceback = _error.__traceback__.tb_next
+    while (_mode == '' and _traceback is not None
+           and _traceback.tb_frame.f_globals.get('__name__') == 'runpy'):
+        _traceback = _traceback.tb_next
+    sys.excepthook(type(_error), _error.with_traceback(_traceback),
+                   _traceback)
+    sys.exit(1)
+'''
+
+
+def _python_invocation(command):
+    """
+    Return a tuple ``(mode, target, args)`` for the Python invocation
+    ``command``, a sequence of arguments starting with the interpreter, or
+    ``None`` if it is not supported by :class:`PythonZygote`.
+
+    ``mode`` is ``'-m'`` for a module, ``'-c'`` for code, or ``''`` for a
+    script, which is the ``target``.  Interpreter options are not supported.
+    """
+    if len(command) < 2:
+        return None
+    if command[1] in {'-m', '-c'}:
+        if len(command) < 3:
+            return None
+        return command[1], command[2], list(command[3:])
+    if command[1].startswith('-'):
+        return None
+    return '', command[1], list(command[2:])
+
+
+class _ServerProcess(object):
+    """
+    A command started by a :class:`PythonZygote` or :class:`SpawnServer`,
+    with the parts of the interface of :class:`~subprocess.Popen` used by
+    :meth:`Command.get_output`.
+    """
+
+    def __init__(self, connection, stdout):
+        self._connection = connection
+        self._reader = connection.makefile('rb')
+        self.stdout = stdout
+        self.returncode = None
+        try:
+            self.pid = self._read_reply()['pid']
+        except BaseException:
+            self.close()
+            raise
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise OSError('Server failed to run the command')
+        reply = json.loads(line)
+        if 'errno' in reply:
+            raise OSError(reply['errno'], reply['strerror'], reply['filename'])
+        return reply
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+    def wait(self):
+        """
+        Wait for the command to terminate, and return its resource usage like
+        :func:`_wait`.
+        """
+        try:
+            usage = self._read_reply()
+        finally:
+            self.close()
+        self.returncode = usage.pop('returncode')
+        return usage
+
+    def close(self):
+        self._reader.close()
+        self._connection.close()
+
+
+class _Server(object):
+    """
+    A process started with :data:`sys.executable` which runs ``source``, and
+    starts commands on request.
+
+    Requests are sent as a line of JSON over a Unix socket, along with the
+    write end of a pipe for the output of the command.  The server replies
+    with a line holding the ``pid`` of the command, or the ``errno``,
+    ``strerror`` and ``filename`` of the error which prevented starting it,
+    and later a line with its ``returncode`` and resource usage.
+    """
+
+    #: The source of the server, run with ``python -c``.  It is given the
+    #: path of the socket to listen on as first argument, must write a line
+    #: ``ready`` to its standard output once it accepts connections, and exit
+    #: when its standard input is closed.
+    source = None
+
+    def __init__(self):
+        self._process = None
+        self._directory = None
+        self._owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def _path(self):
+        return os.path.join(self._directory, 'server')
+
+    def _arguments(self):
+        return [sys.executable, '-c', self.source, self._path]
+
+    def start(self):
+        """
+        Start the server, if not started yet.
+
+        A server started before a fork is shared with the forked process,
+        but only stopped by the process which started it.
+        """
+        with self._lock:
+            if self._process is not None:
+                return
+            self._directory = tempfile.mkdtemp(prefix='programoutput-')
+            # pylint:disable=consider-using-with
+            process = Popen(self._arguments(), stdin=PIPE, stdout=PIPE)
+            with process.stdout:
+                ready = process.stdout.readline()
+            if ready != b'ready\n':
+                process.stdin.close()
+                process.wait()
+                shutil.rmtree(self._directory, ignore_errors=True)
+                raise OSError('{0} failed to start'.format(
+                    type(self).__name__))
+            self._process = process
+            self._owner = os.getpid()
+
+    def _request(self, request):
+        # Send ``request`` to the server, and return the started command.
+        self.start()
+        read_end, write_end = os.pipe()
+        stdout = os.fdopen(read_end, 'rb')
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                connection.connect(self._path)
+                data = json.dumps(request).encode('utf-8') + b'\n'
+                sent = socket.send_fds(connection, [data], [write_end])
+                # The request may not fit into a single message.  The server
+                # may already be done with a complete one, so do not even
+                # send nothing then.
+                if sent < len(data):
+                    connection.sendall(data[sent:])
+            finally:
+                os.close(write_end)
+            return _ServerProcess(connection, stdout)
+        except BaseException:
+            connection.close()
+            stdout.close()
+            raise
+
+    def close(self):
+        """
+        Stop the server, if started by this process.
+        """
+        with self._lock:
+            if self._process is not None and self._owner == os.getpid():
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
+                shutil.rmtree(self._directory, ignore_errors=True)
+
+
+class PythonZygote(_Server):
+    """
+    Run Python commands in forks of a warm interpreter.
+
+    The interpreter, which imports the modules in ``preload`` ahead, is
+    started with :data:`sys.executable` when the first command is spawned,
+    and runs until :meth:`close`.  Each command runs in a fresh fork with
+    its own process group, arguments, working directory and standard
+    streams, so its output and return code are those of running it in a new
+    interpreter, but without the cost of starting it.
+
+    This requires :func:`os.fork` and :func:`socket.send_fds`, see
+    :attr:`available`.
+    """
+
+    #: Whether zygotes are supported on this platform.
+    available = hasattr(os, 'fork') and hasattr(socket, 'send_fds')
+
+    source = _ZYGOTE_SOURCE
+
+    def __init__(self, preload=()):
+        super().__init__()
+        self.preload = list(preload)
+
+    def _arguments(self):
+        return super()._arguments() + self.preload
+
+    def spawn(self, command):
+        """
+        Start the Python :class:`Command` ``command`` in a fork.
+
+        Return an object like :class:`~subprocess.Popen` to read the output
+        from and wait for.
+        """
+        mode, target, args = _python_invocation(command.command)
+        return self._request(dict(
+            mode=mode, target=target, args=args,
+            working_directory=command.working_directory,
+            hide_standard_error=command.hide_standard_error))
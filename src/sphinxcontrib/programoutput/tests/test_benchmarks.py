@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+#: The micro-benchmarks, found in a checkout but not in an installation.
+BENCHMARKS = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..',
+                          'benchmarks', 'bm_programoutput.py')
+
+
+@unittest.skipUnless(os.path.exists(BENCHMARKS), 'Benchmarks not found')
+class TestBenchmarks(unittest.TestCase):
+    """
+    Run each micro-benchmark once, so that they keep working.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        spec = importlib.util.spec_from_file_location('bm_programoutput',
+                                                      BENCHMARKS)
+        cls.bm = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cls.bm)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_command_new(self):
+        self.bm.bench_command_new(1, ['python', '-V'], False)
+        self.bm.bench_command_new(1, 'echo "${HOME}" | tr a-z A-Z', True)
+
+    def test_cache(self):
+        self.bm.bench_cache_hit(1)
+        self.bm.bench_cache_miss(1)
+
+    def test_strip_ansi(self):
+        self.bm.bench_strip_ansi(1)
+
+    def test_run_programs(self):
+        commands = ['echo %d' % i for i in range(3)]
+        app = self.bm.make_app(self.tmpdir)
+        self.bm.fill_cache(app, commands, self.bm.SMALL_OUTPUT)
+        self.bm.bench_run_programs(1, app, commands, 6)
+        self.bm.bench_run_programs(1, app, commands, 6,
+                                   dict(show_prompt=True))
+        self.bm.bench_run_rendered(1, app, commands, 6)
+        self.bm.fill_cache(app, commands, self.bm.LARGE_OUTPUT)
+        self.bm.bench_run_programs(1, app, commands, 3,
+                                   dict(strip_lines=(10, -10)))
+        ansi_app = self.bm.make_app(os.path.join(self.tmpdir, 'ansi'),
+                                    programoutput_use_ansi=True)
+        self.bm.fill_cache(ansi_app, commands, self.bm.ANSI_OUTPUT)
+        self.bm.bench_run_programs(1, ansi_app, commands, 3)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
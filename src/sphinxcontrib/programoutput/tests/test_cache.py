@@ -22,12 +22,24 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
+import asyncio
+import json
 import os
 import pickle
 import sys
+import threading
 import unittest
+from unittest.mock import patch as Patch
 
 from sphinxcontrib.programoutput import ProgramOutputCache, Command
+from sphinxcontrib.programoutput import BlobFile
+from sphinxcontrib.programoutput import Cassette
+from sphinxcontrib.programoutput import CassetteMissError
+from sphinxcontrib.programoutput import SQLiteResultStore
+from sphinxcontrib.programoutput import CommandStatistics
+from sphinxcontrib.programoutput import init_cache
+from sphinxcontrib.programoutput._blobs import _digest_output
+from sphinxcontrib.programoutput import _result_digest
 
 from . import AppMixin
 
@@ -86,6 +98,110 @@ class TestCache(AppMixin,
         cmd = sys.executable + " -c 'import sys; sys.exit(1)'"
         self.assert_cache(cache, Command(cmd, shell=True), '', returncode=1)
 
+    def test_get_output_async(self):
+        cache = ProgramOutputCache()
+        cmd = Command(['echo', 'spam'])
+        calls = []
+        original = Command.get_output_async
+
+        async def get_output_async(command, timeout=None, **kwargs):
+            calls.append(command)
+            return await original(command, timeout, **kwargs)
+
+        async def get_twice():
+            return await asyncio.gather(cache.get_output_async(cmd),
+                                        cache.get_output_async(cmd))
+
+        with Patch.object(Command, 'get_output_async', get_output_async):
+            self.assertEqual(asyncio.run(get_twice()),
+                             [(0, 'spam'), (0, 'spam')])
+            self.assertEqual(asyncio.run(cache.get_output_async(cmd)),
+                             (0, 'spam'))
+        self.assertEqual(calls, [cmd])
+        self.assertEqual(cache, {cmd: (0, 'spam')})
+        self.assertFalse(cache._in_flight) # pylint:disable=protected-access
+
+    def test_speculate(self):
+        cache = ProgramOutputCache()
+        cmd = Command(['echo', 'spam'])
+        threads = []
+        original = Command.get_output
+
+        def get_output(command, *args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return original(command, *args, **kwargs)
+
+        with Patch.object(Command, 'get_output', get_output):
+            cache.speculate(cmd, max_workers=2)
+            cache.speculate(cmd)
+            self.assertIn(cmd, cache.speculative)
+            self.assertEqual(cache.get_output(cmd), (0, 'spam'))
+            # Cached commands are not executed again.
+            cache.speculate(cmd)
+            self.assertEqual(cache[cmd], (0, 'spam'))
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('programoutput-speculate'))
+        self.assertFalse(cache.speculative)
+        cache.stop_speculating()
+        self.assertIsNone(cache._executor) # pylint:disable=protected-access
+
+    def test_speculate_failure(self):
+        cache = ProgramOutputCache()
+        cmd = Command(['spam with eggs'])
+        cache.speculate(cmd)
+        with self.assertRaises(EnvironmentError):
+            cache.get_output(cmd)
+        self.assertFalse(cache.speculative)
+        cache.stop_speculating()
+
+    def test_speculate_async(self):
+        cache = ProgramOutputCache()
+        cmd = Command(['echo', 'spam'])
+        cache.speculate(cmd)
+        with Patch.object(Command, 'get_output_async') as get_output_async:
+            self.assertEqual(asyncio.run(cache.get_output_async(cmd)),
+                             (0, 'spam'))
+        get_output_async.assert_not_called()
+        cache.stop_speculating()
+
+    def test_get_rendered(self):
+        cache = ProgramOutputCache()
+        cache.max_rendered_size = 8
+        renders = []
+
+        def render(text):
+            renders.append(text)
+            return text
+
+        self.assertEqual(cache.get_rendered('spam', lambda: render('spam')),
+                         'spam')
+        self.assertEqual(cache.get_rendered('spam', lambda: render('')),
+                         'spam')
+        self.assertEqual(renders, ['spam'])
+        cache.get_rendered('eggs', lambda: render('eggs'))
+        cache.get_rendered('spam', lambda: render('spam'))
+        # Keeping "ham" evicts the least recently used "eggs".
+        cache.get_rendered('ham', lambda: render('ham'))
+        self.assertEqual(list(cache.rendered), ['spam', 'ham'])
+        self.assertNotIn('rendered', pickle.dumps(cache).decode('latin-1'))
+
+    def test_result_digest(self):
+        cache = ProgramOutputCache()
+        cmd = Command(['echo', 'spam'])
+        cache[cmd] = (1, 'spam')
+        with Patch.object(ProgramOutputCache, 'get_encoded',
+                          wraps=cache.get_encoded) as get_encoded:
+            returncode, digest, read = _result_digest(cache, cmd, None)
+            self.assertEqual((returncode, digest),
+                             (1, _digest_output(b'spam')))
+            get_encoded.assert_not_called()
+            self.assertEqual(read(), b'spam')
+            get_encoded.assert_called_once_with(cmd)
+        # Results no longer cached are digested.
+        cache.discard(cmd)
+        self.assertEqual(_result_digest(cache, cmd, (1, b'eggs'))[:2],
+                         (1, _digest_output(b'eggs')))
+
     def test_cache_pickled(self):
         doctreedir = self.doctreedir
         app = self.app
@@ -98,6 +214,527 @@ class TestCache(AppMixin,
             pickled_env = pickle.load(f)
         assert pickled_env.programoutput_cache == {cmd: result}
 
+
+class TestCacheLimits(AppMixin,
+                      unittest.TestCase):
+
+    def fill(self, cache, *outputs):
+        commands = [Command(['echo', str(i)]) for i in range(len(outputs))]
+        for command, output in zip(commands, outputs):
+            cache[command] = (0, output)
+        return commands
+
+    def test_size(self):
+        cache = ProgramOutputCache()
+        spam, eggs = self.fill(cache, 'spam', 'blök')
+        self.assertEqual(cache.size, 9)
+        cache[spam] = (0, 'spam and eggs')
+        self.assertEqual(cache.size, 18)
+        del cache[spam]
+        self.assertEqual(cache.size, 5)
+        self.assertEqual(cache.pop(eggs), (0, 'blök'))
+        self.assertIsNone(cache.pop(eggs, None))
+        self.assertEqual(cache.size, 0)
+        self.fill(cache, 'spam')
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+    def test_max_entries_lru(self):
+        cache = ProgramOutputCache(max_entries=2)
+        spam, eggs = self.fill(cache, 'spam', 'eggs')
+        cache[spam] # pylint:disable=pointless-statement
+        ham = Command(['echo', 'ham'])
+        self.assertEqual(cache[ham], (0, 'ham'))
+        self.assertEqual(cache, {spam: (0, 'spam'), ham: (0, 'ham')})
+        self.assertNotIn(eggs, cache)
+        # Evicted results are executed again.
+        self.assertEqual(cache[eggs], (0, '1'))
+        self.assertEqual(cache, {ham: (0, 'ham'), eggs: (0, '1')})
+
+    def test_max_entries_lfu(self):
+        cache = ProgramOutputCache(max_entries=2, policy='lfu')
+        spam, eggs = self.fill(cache, 'spam', 'eggs')
+        cache[spam] # pylint:disable=pointless-statement
+        cache[eggs] # pylint:disable=pointless-statement
+        cache[spam] # pylint:disable=pointless-statement
+        ham = Command(['echo', 'ham'])
+        cache[ham] # pylint:disable=pointless-statement
+        self.assertEqual(set(cache), {spam, ham})
+
+    def test_max_bytes(self):
+        cache = ProgramOutputCache(max_bytes=10)
+        spam, eggs, ham = self.fill(cache, 'spam', 'eggs', 'ham')
+        self.assertEqual(cache.size, 7)
+        self.assertEqual(set(cache), {eggs, ham})
+        # A result exceeding the limit by itself is not kept.
+        cache[spam] = (0, 'spam' * 3)
+        self.assertFalse(cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_evict(self):
+        cache = ProgramOutputCache()
+        spam, eggs = self.fill(cache, 'spam', 'eggs')
+        cache.max_entries = 2
+        cache.evict()
+        self.assertEqual(set(cache), {spam, eggs})
+        cache.max_entries = 1
+        cache.evict()
+        self.assertEqual(set(cache), {eggs})
+
+    def test_pickle(self):
+        cache = ProgramOutputCache(policy='lfu')
+        spam, eggs, ham = self.fill(cache, 'spam', 'eggs', 'ham')
+        cache[spam] # pylint:disable=pointless-statement
+        cache[spam] # pylint:disable=pointless-statement
+        cache[eggs] # pylint:disable=pointless-statement
+        unpickled = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(unpickled, cache)
+        self.assertEqual(unpickled.size, cache.size)
+        self.assertIsNone(unpickled.max_entries)
+        # The limits are not pickled, but the uses of the results are.
+        unpickled.policy = 'lfu'
+        unpickled.max_entries = 2
+        unpickled.evict()
+        self.assertNotIn(ham, unpickled)
+        unpickled.max_entries = 1
+        unpickled.evict()
+        self.assertEqual(set(unpickled), {spam})
+        self.assertNotIn(eggs, unpickled)
+
+    def test_init_cache(self):
+        getattr(self, 'confoverrides')
+        self.confoverrides = {'programoutput_cache_max_entries': 1,
+                              'programoutput_cache_max_bytes': 100,
+                              'programoutput_cache_policy': 'lfu'}
+        app = self.app
+        cache = app.env.programoutput_cache
+        self.assertEqual((cache.max_entries, cache.max_bytes, cache.policy),
+                         (1, 100, 'lfu'))
+        app.config.programoutput_cache_max_entries = None
+        self.fill(cache, 'spam', 'eggs')
+        app.config.programoutput_cache_max_bytes = 4
+        init_cache(app)
+        self.assertEqual(len(cache), 1)
+
+
+class TestCacheBlobs(unittest.TestCase):
+
+    output = '\n'.join('line %d of spam with eggs' % i for i in range(1000))
+
+    def test_shared(self):
+        cache = ProgramOutputCache()
+        spam = Command(['spam', '--help'], working_directory='/spam')
+        eggs = Command(['spam', '--help'], working_directory='/eggs')
+        cache[spam] = (0, self.output)
+        size = cache.size
+        self.assertLess(size, len(self.output) / 10)
+        cache[eggs] = (1, self.output)
+        self.assertEqual(cache.size, size)
+        self.assertEqual(len(cache._outputs.blobs), 1) # pylint:disable=protected-access
+        self.assertEqual(cache[spam], (0, self.output))
+        self.assertEqual(cache[eggs], (1, self.output))
+        del cache[spam]
+        self.assertEqual(cache.size, size)
+        self.assertEqual(cache.pop(eggs), (1, self.output))
+        self.assertEqual(cache.size, 0)
+        self.assertFalse(cache._outputs.blobs) # pylint:disable=protected-access
+
+    def test_compression(self):
+        cmd = Command(['echo', 'spam'])
+        sizes = {}
+        for compression in (None, 'zlib', 'lzma'):
+            cache = ProgramOutputCache(compression=compression)
+            cache[cmd] = (0, self.output)
+            self.assertEqual(cache[cmd], (0, self.output))
+            sizes[compression] = cache.size
+        self.assertEqual(sizes[None], len(self.output))
+        self.assertLess(sizes['zlib'], sizes[None])
+        self.assertLess(sizes['lzma'], sizes[None])
+        # Outputs which do not get smaller are not compressed.
+        cache = ProgramOutputCache()
+        cache[cmd] = (0, 'blök')
+        self.assertEqual(cache.size, 5)
+        self.assertEqual(cache[cmd], (0, 'blök'))
+
+    def test_mapping(self):
+        cache = ProgramOutputCache()
+        spam, eggs = Command(['echo', 'spam']), Command(['echo', 'eggs'])
+        cache[spam] = (0, 'spam')
+        cache[eggs] = (0, self.output)
+        self.assertEqual(cache, {spam: (0, 'spam'), eggs: (0, self.output)})
+        self.assertNotEqual(cache, {spam: (0, 'spam')})
+        self.assertEqual(sorted(cache.values()),
+                         [(0, self.output), (0, 'spam')])
+        self.assertIn("(0, 'spam')", repr(cache))
+        # Listing the results does not use them.
+        uses = cache._outputs.uses # pylint:disable=protected-access
+        self.assertEqual(len(cache.items()), 2)
+        self.assertEqual(dict(cache.items())[spam], (0, 'spam'))
+        self.assertEqual(list(uses.values()), [1, 1])
+        self.assertEqual(cache.get(spam), (0, 'spam'))
+        self.assertEqual(list(uses.items()), [(eggs, 1), (spam, 2)])
+        # Updating a cache stores the results like setting them.
+        other = ProgramOutputCache()
+        other.update(cache)
+        self.assertEqual(other, cache)
+        self.assertEqual(other.size, cache.size)
+        with self.assertRaises(TypeError):
+            hash(cache)
+        self.assertIsNone(cache.get(Command(['echo', 'ham'])))
+        cache.discard(spam)
+        cache.discard(spam)
+        self.assertEqual(list(cache), [eggs])
+
+    def test_pickle(self):
+        cache = ProgramOutputCache()
+        commands = [Command(['echo', str(i)]) for i in range(10)]
+        for command in commands:
+            cache[command] = (0, self.output)
+        pickled = pickle.dumps(cache)
+        self.assertLess(len(pickled), len(self.output))
+        unpickled = pickle.loads(pickled)
+        self.assertEqual(unpickled, cache)
+        self.assertEqual(unpickled.size, cache.size)
+        self.assertEqual(len(unpickled._outputs.blobs), 1) # pylint:disable=protected-access
+
+    def test_merge(self):
+        cache = ProgramOutputCache()
+        other = ProgramOutputCache()
+        spam, eggs = Command(['echo', 'spam']), Command(['echo', 'eggs'])
+        cache[spam] = (0, 'spam')
+        other[spam] = (0, 'eggs')
+        other[eggs] = (0, self.output)
+        with Patch('sphinxcontrib.programoutput._blobs._compress') as compress:
+            cache.merge(other)
+        compress.assert_not_called()
+        self.assertEqual(cache, {spam: (0, 'spam'), eggs: (0, self.output)})
+        self.assertEqual(cache.size, other.size)
+
+
+class TestBlobFile(AppMixin,
+                   unittest.TestCase):
+
+    output = TestCacheBlobs.output
+
+    def test_append_read(self):
+        blob_file = BlobFile.create(self.tmpdir)
+        self.assertEqual(os.path.dirname(blob_file.path), self.tmpdir)
+        self.assertEqual(blob_file.size, 0)
+        self.assertEqual(blob_file.append([b'spam', b'', b'eggs']),
+                         [(0, 4), (4, 0), (4, 4)])
+        self.assertEqual(blob_file.read(4, 4), b'eggs')
+        self.assertEqual(blob_file.append([b'ham']), [(8, 3)])
+        self.assertEqual(blob_file.read(8, 3), b'ham')
+        self.assertEqual(blob_file.read(4, 0), b'')
+        with self.assertRaises(ValueError):
+            blob_file.read(8, 4)
+        blob_file.close()
+        self.assertEqual(pickle.loads(pickle.dumps(blob_file)), blob_file)
+        self.assertNotEqual(BlobFile.create(self.tmpdir), blob_file)
+        with self.assertRaises(OSError):
+            BlobFile.create(self.tmpdir).read(0, 1)
+
+    def make_cache(self):
+        cache = ProgramOutputCache()
+        cache.blob_file = BlobFile.create(self.tmpdir)
+        self.addCleanup(cache.blob_file.close)
+        spam, eggs = Command(['echo', 'spam']), Command(['echo', 'eggs'])
+        cache[spam] = (0, self.output)
+        cache[eggs] = (0, 'eggs')
+        return cache, spam, eggs
+
+    def test_write_blobs(self):
+        cache, spam, eggs = self.make_cache()
+        size = cache.size
+        cache.write_blobs()
+        self.assertEqual(cache.size, size)
+        self.assertEqual(cache.blob_file.size, size)
+        self.assertLess(len(pickle.dumps(cache)), 1024)
+        unpickled = pickle.loads(pickle.dumps(cache))
+        # Outputs are read from the blob file one at a time, when used.
+        with Patch.object(BlobFile, 'read', autospec=True,
+                          side_effect=BlobFile.read) as read:
+            self.assertEqual(unpickled[eggs], (0, 'eggs'))
+            self.assertEqual(len(read.call_args_list), 1)
+            self.assertEqual(unpickled[spam], (0, self.output))
+            self.assertEqual(len(read.call_args_list), 2)
+        self.assertEqual(unpickled, cache)
+        # Writing again only appends new outputs.
+        cache[Command(['echo', 'ham'])] = (0, 'ham')
+        cache.write_blobs()
+        self.assertEqual(cache.blob_file.size, size + 3)
+
+    def test_missing_blob_file(self):
+        cache, spam, _ = self.make_cache()
+        cache.write_blobs()
+        cache.blob_file.close()
+        os.remove(cache.blob_file.path)
+        self.assertEqual(cache[spam], (0, 'spam'))
+
+    def test_get_encoded(self):
+        cache, spam, eggs = self.make_cache()
+        cache[eggs] = (0, 'bl\xf6k\udcff')
+        cache.write_blobs()
+        self.assertEqual(cache.get_encoded(spam),
+                         (0, self.output.encode('utf-8')))
+        self.assertEqual(cache.get_encoded(eggs), (0, b'bl\xc3\xb6k\xff'))
+        ham = Command(['echo', 'ham'])
+        self.assertEqual(cache.get_encoded(ham), (0, b'ham'))
+        self.assertEqual(cache[ham], (0, 'ham'))
+
+    def test_rewrite(self):
+        cache, spam, eggs = self.make_cache()
+        cache[Command(['echo', 'ham'])] = (0, os.urandom(1024 * 1024).hex())
+        cache.write_blobs()
+        old_file = cache.blob_file
+        cache.discard(Command(['echo', 'ham']))
+        cache.write_blobs()
+        self.assertNotEqual(cache.blob_file, old_file)
+        self.assertEqual(cache.blob_file.size, cache.size)
+        self.assertEqual(cache, {spam: (0, self.output), eggs: (0, 'eggs')})
+        self.assertTrue(os.path.exists(old_file.path))
+
+    def test_environment(self):
+        cmd = Command([sys.executable, '-c', 'print("spam" * 2)'])
+        app = self.app
+        self.assertEqual(app.env.programoutput_cache[cmd], (0, 'spamspam'))
+        app.build()
+        blob_file = app.env.programoutput_cache.blob_file
+        self.assertEqual(os.path.dirname(blob_file.path), self.doctreedir)
+        self.assertEqual(blob_file.read(0, 8), b'spamspam')
+        blob_file.close()
+        with open(os.path.join(self.doctreedir, 'environment.pickle'),
+                  'rb') as f:
+            self.assertFalse(b'spamspam' in f.read())
+
+        # Blob files no longer used are removed.
+        stale = BlobFile.create(self.doctreedir)
+        stale.append([b'eggs'])
+        del app.env.programoutput_cache
+        init_cache(app)
+        self.assertFalse(os.path.exists(stale.path))
+        self.assertFalse(os.path.exists(blob_file.path))
+
+
+class TestCassette(AppMixin,
+                   unittest.TestCase):
+
+    def test_record_replay(self):
+        path = os.path.join(self.tmpdir, 'cassette.json')
+        cassette = Cassette(path)
+        self.assertIsNone(cassette.digest)
+        spam = Command(['echo', 'spam'], working_directory=self.tmpdir)
+        eggs = Command('echo eggs', shell=True, fingerprint='abc',
+                       window=(1, None, False))
+        cassette.record([(spam, (0, 'spam')), (eggs, (1, 'eggs\nblök\n'))])
+        cassette.save()
+        self.assertIsNotNone(cassette.digest)
+
+        cassette = Cassette(path)
+        self.assertEqual(len(cassette), 2)
+        self.assertEqual(cassette.get(spam), (0, 'spam'))
+        self.assertEqual(cassette.get(eggs), (1, 'eggs\nblök\n'))
+        # The fingerprint is not recorded.
+        self.assertEqual(cassette.get(eggs._replace(fingerprint='def')),
+                         (1, 'eggs\nblök\n'))
+        self.assertIsNone(cassette.get(eggs._replace(shell=False)))
+
+        with open(path, encoding='utf-8') as f:
+            content = json.load(f)
+        self.assertEqual(content['version'], Cassette.version)
+        self.assertEqual(content['commands'][0]['command'], 'echo eggs')
+        self.assertEqual(content['commands'][0]['output'],
+                         ['eggs', 'blök', ''])
+        self.assertEqual(content['commands'][1]['working_directory'], '.')
+
+    def test_relocated(self):
+        # Working directories are relative to the cassette.
+        directory = os.path.join(self.tmpdir, 'a', 'docs')
+        os.makedirs(directory)
+        cassette = Cassette(os.path.join(directory, 'cassette.json'))
+        cmd = Command(['ls'], working_directory=directory)
+        cassette.record([(cmd, (0, 'spam'))])
+        cassette.save()
+
+        os.rename(os.path.join(self.tmpdir, 'a'), os.path.join(self.tmpdir, 'b'))
+        directory = os.path.join(self.tmpdir, 'b', 'docs')
+        cassette = Cassette(os.path.join(directory, 'cassette.json'))
+        self.assertEqual(
+            cassette.get(cmd._replace(working_directory=directory)),
+            (0, 'spam'))
+        self.assertIsNone(cassette.get(cmd))
+
+    def test_keep(self):
+        cassette = Cassette(os.path.join(self.tmpdir, 'cassette.json'))
+        spam = Command(['echo', 'spam'])
+        eggs = Command(['echo', 'eggs'])
+        cassette.record([(spam, (0, 'spam'))])
+        cassette.record([(eggs, (0, 'eggs'))], keep=True)
+        self.assertEqual(len(cassette), 2)
+        cassette.record([(eggs, (0, 'eggs'))])
+        self.assertEqual(len(cassette), 1)
+        self.assertIsNone(cassette.get(spam))
+
+    def test_save_unchanged(self):
+        path = os.path.join(self.tmpdir, 'cassette.json')
+        cassette = Cassette(path)
+        cassette.record([(Command(['echo', 'spam']), (0, 'spam'))])
+        cassette.save()
+        os.utime(path, (1000000000, 1000000000))
+        cassette = Cassette(path)
+        cassette.record([(Command(['echo', 'spam']), (0, 'spam'))])
+        cassette.save()
+        self.assertEqual(os.stat(path).st_mtime, 1000000000)
+
+    def test_unsupported_version(self):
+        path = os.path.join(self.tmpdir, 'cassette.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(dict(version=0, commands=[]), f)
+        with self.assertRaises(ValueError):
+            Cassette(path)
+
+    def test_cache_offline(self):
+        cassette = Cassette(os.path.join(self.tmpdir, 'cassette.json'))
+        spam = Command(['echo', 'spam'])
+        cassette.record([(spam, (0, 'recorded'))])
+        cache = ProgramOutputCache()
+        cache.cassette = cassette
+        cache.offline = True
+        with Patch.object(Command, 'get_output') as get_output:
+            self.assertEqual(cache[spam], (0, 'recorded'))
+            with self.assertRaises(CassetteMissError) as exc:
+                cache.get_output(Command(['echo', 'eggs']))
+            with self.assertRaises(CassetteMissError):
+                asyncio.run(cache.get_output_async(Command(['echo', 'ham'])))
+        get_output.assert_not_called()
+        self.assertIn(cassette.path, str(exc.exception))
+        error = pickle.loads(pickle.dumps(exc.exception))
+        self.assertEqual(str(error), str(exc.exception))
+
+
+class TestSQLiteResultStore(AppMixin,
+                            unittest.TestCase):
+
+    def test_get_set(self):
+        store = SQLiteResultStore(os.path.join(self.tmpdir, 'store'))
+        cmd = Command(['echo', 'blök'])
+        self.assertIsNone(store.get(cmd))
+        store.set(cmd, (0, 'blök'))
+        self.assertEqual(store.get(cmd), (0, 'blök'))
+        self.assertIsNone(store.get(Command('echo blök', shell=True)))
+        # A second store on the same directory sees the result.
+        self.assertEqual(SQLiteResultStore(store.directory).get(cmd),
+                         (0, 'blök'))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork()')
+    def test_fork(self):
+        store = SQLiteResultStore(self.tmpdir)
+        spam, eggs = Command(['echo', 'spam']), Command(['echo', 'eggs'])
+        store.set(spam, (0, 'spam'))
+        connection = store._connect() # pylint:disable=protected-access
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            status = 1
+            try:
+                store.set(eggs, (0, 'eggs'))
+                if (store.get(spam) == (0, 'spam') and
+                        store._connect() is not connection): # pylint:disable=protected-access
+                    status = 0
+            finally:
+                os._exit(status) # pylint:disable=protected-access
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(store.get(eggs), (0, 'eggs'))
+        self.assertIs(store._connect(), connection) # pylint:disable=protected-access
+
+    def test_cache_uses_store(self):
+        store = SQLiteResultStore(self.tmpdir)
+        cmd = Command(['echo', 'spam'])
+        ProgramOutputCache(store)[cmd] # pylint:disable=expression-not-assigned
+        self.assertEqual(store.get(cmd), (0, 'spam'))
+
+        cache = ProgramOutputCache(store)
+        with Patch.object(Command, 'get_output') as get_output:
+            self.assertEqual(cache[cmd], (0, 'spam'))
+        get_output.assert_not_called()
+        self.assertEqual(cache, {cmd: (0, 'spam')})
+
+    def test_pickle(self):
+        cache = ProgramOutputCache(SQLiteResultStore(self.tmpdir))
+        cmd = Command(['echo', 'spam'])
+        cache[cmd] # pylint:disable=pointless-statement
+        unpickled = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(unpickled, {cmd: (0, 'spam')})
+        self.assertEqual(unpickled.store.directory, self.tmpdir)
+        self.assertEqual(unpickled.store.get(cmd), (0, 'spam'))
+
+    def test_survives_fresh_environment(self):
+        getattr(self, 'confoverrides')
+        self.confoverrides = {'programoutput_cache_dir': '_cache'}
+        cmd = Command(['echo', 'spam'])
+        app = self.app
+        self.assertIsInstance(app.env.programoutput_cache.store,
+                              SQLiteResultStore)
+        self.assertEqual(app.env.programoutput_cache[cmd], (0, 'spam'))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.srcdir, '_cache', SQLiteResultStore.filename)))
+
+        del app.env.programoutput_cache
+        init_cache(app)
+        self.assertFalse(app.env.programoutput_cache)
+        with Patch.object(Command, 'get_output') as get_output:
+            self.assertEqual(app.env.programoutput_cache[cmd], (0, 'spam'))
+        get_output.assert_not_called()
+
+class TestCommandStatistics(unittest.TestCase):
+
+    def test_cache_records(self):
+        cache = ProgramOutputCache()
+        cache.statistics = statistics = CommandStatistics()
+        spam = Command(['echo', 'spam'])
+        self.assertEqual(cache[spam], (0, 'spam'))
+        failing = Command("'spam with eggs'")
+        with self.assertRaises(EnvironmentError):
+            cache.get_output(failing)
+        self.assertEqual(len(statistics.executions), 2)
+        self.assertIn('wall', statistics.executions[spam])
+        self.assertIn('error', statistics.executions[failing])
+        self.assertEqual(statistics.misses, {spam: 1, failing: 1})
+        # The statistics are not pickled with the cache.
+        self.assertIsNone(pickle.loads(pickle.dumps(cache)).statistics)
+
+    def test_as_json(self):
+        statistics = CommandStatistics()
+        spam = Command(['echo', 'spam'])
+        eggs = Command('echo eggs', shell=True)
+        ham = Command(['echo', 'ham'])
+        statistics.record_execution(spam, dict(wall=1.0, user=0.5, system=0.25,
+                                               max_rss=1024))
+        statistics.record_execution(eggs, dict(wall=2.0, user=None, system=None,
+                                               max_rss=None))
+        statistics.record_hits([spam, spam, ham])
+        other = pickle.loads(pickle.dumps(statistics))
+        self.assertEqual(other.executions, statistics.executions)
+        statistics.merge(other)
+        self.assertEqual(statistics.hits, {spam: 4, ham: 2})
+        self.assertEqual(statistics.misses, {spam: 2, eggs: 2})
+
+        report = statistics.as_json({'a': {spam: None, eggs: None}, 'b': {spam: None}})
+        self.assertEqual(report['executions'], 2)
+        self.assertEqual(report['wall'], 3.0)
+        self.assertEqual((report['hits'], report['misses']), (6, 4))
+        self.assertEqual([entry['command'] for entry in report['commands']],
+                         ['echo eggs', ['echo', 'spam'], ['echo', 'ham']])
+        self.assertEqual(report['commands'][1]['documents'], ['a', 'b'])
+        self.assertEqual([(entry['hits'], entry['misses'])
+                          for entry in report['commands']],
+                         [(0, 2), (4, 2), (2, 0)])
+        self.assertNotIn('wall', report['commands'][2])
+        self.assertEqual(report['documents']['a'],
+                         dict(commands=2, executed=2, wall=3.0, user=0.5,
+                              system=0.25))
+        self.assertEqual(report['documents']['b']['wall'], 1.0)
+
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
 
@@ -29,11 +29,20 @@ import sys
 import unittest
 import tempfile
 import shutil
+import asyncio
 import os.path
+import pickle
+import time
+from unittest.mock import patch as Patch
 
 from sphinxcontrib.programoutput import Command, program_output
+from sphinxcontrib.programoutput import CommandTimeoutError
+from sphinxcontrib.programoutput import PythonZygote
+from sphinxcontrib.programoutput import ShellSessions
+from sphinxcontrib.programoutput import SpawnServer
 
 class TestCommand(unittest.TestCase):
+    # pylint:disable=too-many-public-methods
 
     def test_new_with_string_command(self):
         cmd = 'echo "spam with eggs"'
@@ -42,6 +51,51 @@ class TestCommand(unittest.TestCase):
         self.assertEqual(Command(cmd, shell=True).command, cmd)
 
 
+    def test_new_with_simple_shell_command(self):
+        cmd = Command("ls -l 'spam with eggs' blök_1.txt", shell=True)
+        self.assertFalse(cmd.shell)
+        self.assertEqual(cmd.command, ('ls', '-l', 'spam with eggs',
+                                       'blök_1.txt'))
+        self.assertEqual(cmd, Command(['ls', '-l', 'spam with eggs',
+                                       'blök_1.txt']))
+        self.assertEqual(hash(cmd), hash(Command(
+            "ls -l 'spam with eggs' blök_1.txt")))
+
+    def test_new_keeps_shell(self):
+        for cmd in ('ls $HOME', 'ls | cat', 'ls *.txt', 'ls > spam', 'ls ~',
+                    'ls; ls', 'ls && ls', 'ls `pwd`', 'ls \\', 'ls "$HOME"',
+                    "ls 'spam", 'SPAM=eggs ls', 'echo spam', 'cd /', 'ls\nls',
+                    './run.sh', '/bin/ls', ''):
+            self.assertEqual(Command(cmd, shell=True).command, cmd)
+            self.assertTrue(Command(cmd, shell=True).shell)
+        cmd = Command('ls', shell=True, session=('spam', ()))
+        self.assertEqual(cmd.command, 'ls')
+        self.assertTrue(cmd.shell)
+
+    def test_script_without_interpreter_line(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        script = os.path.join(tmpdir, 'run.sh')
+        with open(script, 'w', encoding='utf-8') as f:
+            f.write('echo spam\n')
+        os.chmod(script, 0o755)
+        for cmd in ('./run.sh', script):
+            self.assertEqual(
+                Command(cmd, shell=True, working_directory=tmpdir).get_output(),
+                (0, 'spam'))
+        path = tmpdir + os.pathsep + os.environ.get('PATH', '')
+        with Patch.dict(os.environ, PATH=path):
+            cmd = Command('run.sh', shell=True)
+            self.assertTrue(cmd.shell)
+            self.assertEqual(cmd.get_output(), (0, 'spam'))
+
+    def test_shell_missing_executable(self):
+        cmd = Command('nonexistent_tool_xyz --help', shell=True)
+        self.assertTrue(cmd.shell)
+        returncode, output = cmd.get_output()
+        self.assertEqual(returncode, 127)
+        self.assertIn('nonexistent_tool_xyz', output)
+
     def test_new_with_list(self):
         cmd = Command(['echo', 'spam'])
         self.assertEqual(cmd.command, ('echo', 'spam'))
@@ -52,6 +106,11 @@ class TestCommand(unittest.TestCase):
         # list.  Important for caching!
         hash(Command(['echo', 'spam']))
 
+    def test_pickle(self):
+        cmd = Command('echo $SPAM', True, window=(0, 1, True),
+                      session=('spam', ['SPAM=eggs']), fingerprint='ham')
+        self.assertEqual(pickle.loads(pickle.dumps(cmd)), cmd)
+
 
     def test_from_programoutput_node(self):
         node = program_output()
@@ -135,6 +194,431 @@ class TestCommand(unittest.TestCase):
         self.assertEqual(output, cwd)
         shutil.rmtree(tmpdir)
 
+    def test_get_output_within_timeout(self):
+        returncode, output = Command('echo spam').get_output(timeout=30)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(output, 'spam')
+
+    def test_get_output_timeout(self):
+        # The grandchild keeps standard output open; unless it is killed with
+        # its parent, collecting the output would block for 30 seconds.
+        cmd = Command([sys.executable, '-c',
+                       'import subprocess, time; '
+                       'subprocess.Popen(["sleep", "30"]); time.sleep(30)'])
+        start = time.monotonic()
+        with self.assertRaises(CommandTimeoutError) as exc:
+            cmd.get_output(timeout=0.5)
+        self.assertLess(time.monotonic() - start, 15)
+        self.assertIsInstance(exc.exception, EnvironmentError)
+        self.assertEqual(exc.exception.timeout, 0.5)
+        self.assertGreaterEqual(exc.exception.elapsed, 0.5)
+        self.assertIn('timed out after 0.5 seconds', str(exc.exception))
+        unpickled = pickle.loads(pickle.dumps(exc.exception))
+        self.assertEqual(str(unpickled), str(exc.exception))
+
+    def test_get_output_window(self):
+        cmd = Command([sys.executable, '-c',
+                       'for i in range(10000): print(i)'],
+                      window=(2, -2, False))
+        self.assertEqual(cmd.get_output(), (0, '0\n1\n...\n9998\n9999'))
+
+    def test_get_output_window_stop_early(self):
+        cmd = Command([sys.executable, '-c',
+                       'import time\n'
+                       'print("spam\\nwith\\neggs", flush=True)\n'
+                       'time.sleep(30)'],
+                      window=(2, None, True))
+        start = time.monotonic()
+        self.assertEqual(cmd.get_output(), (None, 'spam\nwith\n...'))
+        self.assertLess(time.monotonic() - start, 15)
+
+    def test_get_output_window_timeout(self):
+        cmd = Command([sys.executable, '-c', 'import time; time.sleep(30)'],
+                      window=(2, None, False))
+        with self.assertRaises(CommandTimeoutError):
+            cmd.get_output(timeout=0.5)
+
+    def test_get_output_spilled(self):
+        code = 'for i in range(10000): print(i, "bl\u00f6k")\nprint()'
+        for window in None, (2, -2, False), (3, None, True):
+            cmd = Command([sys.executable, '-c', code], window=window)
+            for threshold in 0, 10, 1 << 20:
+                self.assertEqual(cmd.get_output(spill_threshold=threshold),
+                                 cmd.get_output(), (window, threshold))
+        cmd = Command([sys.executable, '-c',
+                       'import sys; sys.stderr.write("spam"); print("eggs")'],
+                      hide_standard_error=True)
+        self.assertEqual(cmd.get_output(spill_threshold=0), (0, 'eggs'))
+        self.assertEqual(asyncio.run(cmd.get_output_async(spill_threshold=0)),
+                         (0, 'eggs'))
+
+    def test_get_output_spilled_timeout(self):
+        cmd = Command([sys.executable, '-c',
+                       'import time; print("spam" * 100, flush=True); '
+                       'time.sleep(30)'])
+        with self.assertRaises(CommandTimeoutError):
+            cmd.get_output(timeout=0.5, spill_threshold=10)
+
+    def test_get_output_async(self):
+        self.assertEqual(asyncio.run(Command('echo spam').get_output_async()),
+                         (0, 'spam'))
+        self.assertEqual(
+            asyncio.run(Command('echo "${PWD}"', shell=True,
+                                working_directory=os.path.realpath('/'))
+                        .get_output_async(timeout=30)),
+            (0, '/'))
+
+    def test_get_output_async_non_zero_with_hidden_standard_error(self):
+        cmd = Command([sys.executable, '-c',
+                       'import sys; sys.stderr.write("spam"); sys.exit(1)'],
+                      hide_standard_error=True)
+        self.assertEqual(asyncio.run(cmd.get_output_async()), (1, ''))
+
+    def test_get_output_async_timeout(self):
+        cmd = Command([sys.executable, '-c', 'import time; time.sleep(30)'])
+        with self.assertRaises(CommandTimeoutError):
+            asyncio.run(cmd.get_output_async(timeout=0.5))
+
+    def test_get_output_async_window(self):
+        cmd = Command('echo spam', window=(0, None, False))
+        self.assertEqual(asyncio.run(cmd.get_output_async()), (0, '...'))
+
+    def test_get_output_async_non_existing_executable(self):
+        with self.assertRaises(EnvironmentError):
+            asyncio.run(Command("'spam with eggs'").get_output_async())
+
+    def test_get_output_statistics(self):
+        statistics = {}
+        cmd = Command([sys.executable, '-c',
+                       'import time; time.sleep(0.2); print("spam")'])
+        self.assertEqual(cmd.get_output(statistics=statistics), (0, 'spam'))
+        self.assertEqual(sorted(statistics),
+                         ['max_rss', 'system', 'user', 'wall'])
+        self.assertGreaterEqual(statistics['wall'], 0.2)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(statistics['user'] + statistics['system'], 0)
+            self.assertGreater(statistics['max_rss'], 1024 * 1024)
+
+    def test_execute_python(self):
+        # Python commands run with the interpreter running Sphinx.
+        cmd = Command('python3.0 -c "import sys; print(sys.executable)"',
+                      python=True)
+        self.assertEqual(cmd.get_output(), (0, sys.executable))
+
+
+@unittest.skipIf(not PythonZygote.available, "Zygotes require fork")
+class TestPythonZygote(unittest.TestCase):
+
+    def setUp(self):
+        self.zygote = PythonZygote(['json'])
+        self.addCleanup(self.zygote.close)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def assertSameOutput(self, command, **kwargs):
+        cmd = Command(command, python=True, working_directory=self.tmpdir,
+                      **kwargs)
+        result = cmd.get_output(zygote=self.zygote)
+        self.assertEqual(result, cmd.get_output())
+        return result
+
+    def test_code(self):
+        returncode, output = self.assertSameOutput([
+            'python', '-c',
+            'import sys, os; print(sys.argv, repr(sys.path[0]), os.getcwd()); '
+            'print("eggs", file=sys.stderr); sys.exit(3)', 'spam'])
+        self.assertEqual(returncode, 3)
+        self.assertEqual(output, "['-c', 'spam'] '' %s\neggs"
+                         % os.path.realpath(self.tmpdir))
+
+    def test_hidden_standard_error(self):
+        self.assertEqual(
+            self.assertSameOutput(
+                ['python', '-c', 'import sys; print("eggs", file=sys.stderr)'],
+                hide_standard_error=True),
+            (0, ''))
+
+    def test_clean_main_module(self):
+        code = 'import __main__; print(__name__, vars(__main__))'
+        self.assertSameOutput(['python', '-c', code])
+        with open(os.path.join(self.tmpdir, 'script.py'), 'w',
+                  encoding='utf-8') as f:
+            f.write(code.replace('vars(__main__)', 'list(vars(__main__))'))
+        self.assertSameOutput(['python', 'script.py'])
+
+    def test_module(self):
+        returncode, output = self.assertSameOutput(
+            ['python', '-m', 'json.tool', '--help'])
+        self.assertEqual(returncode, 0)
+        self.assertIn('json.tool', output)
+
+    def test_script(self):
+        with open(os.path.join(self.tmpdir, 'script.py'), 'w',
+                  encoding='utf-8') as f:
+            f.write('import sys\n'
+                    'print(sys.argv, sys.path[0], __name__, __file__)\n'
+                    'def spam():\n'
+                    '    raise KeyError("eggs")\n'
+                    'spam()\n')
+        self.assertEqual(
+            self.assertSameOutput(['python', 'script.py', 'eggs'])[0], 1)
+
+    def test_errors(self):
+        self.assertSameOutput(['python', '-c', 'raise ValueError("spam")'])
+        self.assertSameOutput(['python', '-c', 'spam = ('])
+        self.assertSameOutput(['python', '-c', 'import sys; sys.exit("spam")'])
+        self.assertSameOutput(['python', '-m', 'no_such_module'])
+        self.assertSameOutput(['python', 'no_such_script.py'])
+
+    def test_interpreter_shutdown(self):
+        self.assertEqual(self.assertSameOutput([
+            'python', '-c',
+            'import atexit, threading, time\n'
+            'atexit.register(print, "atexit")\n'
+            'threading.Thread(target=lambda: (time.sleep(0.2), print("thread")))'
+            '.start()\n'
+            'print("spam", end="")']),
+            (0, 'spamthread\natexit'))
+
+    def test_long_request(self):
+        # Larger than a single message.
+        code = 'spam = %r; print(len(spam))' % ('x' * 100000)
+        self.assertEqual(self.assertSameOutput(['python', '-c', code]),
+                         (0, '100000'))
+
+    def test_unsupported_invocation(self):
+        cmd = Command(['python', '-u', '-c', 'print("spam")'], python=True)
+        with Patch.object(self.zygote, 'spawn') as spawn:
+            self.assertEqual(cmd.get_output(zygote=self.zygote), (0, 'spam'))
+        spawn.assert_not_called()
+
+    def test_timeout(self):
+        cmd = Command(['python', '-c', 'import time; time.sleep(30)'],
+                      python=True)
+        start = time.monotonic()
+        with self.assertRaises(CommandTimeoutError):
+            cmd.get_output(timeout=0.5, zygote=self.zygote)
+        self.assertLess(time.monotonic() - start, 15)
+
+    def test_window(self):
+        cmd = Command(['python', '-c', 'for i in range(10000): print(i)'],
+                      window=(2, -2, False), python=True)
+        self.assertEqual(cmd.get_output(zygote=self.zygote),
+                         (0, '0\n1\n...\n9998\n9999'))
+
+    def test_statistics(self):
+        statistics = {}
+        cmd = Command(['python', '-c', 'print("spam")'], python=True)
+        self.assertEqual(cmd.get_output(statistics=statistics,
+                                        zygote=self.zygote),
+                         (0, 'spam'))
+        self.assertEqual(sorted(statistics),
+                         ['max_rss', 'system', 'user', 'wall'])
+        self.assertGreater(statistics['max_rss'], 1024 * 1024)
+
+    def test_async(self):
+        cmd = Command(['python', '-c', 'print("spam")'], python=True)
+        with Patch.object(self.zygote, 'spawn', wraps=self.zygote.spawn) as spawn:
+            self.assertEqual(asyncio.run(cmd.get_output_async(
+                zygote=self.zygote)), (0, 'spam'))
+        spawn.assert_called_once_with(cmd)
+
+    def test_close(self):
+        cmd = Command(['python', '-c', 'print("spam")'], python=True)
+        self.assertEqual(cmd.get_output(zygote=self.zygote), (0, 'spam'))
+        process = self.zygote._process # pylint:disable=protected-access
+        self.zygote.close()
+        self.assertIsNotNone(process.returncode)
+        self.assertIsNone(self.zygote._process) # pylint:disable=protected-access
+        # It is started again when needed.
+        self.assertEqual(cmd.get_output(zygote=self.zygote), (0, 'spam'))
+
+
+@unittest.skipIf(not ShellSessions.available, "Sessions require a POSIX shell")
+class TestShellSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = ShellSessions()
+        self.addCleanup(self.sessions.close)
+        self.history = []
+
+    def run_command(self, command, name='spam', **kwargs):
+        cmd = Command(command, shell=True,
+                      session=(name, self.history), **kwargs)
+        self.history.append(command)
+        return cmd.get_output(sessions=self.sessions)
+
+    def test_state(self):
+        self.assertEqual(self.run_command('cd /; SPAM=eggs'), (0, ''))
+        self.assertEqual(self.run_command('pwd; echo "$SPAM"'),
+                         (0, '/\neggs'))
+        self.assertEqual(self.run_command('printf spam'), (0, 'spam'))
+        self.assertEqual(self.run_command('echo eggs >&2; false'),
+                         (1, 'eggs'))
+        self.assertEqual(
+            self.run_command('echo spam; echo eggs >&2',
+                             hide_standard_error=True),
+            (0, 'spam'))
+
+    def test_exit(self):
+        self.run_command('SPAM=eggs')
+        self.assertEqual(self.run_command('exit 3'), (3, ''))
+        # The following commands run in a new shell.
+        self.assertEqual(self.run_command('echo "spam$SPAM"'), (0, 'spam'))
+
+    def test_replay(self):
+        self.run_command('SPAM=eggs')
+        self.run_command('SPAM="$SPAM and spam"')
+        # Like the cached output of the commands before.
+        self.sessions.close()
+        self.assertEqual(self.run_command('echo "$SPAM"'),
+                         (0, 'eggs and spam'))
+        cmd = Command('echo "$SPAM"', shell=True,
+                      session=('spam', self.history[:1]))
+        self.assertEqual(cmd.get_output(sessions=self.sessions), (0, 'eggs'))
+        self.assertEqual(cmd.get_output(), (0, 'eggs'))
+
+    def test_syntax_error(self):
+        start = time.monotonic()
+        returncode, output = self.run_command("echo 'unterminated")
+        self.assertLess(time.monotonic() - start, 15)
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('unterminated', output.lower())
+        # Depending on the shell, this may have ended it.
+        self.assertEqual(self.run_command('echo spam'), (0, 'spam'))
+
+    def test_sessions_are_separate(self):
+        self.run_command('SPAM=eggs')
+        self.history = []
+        self.assertEqual(self.run_command('echo "spam$SPAM"', name='eggs'),
+                         (0, 'spam'))
+
+    def test_timeout(self):
+        self.run_command('SPAM=eggs')
+        cmd = Command('sleep 30', shell=True, session=('spam', self.history))
+        self.history.append('sleep 30')
+        start = time.monotonic()
+        with self.assertRaises(CommandTimeoutError):
+            cmd.get_output(timeout=0.5, sessions=self.sessions)
+        self.assertLess(time.monotonic() - start, 15)
+        # The command ended its shell, and is not run again.
+        start = time.monotonic()
+        self.assertEqual(self.run_command('echo "spam$SPAM"'), (0, 'spam'))
+        self.assertLess(time.monotonic() - start, 15)
+
+    def test_window(self):
+        cmd = Command('seq 10000', shell=True, window=(2, -2, False),
+                      session=('spam', ()))
+        self.assertEqual(cmd.get_output(sessions=self.sessions),
+                         (0, '1\n2\n...\n9999\n10000'))
+
+    def test_statistics(self):
+        statistics = {}
+        cmd = Command('sleep 0.2', shell=True, session=('spam', ()))
+        cmd.get_output(statistics=statistics, sessions=self.sessions)
+        self.assertGreaterEqual(statistics['wall'], 0.2)
+
+
+@unittest.skipIf(not SpawnServer.available, "Spawn servers require posix_spawn")
+class TestSpawnServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SpawnServer()
+        self.addCleanup(self.server.close)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def assertSameOutput(self, command, **kwargs):
+        cmd = Command(command, working_directory=self.tmpdir, **kwargs)
+        result = cmd.get_output(spawn_server=self.server)
+        self.assertEqual(result, cmd.get_output())
+        return result
+
+    def test_output(self):
+        self.assertEqual(
+            self.assertSameOutput(['python', '-c', 'import sys, os; '
+                                   'print(sys.argv, os.getcwd()); '
+                                   'print("eggs", file=sys.stderr); '
+                                   'sys.exit(3)', 'spam']),
+            (3, "['-c', 'spam'] %s\neggs" % os.path.realpath(self.tmpdir)))
+
+    def test_shell(self):
+        self.assertEqual(
+            self.assertSameOutput('echo "$0 spam" | tr a-z A-Z; exit 2',
+                                  shell=True),
+            (2, '/BIN/SH SPAM'))
+
+    def test_hidden_standard_error(self):
+        self.assertEqual(
+            self.assertSameOutput('echo spam; echo eggs >&2', shell=True,
+                                  hide_standard_error=True),
+            (0, 'spam'))
+
+    def test_standard_input(self):
+        self.assertEqual(self.assertSameOutput('cat', shell=True), (0, ''))
+
+    def test_environment(self):
+        # The server is already running when the environment changes.
+        self.server.start()
+        with Patch.dict(os.environ, SPAM='eggs'):
+            self.assertEqual(self.assertSameOutput('echo "$SPAM"', shell=True),
+                             (0, 'eggs'))
+
+    def test_signal(self):
+        self.assertEqual(self.assertSameOutput('kill -TERM $$', shell=True),
+                         (-15, ''))
+
+    def test_missing_executable(self):
+        cmd = Command('no_such_executable spam')
+        with self.assertRaises(FileNotFoundError) as context:
+            cmd.get_output(spawn_server=self.server)
+        self.assertEqual(context.exception.filename, 'no_such_executable')
+
+    def test_missing_working_directory(self):
+        cmd = Command('echo spam', working_directory='/no/such/directory')
+        with self.assertRaises(FileNotFoundError):
+            cmd.get_output(spawn_server=self.server)
+        # The server survives errors.
+        self.assertEqual(Command('echo spam').get_output(
+            spawn_server=self.server), (0, 'spam'))
+
+    def test_timeout(self):
+        cmd = Command('sleep 30; echo spam', shell=True)
+        start = time.monotonic()
+        with self.assertRaises(CommandTimeoutError):
+            cmd.get_output(timeout=0.5, spawn_server=self.server)
+        self.assertLess(time.monotonic() - start, 15)
+
+    def test_window(self):
+        cmd = Command('echo spam; echo with; echo eggs; sleep 30',
+                      shell=True, window=(2, None, True))
+        start = time.monotonic()
+        self.assertEqual(cmd.get_output(spawn_server=self.server),
+                         (None, 'spam\nwith\n...'))
+        self.assertLess(time.monotonic() - start, 15)
+
+    def test_statistics(self):
+        statistics = {}
+        cmd = Command(['python', '-c', 'print("spam")'])
+        self.assertEqual(cmd.get_output(statistics=statistics,
+                                        spawn_server=self.server),
+                         (0, 'spam'))
+        self.assertEqual(sorted(statistics),
+                         ['max_rss', 'system', 'user', 'wall'])
+        self.assertGreater(statistics['max_rss'], 1024 * 1024)
+
+    def test_concurrent(self):
+        async def get_outputs():
+            return await asyncio.gather(*[
+                Command('sleep 0.2; echo %d' % i, shell=True).get_output_async(
+                    spawn_server=self.server)
+                for i in range(10)])
+        start = time.monotonic()
+        self.assertEqual(asyncio.run(get_outputs()),
+                         [(0, str(i)) for i in range(10)])
+        self.assertLess(time.monotonic() - start, 2)
+
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
 
@@ -24,7 +24,10 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import functools
+import io
+import json
 import os
+import re
 import sys
 import unittest
 from unittest.mock import patch as Patch
@@ -33,7 +36,13 @@ from docutils.nodes import caption
 from docutils.nodes import container
 from docutils.nodes import literal_block
 from docutils.nodes import system_message
+from sphinx.application import Sphinx
 from sphinxcontrib.programoutput import Command
+from sphinxcontrib.programoutput import ProgramOutputCache
+from sphinxcontrib.programoutput import PythonZygote
+from sphinxcontrib.programoutput import SpawnServer
+from sphinxcontrib.programoutput import _render_output
+from sphinxcontrib.programoutput import run_deferred_programs
 
 from . import AppMixin
 
@@ -48,7 +57,9 @@ def with_content(content, **kwargs):
     """
     if 'python' in content:
         # XXX: This probably breaks if there are spaces in sys.executable.
-        content = content.replace('python', sys.executable)
+        # Leave the ``:python:`` option alone.
+        content = re.sub(r'(?<![:\w])python(?![:\w])',
+                         lambda _: sys.executable, content)
 
     def factory(f):
         @functools.wraps(f)
@@ -435,6 +446,21 @@ U+2264 \u2264 LESS-THAN OR EQUAL TO\n\u2264 line2\n..."""
         self.assertEqual(literal.astext(), '{"foo": "bar"}')
         self.assertEqual(literal["language"], "json")
 
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. command-output:: echo spam
+
+    .. command-output:: echo spam""")
+    def test_render_once(self):
+        with Patch('sphinxcontrib.programoutput._render_output',
+                   wraps=_render_output) as render_output:
+            doctree = self.doctree
+        self.assertEqual([literal.astext() for literal
+                          in doctree.findall(literal_block)],
+                         ['spam', '$ echo spam\nspam', '$ echo spam\nspam'])
+        self.assertEqual(render_output.call_count, 2)
+
     @with_content("""\
     .. program-output:: echo spam""",
                   programoutput_use_ansi=True)
@@ -515,6 +541,509 @@ U+2264 \u2264 LESS-THAN OR EQUAL TO\n\u2264 line2\n..."""
         self.assert_output(self.doctree, 'spam', caption='mycaption')
         self.assert_cache(self.app, 'echo spam', 'spam')
 
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: echo eggs
+
+    .. program-output:: echo spam""",
+                  programoutput_max_workers=4)
+    def test_max_workers(self):
+        literals = list(self.doctree.findall(literal_block))
+        self.assertEqual([literal.astext() for literal in literals],
+                         ['spam', 'eggs', 'spam'])
+        cache = self.app.env.programoutput_cache
+        working_directory = os.path.realpath(self.srcdir)
+        self.assertEqual(cache, {
+            Command('echo spam', working_directory=working_directory): (0, 'spam'),
+            Command('echo eggs', working_directory=working_directory): (0, 'eggs'),
+        })
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: 'spam with eggs'""",
+                  programoutput_max_workers=2)
+    def test_max_workers_with_failure(self):
+        doctree = self.doctree
+        self.assertEqual(doctree.next_node(literal_block).astext(), 'spam')
+        message = doctree.next_node(system_message)
+        self.assertTrue(message)
+        self.assertIn('spam with eggs', message.astext())
+
+    def _write_dependency(self, content):
+        with open(os.path.join(self.srcdir, 'content', 'dep.txt'), 'w',
+                  encoding='utf-8') as f:
+            f.write(content)
+
+    @with_content("""\
+    .. program-output:: cat dep.txt
+       :cwd: .
+       :depends: dep*.txt""")
+    def test_depends(self):
+        self._write_dependency('spam')
+        doctree = self.doctree
+        app = self.app
+        self.assert_output(doctree, 'spam')
+        depfile = os.path.join(self.srcdir, 'content', 'dep.txt')
+        self.assertIn(depfile, {str(path)
+                                for path in app.env.dependencies['content/doc']})
+        (command, result), = app.env.programoutput_cache.items()
+        self.assertEqual(result, (0, 'spam'))
+        self.assertIsNotNone(command.depends)
+
+        # Changing the dependency re-reads the document, and executes the
+        # command again under a new cache key.  The stale entry is pruned.
+        self._write_dependency('eggs')
+        app = Sphinx(str(self.srcdir), str(self.srcdir), str(self.outdir),
+                     str(self.doctreedir), 'html', status=None, warning=None)
+        app.build()
+        self.assert_output(app.env.get_doctree('content/doc'), 'eggs')
+        cache = app.env.programoutput_cache
+        self.assertEqual(len(cache), 1)
+        self.assertNotIn(command, cache)
+
+    def _write_tool(self, output, mtime):
+        tool = os.path.join(self.srcdir, 'tool')
+        with open(tool, 'w', encoding='utf-8') as f:
+            f.write('#!/bin/sh\necho %s\n' % output)
+        os.chmod(tool, 0o755)
+        os.utime(tool, (mtime, mtime))
+
+    @unittest.skipIf(sys.platform == 'win32', "Requires a POSIX shell")
+    @with_content("""\
+    .. program-output:: ./tool | cat
+       :shell:""",
+                  programoutput_fingerprint=True)
+    def test_fingerprint(self):
+        self._write_tool('spam', 1000000000)
+        doctree = self.doctree
+        app = self.app
+        self.assert_output(doctree, 'spam')
+        (command, _), = app.env.programoutput_cache.items()
+        self.assertIsNotNone(command.fingerprint)
+
+        # Upgrading the tool re-reads the document, and executes the command
+        # again under a new cache key.
+        self._write_tool('eggs', 1000000001)
+        app = self._build_again()
+        self.assert_output(app.env.get_doctree('content/doc'), 'eggs')
+        self.assertNotIn(command, app.env.programoutput_cache)
+
+        # Nothing is read again while it is unchanged.
+        read_time = app.env.all_docs['content/doc']
+        app = self._build_again()
+        self.assertEqual(app.env.all_docs['content/doc'], read_time)
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: echo eggs
+       :session: spam
+
+    .. program-output:: echo spam""",
+                  programoutput_speculate=True)
+    def test_speculate(self):
+        speculated = []
+        original = ProgramOutputCache.speculate
+
+        def speculate(cache, command, *args):
+            speculated.append(command)
+            return original(cache, command, *args)
+
+        with Patch.object(ProgramOutputCache, 'speculate', speculate):
+            doctree = self.doctree
+        self.assertEqual([literal.astext() for literal
+                          in doctree.findall(literal_block)],
+                         ['spam', 'eggs', 'spam'])
+        # Session commands are not speculated.
+        self.assertEqual(speculated, [Command(
+            ['echo', 'spam'], working_directory=self.srcdir)] * 2)
+        cache = self.app.env.programoutput_cache
+        self.assertEqual(len(self.app.env.programoutput_statistics.executions),
+                         2)
+        self.assertFalse(cache.speculative)
+        self.assertIsNone(cache._executor) # pylint:disable=protected-access
+
+    @with_content("""\
+    .. program-output:: seq 2
+       :shell:
+
+    .. program-output:: seq 2""")
+    def test_simple_shell_command(self):
+        self.assertEqual([literal.astext() for literal
+                          in self.doctree.findall(literal_block)],
+                         ['1\n2', '1\n2'])
+        (command, _), = self.app.env.programoutput_cache.items()
+        self.assertFalse(command.shell)
+        self.assertEqual(
+            len(self.app.env.programoutput_statistics.executions), 1)
+
+    @with_content("""\
+    .. program-output:: python -c 'print("spam\\n" * 3)'
+       :ellipsis: 1""",
+                  programoutput_spill_threshold=0)
+    def test_spill_threshold(self):
+        original = Command.get_output
+        thresholds = []
+
+        def get_output(command, *args, **kwargs):
+            thresholds.append(kwargs.get('spill_threshold'))
+            return original(command, *args, **kwargs)
+
+        with Patch.object(Command, 'get_output', get_output):
+            self.assert_output(self.doctree, 'spam\n...')
+        self.assertEqual(thresholds, [0])
+
+    def _build_again(self, **confoverrides):
+        # Build with a new application, as a later sphinx-build would.
+        app = Sphinx(str(self.srcdir), str(self.srcdir), str(self.outdir),
+                     str(self.doctreedir), 'html', status=None, warning=None,
+                     confoverrides=dict(self.confoverrides, **confoverrides))
+        app.build()
+        return app
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: ls | sort
+       :shell:""",
+                  programoutput_mode='record')
+    def test_record_replay(self):
+        self.assert_output(self.doctree, 'spam')
+        path = os.path.join(self.srcdir, 'programoutput-cassette.json')
+        with open(path, encoding='utf-8') as f:
+            recorded = json.load(f)['commands']
+        self.assertEqual([entry['command'] for entry in recorded],
+                         ['ls | sort', ['echo', 'spam']])
+        self.assertEqual(recorded[1]['output'], ['spam'])
+
+        # Replay in a fresh environment, without executing anything.
+        with open(path, 'w', encoding='utf-8') as f:
+            recorded[1]['output'] = ['eggs']
+            json.dump(dict(version=1, commands=recorded), f)
+        with Patch.object(Command, 'get_output') as get_output:
+            app = self._build_again(programoutput_mode='replay')
+        get_output.assert_not_called()
+        self.assertEqual(app.env.programoutput_cache.zygote, None)
+        self.assert_output(app.env.get_doctree('content/doc'), 'eggs')
+
+        # Recording again reads the document again.
+        with open(path, 'w', encoding='utf-8') as f:
+            recorded[1]['output'] = ['ham']
+            json.dump(dict(version=1, commands=recorded), f)
+        app = self._build_again(programoutput_mode='replay')
+        self.assert_output(app.env.get_doctree('content/doc'), 'ham')
+
+    @with_content("""\
+    .. program-output:: echo spam""",
+                  programoutput_mode='replay',
+                  ignore_warnings=True)
+    def test_replay_missing(self):
+        with Patch.object(Command, 'get_output') as get_output:
+            message = self.doctree.next_node(system_message)
+        get_output.assert_not_called()
+        self.assertTrue(message)
+        self.assertIn('not recorded in ' + os.path.join(
+            self.srcdir, 'programoutput-cassette.json'), message.astext())
+        self.assertEqual(self.app.env.programoutput_cache, {})
+
+    @with_content("""\
+    .. program-output:: echo spam""",
+                  programoutput_mode='auto',
+                  programoutput_cassette='_cassette.json')
+    def test_auto(self):
+        path = os.path.join(self.srcdir, '_cassette.json')
+        cassette = {'version': 1, 'commands': [{
+            'command': ['echo', 'eggs'], 'shell': False,
+            'hide_standard_error': False, 'working_directory': '.',
+            'depends': None, 'window': None, 'python': False,
+            'session': None, 'returncode': 0, 'output': ['eggs']}]}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(cassette, f)
+        # Missing results are executed, and added to the cassette.
+        self.assert_output(self.doctree, 'spam')
+        with open(path, encoding='utf-8') as f:
+            recorded = json.load(f)['commands']
+        self.assertEqual([entry['output'] for entry in recorded],
+                         [['eggs'], ['spam']])
+
+        # Adding them does not read the document again.
+        read_time = self.app.env.all_docs['content/doc']
+        app = self._build_again()
+        self.assertEqual(app.env.all_docs['content/doc'], read_time)
+
+    @with_content("""\
+    .. program-output:: echo spam
+       :depends: missing.txt""")
+    def test_depends_no_match(self):
+        with Patch('sphinxcontrib.programoutput.logger.warning') as patch_warning:
+            doctree = self.doctree
+        self.assert_output(doctree, 'spam')
+        patch_warning.assert_called_once()
+        self.assertEqual(patch_warning.call_args.args[1], 'missing.txt')
+
+    @with_content("""\
+    .. program-output:: python -c 'import time; time.sleep(30)'
+       :timeout: 0.5""")
+    def test_timeout(self):
+        message = self.doctree.next_node(system_message)
+        self.assertTrue(message)
+        self.assertIn('timed out after 0.5 seconds', message.astext())
+        self.assertEqual(self.app.env.programoutput_cache, {})
+
+    @with_content("""\
+    .. program-output:: python -c 'import time; time.sleep(30)'""",
+                  programoutput_timeout=0.5)
+    def test_timeout_config(self):
+        message = self.doctree.next_node(system_message)
+        self.assertTrue(message)
+        self.assertIn('timed out after 0.5 seconds', message.astext())
+
+    @with_content("""\
+    .. program-output:: echo spam
+       :timeout: 30""",
+                  programoutput_timeout=0.5)
+    def test_timeout_option_overrides_config(self):
+        self.assert_output(self.doctree, 'spam')
+        self.assert_cache(self.app, 'echo spam', 'spam')
+
+    @with_content("""\
+    .. program-output:: python -c 'print("spam\\nwith\\neggs")'
+       :ellipsis: 1, -1""",
+                  programoutput_stream_ellipsis=True)
+    def test_ellipsis_streamed(self):
+        self.assert_output(self.doctree, 'spam\n...\neggs')
+        (command, result), = self.app.env.programoutput_cache.items()
+        self.assertEqual(command.window, (1, -1, False))
+        self.assertEqual(result, (0, 'spam\n...\neggs'))
+
+    @with_content("""\
+    .. command-output:: python -c 'print("spam\\nwith\\neggs")'
+       :ellipsis: 1""",
+                  programoutput_stream_ellipsis='stop',
+                  programoutput_prompt_template='{output}\n[{returncode}]',
+                  ignore_warnings=False)
+    def test_ellipsis_streamed_stop_early(self):
+        with Patch('sphinxcontrib.programoutput.logger.warning') as patch_warning:
+            doctree = self.doctree
+        self.assert_output(doctree, 'spam\n...\n[None]')
+        patch_warning.assert_not_called()
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: echo eggs
+       :shell:
+
+    .. program-output:: 'spam with eggs'
+
+    .. program-output:: echo spam""",
+                  programoutput_engine='asyncio',
+                  programoutput_max_workers=2)
+    def test_asyncio_engine(self):
+        doctree = self.doctree
+        literals = list(doctree.findall(literal_block))
+        self.assertEqual([literal.astext() for literal in literals],
+                         ['spam', 'eggs', 'spam'])
+        message = doctree.next_node(system_message)
+        self.assertTrue(message)
+        self.assertIn('spam with eggs', message.astext())
+        self.assertEqual(len(self.app.env.programoutput_cache), 2)
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: 'spam with eggs'""",
+                  programoutput_defer=True)
+    def test_defer(self):
+        app = self.app
+        app.build()
+        cache = app.env.programoutput_cache
+        self.assertEqual(len(cache.failures), 1)
+        with Patch.object(Command, 'get_output') as get_output:
+            doctree = app.env.get_doctree('content/doc')
+            app.env.apply_post_transforms(doctree, 'content/doc')
+        get_output.assert_not_called()
+        self.assert_output(doctree, 'spam')
+        message = doctree.next_node(system_message)
+        self.assertTrue(message)
+        self.assertIn('spam with eggs', message.astext())
+        self.assert_cache(app, 'echo spam', 'spam')
+
+    @with_content('.. program-output:: echo spam',
+                  programoutput_defer=True)
+    def test_defer_cached(self):
+        app = self.app
+        app.build()
+        cache = app.env.programoutput_cache
+        app.env.programoutput_pending = dict.fromkeys(cache, None)
+        with Patch.object(ProgramOutputCache, '__getitem__') as getitem:
+            run_deferred_programs(app, app.env)
+        getitem.assert_not_called()
+        self.assertFalse(cache.failures)
+        self.assertFalse(app.env.programoutput_pending)
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: echo spam
+
+    .. program-output:: echo eggs""",
+                  programoutput_report_slowest=1,
+                  programoutput_report_file='programoutput.json')
+    def test_report(self):
+        with Patch('sphinxcontrib.programoutput.logger.info') as patch_info:
+            self.app.build()
+        self.assertEqual(patch_info.call_count, 2)
+        with open(os.path.join(self.outdir, 'programoutput.json'),
+                  encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(report['executions'], 2)
+        self.assertEqual(report['documents']['content/doc']['executed'], 2)
+        self.assertEqual(sorted(entry['command'] for entry in report['commands']),
+                         [['echo', 'eggs'], ['echo', 'spam']])
+
+    @with_content("""\
+    .. program-output:: python -c 'import sys; print(sys.argv)' spam
+       :python:
+
+    .. program-output:: python -m json.tool --help
+       :python:
+       :nostderr:""",
+                  programoutput_python_preload=['json'])
+    def test_python(self):
+        app = self.app
+        with Patch('sphinxcontrib.programoutput.PythonZygote.close',
+                   autospec=True, side_effect=PythonZygote.close) as close:
+            app.build()
+        literals = list(app.env.get_doctree('content/doc').findall(literal_block))
+        self.assertEqual(literals[0].astext(), "['-c', 'spam']")
+        self.assertIn('json.tool', literals[1].astext())
+        if PythonZygote.available:
+            zygote, = [call.args[0] for call in close.call_args_list]
+            self.assertEqual(zygote.preload, ['json'])
+            self.assertIsNone(zygote._process) # pylint:disable=protected-access
+        self.assertIsNone(app.env.programoutput_cache.zygote)
+        command = Command([sys.executable, '-c', 'import sys; print(sys.argv)',
+                           'spam'], working_directory=app.srcdir, python=True)
+        self.assertEqual(app.env.programoutput_cache[command],
+                         (0, "['-c', 'spam']"))
+
+    @with_content("""\
+    .. program-output:: python -c 'print("spam")'
+       :python:
+       :shell:""")
+    def test_python_with_shell(self):
+        warnings = io.StringIO()
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, self.doctreedir,
+                     'html', status=None, warning=warnings)
+        app.build()
+        self.assertIn('The python and shell options are mutually exclusive',
+                      warnings.getvalue())
+        self.assertEqual(app.env.programoutput_cache, {})
+
+    @with_content("""\
+    .. program-output:: ls -c spam
+       :python:
+
+    .. program-output:: python3.99 -c 'print("spam")'
+       :python:""")
+    def test_python_without_interpreter(self):
+        warnings = io.StringIO()
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, self.doctreedir,
+                     'html', status=None, warning=warnings)
+        app.build()
+        self.assertIn("The python option requires a Python interpreter, not "
+                      "'ls'", warnings.getvalue())
+        (command, result), = app.env.programoutput_cache.items()
+        self.assertEqual(command.command[0], 'python3.99')
+        self.assertEqual(result, (0, 'spam'))
+
+    @with_content("""\
+    .. program-output:: cd content; SPAM=eggs
+       :session: spam
+
+    .. program-output:: SPAM=spam
+       :session: eggs
+
+    .. program-output:: echo "$SPAM"; basename "$PWD"
+       :session: spam
+
+    .. program-output:: echo "$SPAM"; basename "$PWD"
+       :session: eggs
+
+    .. program-output:: echo "$SPAM"
+       :shell:""",
+                  programoutput_max_workers=4)
+    def test_session(self):
+        literals = list(self.doctree.findall(literal_block))
+        self.assertEqual([literal.astext() for literal in literals],
+                         ['', '', 'eggs\ncontent', 'spam\nsrc', ''])
+        command = Command('echo "$SPAM"; basename "$PWD"', shell=True,
+                          working_directory=self.app.srcdir,
+                          session=('spam', ['cd content; SPAM=eggs']))
+        self.assertEqual(self.app.env.programoutput_cache[command],
+                         (0, 'eggs\ncontent'))
+
+    @with_content("""\
+    .. program-output:: SPAM=eggs
+       :session: spam
+
+    .. program-output:: echo "$SPAM"
+       :session: spam""")
+    def test_session_cached(self):
+        self.app.build()
+        with open(os.path.join(self.srcdir, 'content', 'doc.rst'), 'a',
+                  encoding='utf-8') as f:
+            f.write('\n.. program-output:: echo "spam and $SPAM"\n'
+                    '   :session: spam\n')
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, self.doctreedir,
+                     'html', status=None, warning=None)
+        with Patch.object(Command, 'get_output',
+                          autospec=True, side_effect=Command.get_output) as get_output:
+            app.build()
+        # Only the new command is executed, in a session that ran the others
+        # again.
+        self.assertEqual(len(get_output.call_args_list), 1)
+        literals = list(app.env.get_doctree('content/doc').findall(literal_block))
+        self.assertEqual([literal.astext() for literal in literals],
+                         ['', 'eggs', 'spam and eggs'])
+
+    @with_content("""\
+    .. program-output:: python -c 'print("spam")'
+       :python:
+       :session: spam""")
+    def test_session_with_python(self):
+        warnings = io.StringIO()
+        app = Sphinx(self.srcdir, self.srcdir, self.outdir, self.doctreedir,
+                     'html', status=None, warning=warnings)
+        app.build()
+        self.assertIn('The python and session options are mutually exclusive',
+                      warnings.getvalue())
+
+    @with_content("""\
+    .. program-output:: echo spam
+
+    .. program-output:: echo "$0 eggs" >&2
+       :shell:""",
+                  programoutput_spawn_server=True)
+    def test_spawn_server(self):
+        app = self.app
+        with Patch.object(SpawnServer, 'spawn', autospec=True,
+                          side_effect=SpawnServer.spawn) as spawn, \
+             Patch('sphinxcontrib.programoutput.SpawnServer.close',
+                   autospec=True, side_effect=SpawnServer.close) as close:
+            app.build()
+        literals = list(app.env.get_doctree('content/doc').findall(literal_block))
+        self.assertEqual([literal.astext() for literal in literals],
+                         ['spam', '/bin/sh eggs'])
+        if SpawnServer.available:
+            self.assertEqual(len(spawn.call_args_list), 2)
+            server, = [call.args[0] for call in close.call_args_list]
+            self.assertIsNone(server._process) # pylint:disable=protected-access
+        self.assertIsNone(app.env.programoutput_cache.spawn_server)
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
 
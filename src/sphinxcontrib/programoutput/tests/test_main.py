@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import unittest
+from unittest.mock import patch as Patch
+
+from sphinxcontrib.programoutput import Command
+from sphinxcontrib.programoutput import SQLiteResultStore
+from sphinxcontrib.programoutput.__main__ import main
+from sphinxcontrib.programoutput.__main__ import shard
+
+from . import AppMixin
+
+
+class TestMain(AppMixin,
+               unittest.TestCase):
+
+    document_content = """\
+.. program-output:: echo spam
+
+.. program-output:: echo eggs
+   :timeout: 10
+
+.. program-output:: export SPAM=ham
+   :session: spam
+
+.. program-output:: echo $SPAM
+   :session: spam
+
+.. program-output:: echo spam
+"""
+
+    def main(self, *argv):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            status = main(list(argv))
+        return status, stdout.getvalue()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_manifest(self):
+        with Patch.object(Command, 'get_output') as get_output:
+            status, stdout = self.main('manifest', self.srcdir,
+                                       self.path('manifest.json'))
+        get_output.assert_not_called()
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, '4 commands\n')
+        with open(self.path('manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['srcdir'], self.srcdir)
+        commands = {str(entry['command']): entry
+                    for entry in manifest['commands']}
+        self.assertEqual(commands["['echo', 'eggs']"]['timeout'], 10)
+        self.assertEqual(commands["['echo', 'eggs']"]['working_directory'],
+                         '.')
+        self.assertEqual(commands['echo $SPAM']['session'],
+                         ['spam', ['export SPAM=ham']])
+
+    def test_run_shards_and_merge(self):
+        self.main('manifest', self.srcdir, self.path('manifest.json'))
+        outputs = {}
+        for index in 1, 2:
+            results = self.path('results-{0}.json'.format(index))
+            status, _ = self.main('run', self.path('manifest.json'), results,
+                                  '--shard', '{0}/2'.format(index))
+            self.assertEqual(status, 0)
+            with open(results, encoding='utf-8') as f:
+                shard_outputs = {str(entry['command']): entry['output']
+                                 for entry in json.load(f)['results']}
+            self.assertTrue(shard_outputs)
+            self.assertFalse(set(shard_outputs) & set(outputs))
+            outputs.update(shard_outputs)
+        self.assertEqual(outputs, {"['echo', 'spam']": 'spam',
+                                   "['echo', 'eggs']": 'eggs',
+                                   'export SPAM=ham': '',
+                                   'echo $SPAM': 'ham'})
+
+        status, stdout = self.main(
+            'merge', self.path('cache'), self.path('results-1.json'),
+            self.path('results-2.json'))
+        self.assertEqual(status, 0)
+        self.assertIn('4 results merged', stdout)
+
+        # A build with the merged results executes nothing.
+        getattr(self, 'confoverrides')
+        self.confoverrides = {'programoutput_cache_dir': self.path('cache')}
+        with Patch.object(Command, 'get_output') as get_output:
+            doctree = self.doctree
+        get_output.assert_not_called()
+        self.assertEqual(sum(self.app.env.programoutput_statistics.hits.values()), 4)
+        self.assertIn('ham', doctree.astext())
+
+    def test_moved_srcdir(self):
+        self.main('manifest', self.srcdir, self.path('manifest.json'))
+        srcdir = self.path('moved')
+        shutil.copytree(self.srcdir, srcdir)
+        self.main('run', self.path('manifest.json'), self.path('results.json'),
+                  '--srcdir', srcdir)
+        self.main('merge', self.path('cache'), self.path('results.json'))
+        store = SQLiteResultStore(self.path('cache'))
+        self.assertEqual(store.get(Command(['echo', 'spam'],
+                                           working_directory=srcdir)),
+                         (0, 'spam'))
+        self.assertIsNone(store.get(Command(['echo', 'spam'],
+                                            working_directory=self.srcdir)))
+
+    def test_failure(self):
+        manifest = self.path('manifest.json')
+        with open(manifest, 'w', encoding='utf-8') as f:
+            json.dump(dict(version=1, srcdir=self.tmpdir, commands=[dict(
+                command=['spam with eggs'], working_directory='.')]), f)
+        with Patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            status, stdout = self.main('run', manifest,
+                                       self.path('results.json'))
+        self.assertEqual(status, 1)
+        self.assertEqual(stdout, '0 of 1 commands executed\n')
+        self.assertIn("Command ['spam with eggs'] failed", stderr.getvalue())
+
+    def test_invalid_files(self):
+        with open(self.path('results.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(version=1, commands=[]), f)
+        with Patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            status, _ = self.main('merge', self.path('cache'),
+                                  self.path('results.json'))
+        self.assertEqual(status, 2)
+        self.assertIn('is not a result file', stderr.getvalue())
+
+
+class TestShard(unittest.TestCase):
+
+    def test_shards(self):
+        commands = [Command(['echo', str(i)]) for i in range(10)]
+        shards = [shard(commands, index, 3) for index in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, []), key=commands.index),
+                         commands)
+        self.assertEqual([len(commands) for commands in shards], [4, 3, 3])
+        self.assertEqual(shard(list(reversed(commands)), 2, 3),
+                         list(reversed(shards[1])))
+
+    def test_sessions(self):
+        commands = [Command('a', shell=True, session=('s', ())),
+                    Command('b', shell=True, session=('s', ('a',))),
+                    Command('c', shell=True, session=('s', ('a', 'b'))),
+                    Command('d', shell=True, session=('t', ()))]
+        self.assertEqual(
+            sorted([shard(commands, 1, 2), shard(commands, 2, 2)], key=len),
+            [commands[3:], commands[:3]])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
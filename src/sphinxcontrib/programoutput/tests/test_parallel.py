@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, 2012, Sebastian Wiesner <lunaryorn@gmail.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch as Patch
+
+from docutils.nodes import literal_block
+from sphinx.application import Sphinx
+
+from sphinxcontrib import programoutput
+from sphinxcontrib.programoutput import Command
+from sphinxcontrib.programoutput import PythonZygote
+from sphinxcontrib.programoutput import SingleFlight
+
+from . import AppMixin
+from . import CONF_PY
+from . import Lazy
+
+#: Number of documents to generate; Sphinx only reads in parallel if there
+#: are more than five.
+DOCUMENTS = 8
+
+#: A command that counts its invocations in the file ``counter``.
+COUNTING_COMMAND = (
+    "python -c 'open(\"counter\", \"a\").write(\"x\"); print(\"spam\")'"
+).replace('python', sys.executable)
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), "Parallel reading requires fork")
+class TestParallel(AppMixin,
+                   unittest.TestCase):
+
+    @Lazy
+    def srcdir(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(srcdir)
+        with open(os.path.join(srcdir, 'conf.py'), 'w', encoding='utf-8') as f:
+            f.write(CONF_PY)
+        with open(os.path.join(srcdir, 'index.rst'), 'w', encoding='utf-8') as f:
+            f.write('.. toctree::\n\n')
+            for i in range(DOCUMENTS):
+                f.write('   doc%d\n' % i)
+        for i in range(DOCUMENTS):
+            with open(os.path.join(srcdir, 'doc%d.rst' % i), 'w',
+                      encoding='utf-8') as f:
+                f.write('=====\nTitle\n=====\n\n')
+                f.write('.. program-output:: %s\n\n' % COUNTING_COMMAND)
+                f.write('.. program-output:: echo %d\n' % i)
+        return srcdir
+
+    def build(self, parallel=2, **confoverrides):
+        app = Sphinx(str(self.srcdir), str(self.srcdir), str(self.outdir),
+                     str(self.doctreedir), 'html', status=None, warning=None,
+                     parallel=parallel, confoverrides=confoverrides)
+        app.build()
+        return app
+
+    def test_merge_and_single_flight(self):
+        app = self.build()
+        srcdir = os.path.realpath(self.srcdir)
+        with open(os.path.join(srcdir, 'counter'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'x')
+
+        cache = app.env.programoutput_cache
+        self.assertEqual(cache[Command(COUNTING_COMMAND, working_directory=srcdir)],
+                         (0, 'spam'))
+        for i in range(DOCUMENTS):
+            self.assertEqual(
+                cache[Command('echo %d' % i, working_directory=srcdir)],
+                (0, str(i)))
+        self.assertEqual(len(cache), DOCUMENTS + 1)
+        self.assertEqual(len(app.env.programoutput_commands), DOCUMENTS)
+        self.assertIsNone(cache.single_flight)
+
+        # The merged cache is pickled with the environment, so the next
+        # build does not execute anything.
+        os.utime(os.path.join(self.srcdir, 'doc0.rst'))
+        app = self.build()
+        with open(os.path.join(srcdir, 'counter'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'x')
+
+    def write_python_commands(self):
+        for i in range(DOCUMENTS):
+            with open(os.path.join(self.srcdir, 'doc%d.rst' % i), 'w',
+                      encoding='utf-8') as f:
+                f.write('=====\nTitle\n=====\n\n'
+                        '.. program-output:: %s -c "print(%d)"\n'
+                        '   :python:\n' % (sys.executable, i))
+
+    def build_in_tmpdir(self, **confoverrides):
+        # Build, and return the app and the temporary files left behind.
+        tmpdir = os.path.join(self.tmpdir, 'tmp')
+        os.makedirs(tmpdir, exist_ok=True)
+        with Patch.object(tempfile, 'tempdir', tmpdir):
+            app = self.build(**confoverrides)
+        # Zygotes started by readers clean up once they notice they exited.
+        for _ in range(100):
+            if not os.listdir(tmpdir):
+                break
+            time.sleep(0.05)
+        return app, os.listdir(tmpdir)
+
+    @unittest.skipIf(not PythonZygote.available, "Zygotes require fork")
+    def test_zygote_shared(self):
+        self.write_python_commands()
+        with Patch.object(PythonZygote, 'start', autospec=True,
+                          side_effect=PythonZygote.start) as start:
+            app, left = self.build_in_tmpdir(
+                programoutput_python_preload=['json'])
+        # The readers use the zygote started before they were forked, rather
+        # than starting their own.
+        start.assert_called_once()
+        doctree = app.env.get_doctree('doc3')
+        self.assertEqual([node.astext() for node in doctree.findall(literal_block)],
+                         ['3'])
+        self.assertEqual(left, [])
+
+        # Documents which ran Python commands do not need preloads.
+        for i in range(DOCUMENTS):
+            os.utime(os.path.join(self.srcdir, 'doc%d.rst' % i))
+        with Patch.object(PythonZygote, 'start', autospec=True,
+                          side_effect=PythonZygote.start) as start:
+            _, left = self.build_in_tmpdir()
+        start.assert_called_once()
+        self.assertEqual(left, [])
+
+    @unittest.skipIf(not PythonZygote.available, "Zygotes require fork")
+    def test_zygote_lazy(self):
+        with Patch.object(PythonZygote, 'start') as start:
+            self.build()
+        start.assert_not_called()
+
+        # Without anything telling, the readers start their own, and leave
+        # nothing behind.
+        self.write_python_commands()
+        app, left = self.build_in_tmpdir()
+        doctree = app.env.get_doctree('doc3')
+        self.assertEqual([node.astext() for node in doctree.findall(literal_block)],
+                         ['3'])
+        self.assertEqual(left, [])
+
+    def test_defer(self):
+        batches = []
+        get_results = programoutput._get_results # pylint:disable=protected-access
+
+        def record_batch(app, commands, **kwargs):
+            batches.append(len(commands))
+            return get_results(app, commands, **kwargs)
+
+        with Patch.object(programoutput, '_get_results', record_batch):
+            app = self.build(programoutput_defer=True,
+                             programoutput_max_workers=4)
+        # One batch for all documents, then cache hits when resolving.
+        self.assertEqual(batches, [DOCUMENTS + 1] + [2] * DOCUMENTS)
+        self.assertFalse(app.env.programoutput_pending)
+        with open(os.path.join(self.srcdir, 'counter'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'x')
+
+        # The nodes are only replaced when resolving.
+        doctree = app.env.get_doctree('doc3')
+        self.assertIsNotNone(doctree.next_node(programoutput.program_output))
+        doctree = app.env.get_doctree('doc3')
+        app.env.apply_post_transforms(doctree, 'doc3')
+        self.assertIsNone(doctree.next_node(programoutput.program_output))
+        self.assertEqual([node.astext() for node in doctree.findall(literal_block)],
+                         ['spam', '3'])
+
+    def test_prune(self):
+        self.build(parallel=0)
+        with open(os.path.join(self.srcdir, 'doc0.rst'), 'w',
+                  encoding='utf-8') as f:
+            f.write('=====\nTitle\n=====\n\n.. program-output:: echo eggs\n')
+        app = self.build(parallel=0)
+        srcdir = os.path.realpath(self.srcdir)
+        cache = app.env.programoutput_cache
+        self.assertNotIn(Command('echo 0', working_directory=srcdir), cache)
+        self.assertIn(Command('echo eggs', working_directory=srcdir), cache)
+        # Still used by other documents.
+        self.assertIn(Command(COUNTING_COMMAND, working_directory=srcdir), cache)
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), "SingleFlight requires fcntl")
+class TestSingleFlight(AppMixin,
+                       unittest.TestCase):
+
+    def test_execute_once(self):
+        calls = []
+
+        def execute(command):
+            calls.append(command)
+            return (0, 'spam')
+
+        cmd = Command(['echo', 'spam'])
+        self.assertEqual(SingleFlight(self.tmpdir)(cmd, execute), (0, 'spam'))
+        self.assertEqual(SingleFlight(self.tmpdir)(cmd, execute), (0, 'spam'))
+        self.assertEqual(calls, [cmd])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -25,9 +25,26 @@
 
 from __future__ import (print_function, division, absolute_import)
 
+import io
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+from unittest.mock import patch as Patch
 
+from sphinxcontrib.programoutput import Command
+from sphinxcontrib.programoutput import _executable_names
+from sphinxcontrib.programoutput import _fingerprint
 from sphinxcontrib.programoutput import _slice
+from sphinxcontrib.programoutput import _strip_ansi_formatting
+from sphinxcontrib.programoutput import _timeout
+from sphinxcontrib.programoutput._output import _OutputWindow
+from sphinxcontrib.programoutput._output import _output_pipeline
+from sphinxcontrib.programoutput._output import _output_text
+from sphinxcontrib.programoutput._output import _spool
+from sphinxcontrib.programoutput._output import _spooled_text
+from sphinxcontrib.programoutput._zygote import _python_invocation
 
 class TestSlice(unittest.TestCase):
 
@@ -54,6 +71,240 @@ class TestSlice(unittest.TestCase):
         self.assertEqual(str(exc.exception.args[0]), 'too many slice parts')
 
 
+class TestTimeout(unittest.TestCase):
+
+    def test_timeout(self):
+        self.assertEqual(_timeout('2'), 2.0)
+        self.assertEqual(_timeout('0.5'), 0.5)
+
+    def test_timeout_not_positive(self):
+        with self.assertRaises(ValueError) as exc:
+            _timeout('0')
+        self.assertEqual(str(exc.exception), 'timeout must be positive')
+
+
+class TestPythonInvocation(unittest.TestCase):
+
+    def test_supported(self):
+        self.assertEqual(_python_invocation(('python', '-m', 'spam', '-e')),
+                         ('-m', 'spam', ['-e']))
+        self.assertEqual(_python_invocation(('python3', '-c', 'spam')),
+                         ('-c', 'spam', []))
+        self.assertEqual(_python_invocation(('py', 'spam.py', 'eggs')),
+                         ('', 'spam.py', ['eggs']))
+
+    def test_unsupported(self):
+        self.assertIsNone(_python_invocation(('python',)))
+        self.assertIsNone(_python_invocation(('python', '-m')))
+        self.assertIsNone(_python_invocation(('python', '-u', 'spam.py')))
+        self.assertIsNone(_python_invocation(('python', '-')))
+
+
+class TestOutputWindow(unittest.TestCase):
+
+    OUTPUTS = [
+        '',
+        '\n\n',
+        'spam',
+        'spam  \n',
+        'spam\nwith\neggs\n',
+        '\n\nspam\n \nwith\n\neggs  \n\t\n\n',
+        '\n'.join(str(i) for i in range(10)),
+    ]
+
+    BOUNDS = [None, -12, -5, -2, -1, 0, 1, 2, 5, 12]
+
+    @staticmethod
+    def expected(output, start, stop):
+        lines = output.rstrip().splitlines()
+        lines[start:stop] = ['...']
+        return lines
+
+    @staticmethod
+    def window(output, start, stop):
+        window = _OutputWindow(start, stop)
+        for line in output.splitlines():
+            window.feed(line)
+        return window.lines()
+
+    def test_like_slicing(self):
+        for output in self.OUTPUTS:
+            for start in self.BOUNDS[1:]:
+                for stop in self.BOUNDS:
+                    self.assertEqual(self.window(output, start, stop),
+                                     self.expected(output, start, stop),
+                                     (output, start, stop))
+
+    def test_bounded(self):
+        window = _OutputWindow(2, -3)
+        for i in range(1000):
+            window.feed(str(i))
+        self.assertEqual(window.head, ['0', '1'])
+        self.assertEqual(len(window.tail), 3)
+        self.assertFalse(window.done)
+        self.assertEqual(window.lines(), ['0', '1', '...', '997', '998', '999'])
+
+    def test_done(self):
+        window = _OutputWindow(2, None)
+        window.feed('spam')
+        window.feed('with')
+        self.assertFalse(window.done)
+        window.feed('eggs')
+        self.assertTrue(window.done)
+        self.assertEqual(window.lines(), ['spam', 'with', '...'])
+
+
+class TestOutputText(unittest.TestCase):
+
+    OUTPUTS = TestOutputWindow.OUTPUTS + [
+        'spam\r\nwith\reggs\r\n',
+        'bl\xf6k\u2028spam\x85\n\nwith eggs\xa0\n',
+        'spam\n\xa0\n',
+    ]
+
+    def test_like_decoding(self):
+        for output in self.OUTPUTS + ['bl\udcffk \n']:
+            data = output.encode('utf-8', 'surrogateescape')
+            expected = data.decode('utf-8', 'replace').rstrip()
+            self.assertEqual(_output_text(data, None, 'utf-8'), expected)
+            self.assertEqual(_output_text(data, None, 'latin-1'),
+                             data.decode('latin-1').rstrip())
+
+    def test_like_window(self):
+        for output in self.OUTPUTS:
+            data = output.encode('utf-8')
+            for start in TestOutputWindow.BOUNDS[1:]:
+                for stop in TestOutputWindow.BOUNDS:
+                    self.assertEqual(
+                        _output_text(data, (start, stop), 'utf-8'),
+                        '\n'.join(TestOutputWindow.window(output, start,
+                                                          stop)),
+                        (output, start, stop))
+
+    def test_spool(self):
+        data = '\n'.join(str(i) for i in range(10000)).encode('ascii')
+        self.assertEqual(_spool(io.BytesIO(data), len(data)), data)
+        spool = _spool(io.BytesIO(data + b'\n\n'), len(data))
+        self.assertFalse(isinstance(spool, bytes))
+        self.assertEqual(_spooled_text(spool, (2, -2), 'utf-8'),
+                         '0\n1\n...\n9998\n9999')
+        self.assertTrue(spool.closed)
+        spool = _spool(io.BytesIO(data), 0)
+        self.assertEqual(_spooled_text(spool, None, 'utf-8'),
+                         data.decode('ascii'))
+
+
+class TestOutputPipeline(unittest.TestCase):
+
+    OUTPUTS = [output.rstrip() for output in TestOutputText.OUTPUTS] + [
+        '\x1b[31mspam\x1b[0m\nwith\n\x1b[1meggs\x1b[0m',
+        'bl\udcffk\n\x1b[1m\n\x1b[0m',
+    ]
+
+    def test_like_text(self):
+        for output in self.OUTPUTS:
+            data = output.encode('utf-8', 'surrogateescape')
+            self.assertEqual(_output_pipeline(None, False)(data), output)
+            self.assertEqual(_output_pipeline(None, True)(data),
+                             _strip_ansi_formatting(output))
+            for start in TestOutputWindow.BOUNDS[1:]:
+                for stop in TestOutputWindow.BOUNDS:
+                    lines = output.splitlines()
+                    lines[start:stop] = ['...']
+                    expected = '\n'.join(lines)
+                    for strip_ansi in (False, True):
+                        if strip_ansi:
+                            expected = _strip_ansi_formatting(expected)
+                        self.assertEqual(
+                            _output_pipeline((start, stop), strip_ansi)(data),
+                            expected, (output, start, stop, strip_ansi))
+
+    def test_built_once(self):
+        self.assertIs(_output_pipeline((1, 2), True),
+                      _output_pipeline((1, 2), True))
+
+
+class TestExecutableNames(unittest.TestCase):
+
+    def test_program(self):
+        self.assertEqual(_executable_names(Command('ls -l')), ['ls'])
+        self.assertEqual(
+            _executable_names(Command('python -V', python=True)),
+            [sys.executable])
+
+    def test_shell(self):
+        command = Command('a "x | y" | b && c; X=1 d >out 2>&1 | <in e',
+                          shell=True)
+        self.assertEqual(_executable_names(command),
+                         ['a', 'b', 'c', 'd', 'e'])
+
+    def test_unbalanced_quotes(self):
+        command = Command('a | b "c | d', shell=True)
+        self.assertEqual(_executable_names(command), ['a', 'b'])
+
+
+class _Config(object):
+
+    def __init__(self, programoutput_fingerprint=True,
+                 programoutput_fingerprint_environment=()):
+        self.programoutput_fingerprint = programoutput_fingerprint
+        self.programoutput_fingerprint_environment = \
+            programoutput_fingerprint_environment
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.tool = os.path.join(self.directory, 'tool')
+        self.command = Command('./tool', working_directory=self.directory)
+        self._write_tool('spam', 1000000000)
+
+    def _write_tool(self, content, mtime):
+        with open(self.tool, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.utime(self.tool, (mtime, mtime))
+
+    def test_executable_changed(self):
+        config = _Config()
+        fingerprint = _fingerprint(self.command, config)
+        self.assertEqual(_fingerprint(self.command, config), fingerprint)
+        self._write_tool('spam', 1000000001)
+        self.assertNotEqual(_fingerprint(self.command, config), fingerprint)
+        fingerprint = _fingerprint(self.command, config)
+        self._write_tool('eggs and spam', 1000000001)
+        self.assertNotEqual(_fingerprint(self.command, config), fingerprint)
+
+    def test_hash(self):
+        config = _Config('hash')
+        fingerprint = _fingerprint(self.command, config)
+        self._write_tool('spam', 1000000001)
+        self.assertEqual(_fingerprint(self.command, config), fingerprint)
+        self._write_tool('eggs', 1000000002)
+        self.assertNotEqual(_fingerprint(self.command, config), fingerprint)
+
+    def test_environment(self):
+        config = _Config(programoutput_fingerprint_environment=['SPAM'])
+        with Patch.dict(os.environ, {'SPAM': 'eggs', 'EGGS': 'spam'}):
+            fingerprint = _fingerprint(self.command, config)
+            os.environ['EGGS'] = 'ham'
+            self.assertEqual(_fingerprint(self.command, config), fingerprint)
+            os.environ['SPAM'] = 'ham'
+            self.assertNotEqual(_fingerprint(self.command, config),
+                                fingerprint)
+
+    def test_missing_executable(self):
+        config = _Config()
+        command = Command('this-executable-does-not-exist',
+                          working_directory=self.directory)
+        fingerprint = _fingerprint(command, config)
+        self.assertEqual(_fingerprint(command, config), fingerprint)
+        os.remove(self.tool)
+        self.assertEqual(_fingerprint(self.command, config),
+                         _fingerprint(self.command, config))
+
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
 